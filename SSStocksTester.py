@@ -5,13 +5,23 @@ __author__ = 'sachi'
 basic unit tests that ensure that invalid data is being dealt with (by exceptions), it efficiently creates a random
 exchange wih trades, that checks for normal-function'''
 
+import numpy as np
 import numpy.random as npr
 import random, string, unittest
 import time, gc
 from datetime import datetime, timedelta
+from decimal import Decimal
 from SuperSimpleStocks.Stock import Stock, StockType
-from SuperSimpleStocks.Exchange import Exchange
-from SuperSimpleStocks.Trade import TradeType
+from SuperSimpleStocks.Exchange import Exchange, IndexBasis
+from SuperSimpleStocks.ShardedExchange import ShardedExchange
+from SuperSimpleStocks.Feed import TradeFeed, encodeTrade, decodeTrades, fileSource
+from SuperSimpleStocks.Journal import Journal
+from SuperSimpleStocks.Archive import saveExchange, loadExchange, loadTrades
+from SuperSimpleStocks.Segments import SegmentStore
+from SuperSimpleStocks.Windows import SlidingWindow
+from SuperSimpleStocks.Metrics import METRICS
+from SuperSimpleStocks.Subscriptions import Topic
+from SuperSimpleStocks.Trade import Trade, TradeType, TRADE_KEY
 
 import timeit
 
@@ -40,8 +50,588 @@ class TestStocks(unittest.TestCase):
           Stock("ASX",StockType.Preferred,12,101)
 
 
+#--Class for Unit testing Trade storage on Stocks-------------------------------------------------------------
+class TestTrades(unittest.TestCase):
+
+#Check trades are kept in timestamp order, and read back as Trade objects
+
+  def test_trade_order(self):
+      stock = Stock("ASX",StockType.Common,12,12)
+      now = datetime.utcnow()
+      stock.addTrade(now, 5, TradeType.BUY, 10)
+      stock.addTrade(now-timedelta(minutes=1), 3, TradeType.SELL, 20)
+      stock.addTrade(now+timedelta(minutes=1), 2, TradeType.BUY, 30)
+
+      self.assertEqual(len(stock.trades), 3)
+      self.assertEqual([x.trade_price for x in stock.trades], [20, 10, 30])
+      self.assertEqual(stock.trades[0].timestamp, now-timedelta(minutes=1))
+      self.assertIs(stock.trades[-1].trade_type, TradeType.BUY)
+
+#Check the volume weighted price only counts the last 15 minutes, including trades inserted out of order
+
+  def test_volume_weighted_price(self):
+      stock = Stock("ASX",StockType.Common,12,12)
+      now = datetime.utcnow()
+      stock.addTrade(now-timedelta(minutes=1), 10, TradeType.BUY, 100)
+      stock.addTrade(now-timedelta(minutes=30), 50, TradeType.BUY, 1)
+      stock.addTrade(now-timedelta(minutes=5), 30, TradeType.SELL, 200)
+      stock.addTrade(now-timedelta(minutes=20), 50, TradeType.SELL, 1)
+
+      self.assertAlmostEqual(stock.getVolumeWeightedStockPrice(), (10*100 + 30*200)/40)
+
+      with self.assertRaises(ValueError):
+          Stock("ASX",StockType.Common,12,12).getVolumeWeightedStockPrice()
+
+#Check VWAPs as of past times, through the clock, as_of and the vectorised vwapAsOf
+
+  def test_vwap_as_of(self):
+      start = datetime(2020, 1, 1, 9)
+      stock = Stock("ASX",StockType.Common,12,12, clock=lambda: start + timedelta(minutes=10))
+      stock.addTrades([(start + timedelta(minutes=x), x + 1, TradeType.BUY, 10 * (x + 1)) for x in range(60)])
+
+      self.assertAlmostEqual(stock.getVolumeWeightedStockPrice(), sum((x + 1) * 10 * (x + 1) for x in range(60)) / sum(range(1, 61)))
+      self.assertAlmostEqual(stock.getVolumeWeightedStockPrice(timedelta(minutes=2), as_of=start + timedelta(minutes=10)),
+                             (10 * 100 + 11 * 110) / 21)
+
+      times = [start + timedelta(seconds=x) for x in range(0, 7200, 30)]
+      vwaps = stock.vwapAsOf(times, window=timedelta(minutes=5))
+      self.assertTrue(np.isnan(vwaps[-1]))
+      for as_of, vwap in zip(times, vwaps):
+          if np.isnan(vwap):
+              self.assertRaises(ValueError, stock.getVolumeWeightedStockPrice, timedelta(minutes=5), as_of)
+          else:
+              self.assertAlmostEqual(vwap, stock.getVolumeWeightedStockPrice(timedelta(minutes=5), as_of=as_of))
+
+#Check bulk trades are merged into timestamp order with trades already stored, and that bulk prices are checked like
+#single ones
+
+  def test_bulk_trades(self):
+      stock = Stock("ASX",StockType.Common,12,12)
+      now = datetime.utcnow()
+      stock.addTrade(now-timedelta(minutes=2), 1, TradeType.BUY, 10)
+      stock.addTrades([now, now-timedelta(minutes=3), now-timedelta(minutes=1)], [2, 3, 4],
+                      [TradeType.SELL, TradeType.BUY, TradeType.SELL], [20, 30, 40])
+      stock.addTrades([(now-timedelta(minutes=4), 5, TradeType.BUY, 50)])
+
+      self.assertEqual([x.share_quantity for x in stock.trades], [5, 3, 1, 4, 2])
+
+      with self.assertRaises(TypeError):
+          stock.addTrades([now, now], [1, 0], [TradeType.BUY, TradeType.BUY], [1, 1])
+      self.assertEqual(len(stock.trades), 5)
+      for price in (0, -5, float('nan'), float('inf')):
+          with self.assertRaises(ValueError):
+              stock.addTrades([now, now], [1, 1], [TradeType.BUY, TradeType.BUY], [10, price])
+      self.assertEqual(len(stock.trades), 5)
+
+#Check trades past the retention horizon are evicted in bulk and rolled up into per-interval bars
+
+  def test_retention(self):
+      stock = Stock("ASX",StockType.Common,12,12,retention=timedelta(minutes=15),rollup_interval=timedelta(minutes=5))
+      start = datetime(2020,1,1)
+      for x in range(60):
+          stock.addTrade(start+timedelta(minutes=x), x+1, TradeType.BUY, 100+x)
+
+      self.assertLessEqual(len(stock.trades), 18)
+      self.assertEqual(stock.trades[-1].share_quantity, 60)
+
+      bars = stock.rollups.bars
+      self.assertEqual(bars['volume'].sum() + sum(x.share_quantity for x in stock.trades), sum(range(1, 61)))
+      self.assertEqual((bars['open'][0], bars['close'][0], bars['high'][0], bars['count'][0]), (100, 104, 104, 5))
+
+#Check sliding windows of different lengths are updated together as trades arrive (late ones included), and rebuilt
+#when replaced, and that integer aggregates stay exact ints when the sums are recomputed
+
+  def test_windows(self):
+      stock = Stock("ASX",StockType.Common,12,12)
+      stock.windows.addWindow(timedelta(minutes=1))
+      stock.windows.addWindow(timedelta(minutes=5))
+      start = datetime(2020,1,1)
+      for x in range(10):
+          stock.addTrade(start+timedelta(seconds=30*x), 1+x, TradeType.BUY if x%2 else TradeType.SELL, 10*(x+1))
+
+      now = start+timedelta(seconds=270)
+      self.assertEqual(stock.windows.value(timedelta(minutes=1), 'count', now), 2)
+      self.assertEqual(stock.windows.value(timedelta(minutes=5), 'sell_volume', now), 1+3+5+7+9)
+      self.assertAlmostEqual(stock.windows.value(timedelta(minutes=1), 'vwap', now), (9*90+10*100)/19)
+      self.assertEqual(stock.windows.value(timedelta(minutes=5), 'low', now), 10)
+
+      self.assertEqual(stock.windows.value(timedelta(minutes=1), 'count', now+timedelta(minutes=2)), 0)
+
+      stock.trades = [Trade(now+timedelta(seconds=x), 1, TradeType.BUY, 10) for x in range(3)]
+      self.assertEqual(stock.windows.value(timedelta(minutes=1), 'count', now+timedelta(seconds=3)), 3)
+      stock.addTrade(now+timedelta(seconds=1), 1, TradeType.BUY, 30)
+      stock.addTrade(now+timedelta(milliseconds=500), 1, TradeType.BUY, 5)
+      self.assertEqual((stock.windows.value(timedelta(minutes=1), 'high', now+timedelta(seconds=3)),
+                        stock.windows.value(timedelta(minutes=1), 'low', now+timedelta(seconds=3))), (30, 5))
+      self.assertEqual(stock.windows.value(timedelta(minutes=1), 'high', now+timedelta(seconds=61.5)), 10)
+
+      window = SlidingWindow(10, 2)
+      window.RECOMPUTE_INTERVAL = 1
+      window.add(1, 2.5, (2 ** 60 + 1, 2.5))
+      window.add(20, 2.5, (2 ** 60 + 3, 2.5))
+      self.assertEqual(window.total(0), 2 ** 60 + 3)
+
+#Check bars are kept up to date as trades arrive, including late trades landing in closed bars and replaced trades
+
+  def test_bars(self):
+      stock = Stock("ASX",StockType.Common,12,12)
+      start = datetime(2020,1,1)
+      stock.addTrade(start, 1, TradeType.BUY, 10)
+      stock.bars.addResolution(timedelta(minutes=1))
+      stock.addTrade(start+timedelta(seconds=70), 2, TradeType.BUY, 30)
+      stock.addTrade(start+timedelta(seconds=30), 3, TradeType.SELL, 5)
+      stock.addTrade(start+timedelta(seconds=190), 4, TradeType.BUY, 20)
+
+      bars = stock.bars.range(timedelta(minutes=1))
+      self.assertEqual(len(bars), 3)
+      self.assertEqual((bars.open[0], bars.high[0], bars.low[0], bars.close[0], bars.volume[0]), (10, 10, 5, 5, 4))
+      self.assertEqual(len(stock.bars.range(timedelta(minutes=1), start+timedelta(minutes=1), start+timedelta(minutes=3))), 1)
+      self.assertAlmostEqual(stock.bars.volumeWeightedPrice(start, start+timedelta(minutes=2)), (10+60+15)/6)
+
+      stock.trades = [Trade(start+timedelta(seconds=x), 2, TradeType.BUY, 10) for x in range(3)]
+      self.assertEqual(stock.bars.range(timedelta(minutes=1)).volume.tolist(), [6])
+
+#Check invalid trade data is rejected before being stored, and Decimal prices accepted singly and in bulk
+
+  def test_trade_checks(self):
+      stock = Stock("ASX",StockType.Common,12,12)
+      with self.assertRaises(TypeError):
+          stock.addTrade("now", 5, TradeType.BUY, 10)
+      with self.assertRaises(TypeError):
+          stock.addTrade(datetime.utcnow(), 0, TradeType.BUY, 10)
+      with self.assertRaises(TypeError):
+          stock.addTrade(datetime.utcnow(), 5, 1, 10)
+      with self.assertRaises(TypeError):
+          stock.addTrade(datetime.utcnow(), 5, TradeType.BUY, True)
+      with self.assertRaises(ValueError):
+          stock.addTrade(datetime.utcnow(), 5, TradeType.BUY, Decimal("-1.5"))
+      self.assertEqual(len(stock.trades), 0)
+
+      stock.addTrade(datetime.utcnow(), 5, TradeType.BUY, Decimal("10.25"))
+      self.assertEqual(stock.trades[0].trade_price, 10.25)
+
+      now = datetime.utcnow()
+      with self.assertRaises(ValueError):
+          stock.addTrades([now], [5], [TradeType.BUY], [Decimal("-1.5")])
+      with self.assertRaises(TypeError):
+          stock.addTrades([now, now], [5, 5], [TradeType.BUY, TradeType.BUY], [Decimal("1.5"), True])
+      stock.addTrades([now, now], [5, 5], [TradeType.BUY, TradeType.BUY], [Decimal("1.5"), 2])
+      ex = Exchange({})
+      ex.addStock(stock)
+      ex.ingest([("ASX", now, 5, TradeType.SELL, Decimal("3.5"))])
+      self.assertEqual([x.trade_price for x in stock.trades][1:], [1.5, 2, 3.5])
+
+#Check range queries filter and aggregate over views of the stored columns
+
+  def test_query(self):
+      start = datetime(2020, 1, 1, 9)
+      stock = Stock("ASX",StockType.Common,12,12)
+      stock.addTrades([(start + timedelta(minutes=x), x + 1, TradeType.BUY if x % 2 else TradeType.SELL, 10 * (x + 1))
+                       for x in range(60)])
+
+      span = stock.query(start + timedelta(minutes=10), start + timedelta(minutes=20))
+      self.assertEqual(span.count(), 10)
+      self.assertFalse(span.prices.flags.writeable)
+      self.assertTrue(np.shares_memory(span.prices, stock._trade_store.prices))
+      self.assertAlmostEqual(span.vwap(), sum((x + 1) * 10 * (x + 1) for x in range(10, 20)) / sum(range(11, 21)))
+
+      buys = span.where(side=TradeType.BUY, min_price=150)
+      self.assertEqual(buys.quantities.tolist(), [16, 18, 20])
+      self.assertEqual((buys.minPrice(), buys.maxPrice()), (160, 200))
+      self.assertEqual([x.share_quantity for x in buys.trades()], [16, 18, 20])
+      self.assertIsNone(span.where(min_price=1000).vwap())
+
+      ex = Exchange()
+      ex.addStock(stock)
+      ex.addStock(Stock("BSX",StockType.Common,12,12))
+      summary = ex.query(start, start + timedelta(minutes=5)).where(side=TradeType.SELL).summary()
+      self.assertEqual(summary.count.tolist(), [3, 0])
+      self.assertTrue(np.isnan(summary.vwap[1]))
+
+#Check the slotted, trusted and key-ordered forms of trades behave as the validated ones
+
+  def test_trade_records(self):
+      now = datetime.utcnow()
+      with self.assertRaises(AttributeError):
+          Trade(now, 5, TradeType.BUY, 10).venue = "LSE"
+      trades = [Trade.trusted(now-timedelta(seconds=x), x + 1, TradeType.SELL, 1.5) for x in range(5)]
+      self.assertEqual(sorted(trades, key=TRADE_KEY), sorted(trades))
+
+      stock = Stock("ASX",StockType.Common,12,12)
+      stock.trades = trades
+      self.assertEqual([x.share_quantity for x in stock.trades], [5, 4, 3, 2, 1])
+      self.assertEqual(stock.trades[0].timestamp, now-timedelta(seconds=4))
+
+
+#--Class for Unit testing the Exchange---------------------------------------------------------------------
+class TestExchange(unittest.TestCase):
+
+#Check a multi-symbol batch reaches each stock, and that unknown symbols or invalid values reject the whole batch
+
+  def test_ingest(self):
+      ex = Exchange({})
+      ex.addStock(Stock("ASX",StockType.Common,12,12))
+      ex.addStock(Stock("BSX",StockType.Common,12,12))
+      now = datetime.utcnow()
+
+      ex.ingest([("ASX", now, 1, TradeType.BUY, 10), ("BSX", now, 2, TradeType.SELL, 20),
+                 ("ASX", now-timedelta(minutes=1), 3, TradeType.BUY, 30)])
+      self.assertEqual([x.share_quantity for x in ex.getStock("ASX").trades], [3, 1])
+      self.assertEqual([x.share_quantity for x in ex.getStock("BSX").trades], [2])
+
+      with self.assertRaises(ValueError):
+          ex.ingest(["ASX", "CSX"], [now, now], [1, 1], [TradeType.BUY, TradeType.BUY], [1, 1])
+      with self.assertRaises(ValueError):
+          ex.ingest(["ASX"], [now], [1], [TradeType.BUY.value + 256], [1])
+      for price in (0, -3, float('nan'), float('inf')):
+          with self.assertRaises(ValueError):
+              ex.ingest([("ASX", now, 1, TradeType.BUY, 10), ("BSX", now, 1, TradeType.BUY, price)])
+      self.assertEqual(len(ex.getStock("ASX").trades), 2)
+      self.assertEqual(ex.getStock("BSX").getVolumeWeightedStockPrice(), 20)
+
+
+#Check the snapshot matches the per-stock calculations, with NaN where they would raise
+
+  def test_snapshot(self):
+      ex = Exchange({})
+      ex.addStock(Stock("ASX",StockType.Common,8,12))
+      ex.addStock(Stock("BSX",StockType.Preferred,0,100,2))
+      ex.addStock(Stock("CSX",StockType.Common,0,12))
+      now = datetime.utcnow()
+      ex.getStock("ASX").addTrade(now, 10, TradeType.BUY, 20)
+      ex.getStock("BSX").addTrade(now, 10, TradeType.BUY, 50)
+
+      snap = ex.snapshot()
+      self.assertEqual(list(snap.symbol), ["ASX", "BSX", "CSX"])
+      self.assertAlmostEqual(snap.vwap[0], ex.getStock("ASX").getVolumeWeightedStockPrice())
+      self.assertAlmostEqual(snap.dividend_yield[1], ex.getStock("BSX").dividend_yield(50))
+      self.assertAlmostEqual(snap.pe_ratio[1], ex.getStock("BSX").PERatio(50))
+      self.assertTrue(np.isnan(snap.vwap[2]) and np.isnan(snap.pe_ratio[2]))
+
+      snap = ex.snapshot(market_prices=[4, 0], symbols=["ASX", "CSX"])
+      self.assertAlmostEqual(snap.pe_ratio[0], ex.getStock("ASX").PERatio(4))
+      self.assertTrue(np.isnan(snap.dividend_yield[1]))
+
+
+#Check the incrementally maintained index follows stocks being added, removed and repriced
+
+  def test_index(self):
+      ex = Exchange()
+      for symbol, par_value in (("ASX", 2), ("BSX", 8), ("CSX", 5)):
+          ex.addStock(Stock(symbol,StockType.Common,12,par_value))
+      ex.removeStock("CSX")
+      self.assertAlmostEqual(ex.GBCEAllShareIndex(), 4)
+
+      ex.getStock("ASX").par_value = 32
+      self.assertAlmostEqual(ex.GBCEAllShareIndex(), 16)
+
+      ex.index_basis = IndexBasis.LastPrice
+      self.assertEqual(ex.GBCEAllShareIndex(), 0)
+      ex.getStock("ASX").addTrade(datetime.utcnow(), 1, TradeType.BUY, 3)
+      ex.getStock("BSX").addTrade(datetime.utcnow(), 1, TradeType.BUY, 27)
+      self.assertAlmostEqual(ex.GBCEAllShareIndex(), 9)
+
+      now = [datetime(2020, 1, 1, 9)]
+      ex = Exchange(index_basis=IndexBasis.VWAP, clock=lambda: now[0])
+      for symbol in ("ASX", "BSX"):
+          ex.addStock(Stock(symbol,StockType.Common,12,10))
+      ex.getStock("ASX").addTrades([(now[0] - timedelta(minutes=10), 1, TradeType.BUY, 4),
+                                    (now[0], 1, TradeType.BUY, 16)])
+      ex.getStock("BSX").addTrade(now[0], 2, TradeType.BUY, 16)
+      self.assertAlmostEqual(ex.GBCEAllShareIndex(), (10 * 16) ** 0.5)
+      now[0] += timedelta(minutes=6)
+      self.assertAlmostEqual(ex.GBCEAllShareIndex(), 16)
+      now[0] += timedelta(minutes=10)
+      self.assertEqual(ex.GBCEAllShareIndex(), 0)
+
+#Check stock IDs stay dense and stable, and the registry arrays follow the stocks' attributes
+
+  def test_registry(self):
+      ex = Exchange()
+      for symbol in ("ASX", "BSX", "CSX"):
+          ex.addStock(Stock(symbol,StockType.Common,12,10))
+      ex.removeStock("BSX")
+      ex.getStock("CSX").last_dividend = 7
+      self.assertEqual([ex.stockId("ASX"), ex.stockId("CSX")], [0, 2])
+      self.assertEqual(ex.registry.ids.tolist(), [0, 2])
+      self.assertEqual(ex.registry.last_dividends[2], 7)
+      self.assertRaises(ValueError, ex.stockId, "BSX")
+
+      ex.addStock(Stock("BSX",StockType.Preferred,1,100,3))
+      self.assertIs(ex.getStockById(1), ex.getStock("BSX"))
+      self.assertEqual(ex.registry.idsOf(["CSX", "BSX", "ASX"]).tolist(), [2, 1, 0])
+      self.assertRaises(ValueError, ex.registry.idsOf, ["ASX", "ASXX"])
+
+      ex.ingest(np.array([1, 2]), [datetime.utcnow()] * 2, [1, 1], [TradeType.BUY] * 2, [5, 5])
+      self.assertEqual(len(ex.getStock("BSX").trades), 1)
+
+
+#Check a burst of trades is pushed to subscribers as a few coalesced updates, off the ingesting thread, by one
+#dispatcher thread shared by the exchange's and the stock's hubs
+
+  def test_subscriptions(self):
+      import threading
+      ex = Exchange(index_basis=IndexBasis.LastPrice)
+      ex.addStock(Stock("ASX",StockType.Common,12,12))
+      updates, threads = [], set()
+      def record(symbol, value):
+          updates.append((symbol, value))
+          threads.add(threading.current_thread())
+
+      ex.subscribe(Topic.LastPrice, record, "ASX", interval=0.05)
+      ex.subscribe(Topic.Index, record)
+      self.addCleanup(ex.close)
+      self.assertEqual(ex.subscriptions.interval, 0.05)
+      stock = Stock("BSX",StockType.Common,12,12)
+      stock.subscribe(Topic.LastPrice, record)
+      self.addCleanup(stock.close)
+
+      now = datetime.utcnow()
+      for x in range(10000):
+          ex.getStock("ASX").addTrade(now + timedelta(microseconds=x), 1, TradeType.BUY, x + 1)
+      stock.addTrade(now, 1, TradeType.BUY, 7)
+
+      deadline = time.monotonic() + 5
+      def indexed():
+          return [x[1] for x in updates if x[0] is None and abs(x[1] - 10000) < 1e-6]
+      while not (("ASX", 10000) in updates and ("BSX", 7) in updates and indexed()) and time.monotonic() < deadline:
+          time.sleep(0.01)
+      self.assertIn(("ASX", 10000), updates)
+      self.assertIn(("BSX", 7), updates)
+      self.assertTrue(indexed())
+      self.assertLess(len(updates), 200)
+      self.assertEqual(len(threads), 1)
+      self.assertNotIn(threading.current_thread(), threads)
+
+#Check a thread-safe exchange loses no trades with writers sharing symbols and readers querying alongside, and that
+#turning thread safety on again keeps the stocks' locks
+
+  def test_threads(self):
+      import threading
+      ex = Exchange(index_basis=IndexBasis.LastPrice, thread_safe=True)
+      for symbol in ("ASX", "BSX"):
+          ex.addStock(Stock(symbol,StockType.Common,12,5))
+      lock = ex.getStock("ASX").lock
+      ex.thread_safe = True
+      self.assertIs(ex.getStock("ASX").lock, lock)
+      now = datetime.utcnow()
+
+      def write(offset):
+          for x in range(500):
+              ex.getStock("ASX").addTrade(now - timedelta(microseconds=2 * x + offset), 1, TradeType.BUY, 10)
+          ex.ingest(["BSX"] * 500, [now] * 500, [1] * 500, [TradeType.SELL] * 500, [20] * 500)
+
+      def read():
+          for x in range(200):
+              ex.GBCEAllShareIndex()
+              ex.snapshot()
+
+      threads = [threading.Thread(target=write, args=(x,)) for x in range(2)] + \
+                [threading.Thread(target=read) for x in range(2)]
+      for thread in threads:
+          thread.start()
+      for thread in threads:
+          thread.join()
+
+      timestamps = ex.getStock("ASX")._trade_store.timestamps
+      self.assertEqual(len(timestamps), 1000)
+      self.assertTrue(np.all(np.diff(timestamps) >= 0))
+      self.assertEqual(len(ex.getStock("BSX").trades), 1000)
+      self.assertAlmostEqual(ex.GBCEAllShareIndex(), (10 * 20) ** 0.5)
+
+
+#Check a sharded exchange gives the same answers as a single-process one
+
+  def test_sharded(self):
+      ex, sharded = Exchange(index_basis=IndexBasis.LastPrice), ShardedExchange(2, index_basis=IndexBasis.LastPrice)
+      self.addCleanup(sharded.close)
+      for symbol, par_value in (("ASX", 2), ("BSX", 8), ("CSX", 5)):
+          for e in (ex, sharded):
+              e.addStock(Stock(symbol,StockType.Common,12,par_value))
+
+      now = datetime.utcnow()
+      rows = [(random.choice(["ASX", "BSX", "CSX"]), now - timedelta(seconds=x), x + 1, TradeType.BUY, x % 7 + 1)
+              for x in range(100)]
+      for e in (ex, sharded):
+          e.ingest(rows)
+          e.getStock("ASX").addTrade(now, 5, TradeType.SELL, 4)
+
+      self.assertAlmostEqual(sharded.GBCEAllShareIndex(), ex.GBCEAllShareIndex())
+      self.assertTrue(np.allclose(sharded.snapshot().vwap, ex.snapshot().vwap))
+      self.assertEqual(len(sharded.getStock("BSX").trades), len(ex.getStock("BSX").trades))
+      self.assertEqual([x.trade_price for x in sharded.getStock("CSX").trades],
+                       [x.trade_price for x in ex.getStock("CSX").trades])
+      self.assertRaises(ValueError, sharded.ingest, [("DSX", now, 1, TradeType.BUY, 1)])
+      self.assertRaises(TypeError, setattr, sharded.getStock("ASX"), "par_value", "8")
+
+
+#Check a replayed feed is applied in batches, with malformed messages, non-positive prices and unknown symbols
+#dropped, and that a failing ingest is counted rather than stalling the feed
+
+  def test_feed(self):
+      import asyncio, os, tempfile
+      ex = Exchange()
+      ex.addStock(Stock("ASX",StockType.Common,12,12))
+      now = datetime.utcnow()
+      messages = b"".join(encodeTrade("ASX", now - timedelta(seconds=x), x + 1, TradeType.BUY, 10) for x in range(25))
+      messages += b"ASX,garbage\nBSX,1,1,BUY,1\nASX,2020-01-01T00:00:00,1,SELL,2.5\nASX,1,99999999999999999999,BUY,1\n"
+      messages += b"ASX,1,1,BUY,0\nASX,1,1,SELL,-3\n"
+
+      with tempfile.NamedTemporaryFile(delete=False) as f:
+          f.write(messages)
+      self.addCleanup(os.remove, f.name)
+      stats = asyncio.run(TradeFeed(ex, batch_size=10, max_queued_batches=1).run(fileSource(f.name, chunk_size=64)))
+
+      self.assertEqual((stats['received'], stats['applied'], stats['rejected']), (31, 26, 5))
+      self.assertLessEqual(stats['max_queue_depth'], 1)
+      self.assertEqual(ex.getStock("ASX").trades[0].trade_price, 2.5)
+
+      columns, dropped = decodeTrades([b"ASX,1,1,BUY,2", b"ASX,2,1,BUY,0", b"ASX,3,1,SELL,-3", b"ASX,4,1,SELL,inf"])
+      self.assertEqual((columns[4].tolist(), dropped), ([2.0], 3))
+
+      def failing(*columns):
+          raise RuntimeError("ingest failed")
+      ex.ingest = failing
+      feed = TradeFeed(ex, batch_size=10, max_queued_batches=1)
+      stats = asyncio.run(asyncio.wait_for(feed.run(fileSource(f.name, chunk_size=64)), 5))
+      self.assertEqual((stats['applied'], stats['rejected'], stats['errors']), (0, 31, stats['batches']))
+      self.assertIsInstance(stats['last_error'], RuntimeError)
+
+
+#Check a journaled exchange is rebuilt on restore, with stock changes, replaced trades and removals replayed
+
+  def test_journal(self):
+      import shutil, tempfile
+      directory = tempfile.mkdtemp()
+      self.addCleanup(shutil.rmtree, directory)
+      now = datetime.utcnow()
+
+      ex, journal = Exchange(), Journal(directory, sync_every=1)
+      journal.attach(ex)
+      for symbol in ("ASX", "BSX", "CSX"):
+          ex.addStock(Stock(symbol,StockType.Common,12,12))
+      ex.getStock("ASX").addTrade(now, 5, TradeType.BUY, 10)
+      ex.ingest([("ASX", now - timedelta(minutes=1), 3, TradeType.SELL, 20), ("BSX", now, 1, TradeType.BUY, 7)])
+      ex.getStock("BSX").par_value = 40
+      ex.getStock("BSX").trades = [Trade(now - timedelta(seconds=x), 2, TradeType.SELL, 3) for x in range(3)]
+      ex.removeStock("CSX")
+      journal.close()
+
+      restored = Journal(directory).restore()
+      self.assertEqual(sorted(restored.stocks), ["ASX", "BSX"])
+      self.assertEqual([x.trade_price for x in restored.getStock("ASX").trades], [20, 10])
+      self.assertEqual(restored.getStock("BSX").par_value, 40)
+      self.assertEqual([x.share_quantity for x in restored.getStock("BSX").trades], [2, 2, 2])
+
+
+#Check a saved exchange loads back (memory-mapped) with the same trades and rollups, and keeps taking trades after
+#loading
+
+  def test_archive(self):
+      import shutil, tempfile
+      directory = tempfile.mkdtemp()
+      self.addCleanup(shutil.rmtree, directory)
+      now = datetime.utcnow()
+
+      ex = Exchange(index_basis=IndexBasis.VWAP)
+      ex.addStock(Stock("ASX",StockType.Common,12,12))
+      ex.addStock(Stock("BSX",StockType.Preferred,8,100,2))
+      ex.ingest([("ASX", now - timedelta(seconds=x), x + 1, TradeType.BUY, x % 9 + 1) for x in range(50)])
+      ex.addStock(Stock("CSX",StockType.Common,12,12,retention=timedelta(minutes=15),rollup_interval=timedelta(minutes=5)))
+      for x in range(60):
+          ex.getStock("CSX").addTrade(datetime(2020,1,1)+timedelta(minutes=x), x+1, TradeType.BUY, 100+x)
+      saveExchange(ex, directory)
+
+      loaded = loadExchange(directory)
+      self.assertEqual(loaded.index_basis, IndexBasis.VWAP)
+      self.assertEqual(loaded.getStock("BSX").fixed_dividend, 2)
+      self.assertEqual(loaded.getStock("CSX").retention, timedelta(minutes=15))
+      self.assertGreater(len(ex.getStock("CSX").rollups), 0)
+      self.assertEqual(loaded.getStock("CSX").rollups.bars.tolist(), ex.getStock("CSX").rollups.bars.tolist())
+      self.assertAlmostEqual(loaded.GBCEAllShareIndex(), ex.GBCEAllShareIndex())
+      self.assertEqual([x.share_quantity for x in loaded.getStock("ASX").trades],
+                       [x.share_quantity for x in ex.getStock("ASX").trades])
+
+      loaded.getStock("ASX").addTrade(now, 1, TradeType.SELL, 1)
+      self.assertEqual(len(loaded.getStock("ASX").trades), 51)
+      self.assertEqual(len(loadTrades(directory)[1]['prices']), 50 + len(ex.getStock("CSX").trades))
+
+
+#Check evicted trades are sealed into segments and history queries span both tiers, also after a restart
+
+  def test_segments(self):
+      import os, shutil, tempfile
+      directory = tempfile.mkdtemp()
+      self.addCleanup(shutil.rmtree, directory)
+      start = datetime(2020, 1, 1, 9)
+
+      ex = Exchange(retention=timedelta(minutes=10), cold_directory=directory)
+      ex.addStock(Stock("ASX",StockType.Common,12,12))
+      stock = ex.getStock("ASX")
+      for x in range(120):
+          stock.addTrade(start + timedelta(minutes=x), x + 1, TradeType.BUY, x % 7 + 1)
+
+      cold = stock.cold_store
+      self.assertEqual(cold.directory, os.path.join(directory, "ASX"))
+      summary = stock.historySummary(start + timedelta(minutes=5), start + timedelta(minutes=115))
+      self.assertEqual((summary['count'], summary['volume']), (110, sum(range(6, 116))))
+      self.assertAlmostEqual(summary['vwap'], sum((x + 1) * (x % 7 + 1) for x in range(5, 115)) / sum(range(6, 116)))
+      cold.flush()
+      self.assertEqual(len(cold) + len(stock.trades), 120)
+      history = stock.queryHistory(start + timedelta(minutes=5), start + timedelta(minutes=115))
+      self.assertEqual(history.quantities.tolist(), list(range(6, 116)))
+
+      stock.addTrade(start - timedelta(seconds=1), 1000, TradeType.SELL, 9)
+      stock.evictTrades(start + timedelta(minutes=200))
+      cold.flush()
+      restarted = Stock("ASX",StockType.Common,12,12)
+      restarted.cold_store = SegmentStore(cold.directory)
+      history = restarted.queryHistory(end=start + timedelta(minutes=3))
+      self.assertEqual(history.quantities.tolist(), [1000, 1, 2, 3])
+      self.assertEqual(restarted.historySummary()['count'], 121)
+
+      store = SegmentStore(os.path.join(directory, "BSX"), segment_trades=10)
+      for x in range(0, 100, 5):
+          store.add(np.arange(x, x + 5), np.arange(x, x + 5) + 1, np.ones(5, dtype=np.int8), np.full(5, 2.0))
+      store.flush()
+      self.assertEqual([x['count'] for x in store.segments], [10] * 10)
+      self.assertEqual(store.summary(15, 85)['volume'], sum(range(16, 86)))
+
+#Check metrics are only recorded while enabled, and that exported counters, gauges and histograms follow the trades
+
+  def test_metrics(self):
+      ex = Exchange(index_basis=IndexBasis.LastPrice)
+      ex.addStock(Stock("ASX",StockType.Common,12,12))
+      now = datetime.utcnow()
+      METRICS.reset()
+      ex.getStock("ASX").addTrade(now, 5, TradeType.BUY, 10)
+      self.assertEqual(METRICS.collect()['counters']['stock.trades_added'], 0)
+
+      snapshots = []
+      METRICS.enabled = True
+      METRICS.watchExchange(ex)
+      METRICS.addExporter(snapshots.append)
+      try:
+          ex.getStock("ASX").addTrade(now, 5, TradeType.BUY, 10)
+          ex.ingest([("ASX", now, 1, TradeType.SELL, 12)] * 3)
+          ex.getStock("ASX").getVolumeWeightedStockPrice()
+          ex.GBCEAllShareIndex()
+          METRICS.export()
+      finally:
+          METRICS.enabled = False
+          METRICS.removeExporter(snapshots.append)
+          METRICS.unwatchExchange()
+
+      snapshot = snapshots[0]
+      self.assertEqual(snapshot['counters']['stock.trades_added'], 4)
+      self.assertEqual(snapshot['counters']['exchange.trades_ingested'], 3)
+      self.assertEqual(snapshot['gauges']['exchange.symbol_trades'], {"ASX": 5})
+      self.assertEqual(snapshot['histograms']['stock.vwap_window_trades']['max'], 5)
+      self.assertEqual(snapshot['histograms']['exchange.gbce_index_ns']['count'], 1)
+
+
 #==Run above Unit tests for Stocks=====
-suite = unittest.TestLoader().loadTestsFromTestCase(TestStocks)
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(x) for x in (TestStocks, TestTrades, TestExchange)])
 unittest.TextTestRunner(verbosity=2).run(suite)
 #--------------------------------------------------------------------------------------------------------
 
@@ -0,0 +1,183 @@
+__author__ = 'sachi'
+
+
+'''The functions below save an Exchange, or a single Stock, to a directory of NumPy .npy files and load it back.
+Trades are stored column-wise, exactly as held in memory: one file per column with all stocks' trades end to end
+(each stock's trades sorted by timestamp), together with the stocks' running sums, rollup bars and an archive.json
+index giving each stock's definition and where its rows start.
+
+Loading memory-maps the columns by default, in NumPy's copy-on-write mode: a loaded stock adopts its slices of the
+mapped files directly (see TradeStore.fromColumns), so a warm start costs next to nothing up front and a query only
+reads the pages it touches. The same files can be read without building any stocks at all (loadTrades), which is
+how datasets are handed to research: no parsing, just np.load'''
+
+import json
+import os
+
+from contextlib import ExitStack
+
+import numpy as np
+
+from SuperSimpleStocks.Bars import BAR_DTYPE
+from SuperSimpleStocks.Exchange import Exchange, IndexBasis
+from SuperSimpleStocks.Stock import Stock, StockType
+from SuperSimpleStocks.TradeStore import TradeStore, toSeconds, fromSeconds
+
+#--------------------------------------------------------------------------------------------------------
+
+ARCHIVE_FILE = 'archive.json'
+ARCHIVE_FORMAT = 1
+
+#Column files: name -> dtype. Running sums hold one more row per stock than the trade columns
+TRADE_FILES = (('timestamps', np.int64), ('quantities', np.int64), ('sides', np.int8), ('prices', np.float64))
+SUM_FILES = (('cum_quantities', np.int64), ('cum_notionals', np.float64))
+ROLLUPS_FILE = 'rollups'
+
+def _createArray(directory, name, dtype, count):
+
+    #An .npy file to be filled in place. Empty arrays cannot be memory-mapped, so those are written directly
+
+    path = os.path.join(directory, name + '.npy')
+    if count == 0:
+        np.save(path, np.zeros(0, dtype=dtype))
+        return np.zeros(0, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(count,))
+
+def _loadArray(directory, name, mmap_mode):
+    path = os.path.join(directory, name + '.npy')
+    try:
+        return np.load(path, mmap_mode=mmap_mode)
+    except ValueError:
+        return np.load(path)
+
+def _readIndex(directory):
+
+    with open(os.path.join(directory, ARCHIVE_FILE)) as f:
+        index = json.load(f)
+    if index.get('format') != ARCHIVE_FORMAT:
+        raise ValueError("Invalid archive : Unsupported format "+ str(index.get('format'))+" in "+ str(directory))
+    return index
+
+#--------------------------------------------------------------------------------------------------------
+
+def saveExchange(exchange, directory):
+
+    '''Save the exchange's settings, stocks, trades and rollups under `directory` (created if needed, files
+    already there are overwritten). Each stock is locked while the archive is written, so a thread-safe exchange
+    is saved in a consistent state'''
+
+    _save(exchange._stockList(), directory, {'index_basis': exchange.index_basis.name,
+                                             'retention': toSeconds(exchange.retention),
+                                             'rollup_interval': toSeconds(exchange.rollup_interval)})
+
+def saveStock(stock, directory):
+    _save([stock], directory, None)
+
+def _save(stocks, directory, exchange):
+
+    os.makedirs(directory, exist_ok=True)
+
+    with ExitStack() as locks:
+        for stock in sorted(stocks, key=lambda x: x.symbol):
+            locks.enter_context(stock.lock)
+
+        entries, trade_count, bar_count = [], 0, 0
+        for stock in stocks:
+            count = len(stock._trade_store)
+            bars = 0 if stock.rollups is None else len(stock.rollups)
+            entries.append({'symbol': stock.symbol, 'stock_type': stock.stock_type.name,
+                            'last_dividend': stock.last_dividend, 'par_value': stock.par_value,
+                            'fixed_dividend': stock.fixed_dividend, 'retention': toSeconds(stock.retention),
+                            'rollup_interval': toSeconds(stock.rollup_interval),
+                            'trades': [trade_count, count], 'rollups': [bar_count, bars]})
+            trade_count += count
+            bar_count += bars
+
+        columns = dict((name, _createArray(directory, name, dtype, trade_count)) for name, dtype in TRADE_FILES)
+        sums = dict((name, _createArray(directory, name, dtype, trade_count + len(stocks))) for name, dtype in SUM_FILES)
+        rollups = _createArray(directory, ROLLUPS_FILE, BAR_DTYPE, bar_count)
+
+        for i, (stock, entry) in enumerate(zip(stocks, entries)):
+            store = stock._trade_store
+            start, count = entry['trades']
+            for name, dtype in TRADE_FILES:
+                columns[name][start:start + count] = getattr(store, name)
+
+            #Running sums are stored rebased to zero at the stock's first live trade
+            head, size = store._head, store._size
+            for name, dtype in SUM_FILES:
+                stored = getattr(store, '_' + name)
+                sums[name][start + i:start + i + count + 1] = stored[head:size + 1] - stored[head]
+
+            start, count = entry['rollups']
+            if count:
+                rollups[start:start + count] = stock.rollups.bars
+
+        for array in list(columns.values()) + list(sums.values()) + [rollups]:
+            if isinstance(array, np.memmap):
+                array.flush()
+        del columns, sums, rollups
+
+    with open(os.path.join(directory, ARCHIVE_FILE), 'w') as f:
+        json.dump({'format': ARCHIVE_FORMAT, 'exchange': exchange, 'stocks': entries}, f, indent=1)
+
+#--------------------------------------------------------------------------------------------------------
+
+def loadTrades(directory, mmap=True):
+
+    '''The archive's index (definitions and row ranges, as stored in archive.json) and its trade columns as a dict
+    of arrays, read-only memory-mapped unless mmap is False. Stock `s` owns rows
+    [s['trades'][0], s['trades'][0] + s['trades'][1]) of every column'''
+
+    columns = dict((name, _loadArray(directory, name, 'r' if mmap else None)) for name, dtype in TRADE_FILES)
+    return _readIndex(directory), columns
+
+def loadExchange(directory, mmap=True, exchange=None):
+
+    '''Rebuild a saved exchange: into `exchange` if given (its own settings are kept), otherwise into a new
+    Exchange with the saved settings. With mmap, trades stay on disk until used and each stock's columns are only
+    copied into memory once it takes new trades'''
+
+    index, stocks = _load(directory, mmap)
+    if exchange is None:
+        settings = index['exchange'] or {}
+        exchange = Exchange(index_basis=IndexBasis[settings.get('index_basis', IndexBasis.ParValue.name)],
+                            retention=fromSeconds(settings.get('retention')),
+                            rollup_interval=fromSeconds(settings.get('rollup_interval')))
+    for stock in stocks:
+        exchange.addStock(stock)
+    return exchange
+
+def loadStock(directory, mmap=True):
+
+    '''The stock saved by saveStock (or the first one of a saved exchange)'''
+
+    index, stocks = _load(directory, mmap)
+    if not stocks:
+        raise ValueError("Invalid archive, no stocks found in "+ str(directory))
+    return stocks[0]
+
+def _load(directory, mmap):
+
+    index = _readIndex(directory)
+    arrays = dict((name, _loadArray(directory, name, 'c' if mmap else None))
+                  for name, dtype in TRADE_FILES + SUM_FILES + ((ROLLUPS_FILE, BAR_DTYPE),))
+
+    stocks = []
+    for i, entry in enumerate(index['stocks']):
+        stock = Stock(entry['symbol'], StockType[entry['stock_type']], entry['last_dividend'], entry['par_value'],
+                      entry['fixed_dividend'], fromSeconds(entry['retention']), fromSeconds(entry['rollup_interval']))
+
+        start, count = entry['trades']
+        columns = [arrays[name][start:start + count] for name, dtype in TRADE_FILES]
+        sums = [arrays[name][start + i:start + i + count + 1] for name, dtype in SUM_FILES]
+        stock._trade_store = TradeStore.fromColumns(columns[0], columns[1], columns[2], columns[3], *sums)
+        stock._scheduleEviction()
+
+        start, count = entry['rollups']
+        if count and stock.rollups is not None:
+            stock.rollups.addBars(arrays[ROLLUPS_FILE][start:start + count])
+
+        stocks.append(stock)
+
+    return index, stocks
@@ -0,0 +1,327 @@
+__author__ = 'sachi'
+
+
+'''The bar series below holds per-interval trade aggregates (open/high/low/close, volume, notional and trade count)
+for one stock at one resolution, as a growable NumPy record array ordered by interval start. It is used to keep a
+compact summary of trades once they are evicted from a stock's trade store (see Stock.retention), so that long
+running processes hold a bounded number of raw trades but can still report on the past, and by the bar builder
+(Stock.bars) which keeps bars at any number of resolutions up to date as trades arrive.
+Trades are folded in one at a time or as sorted batches; they may land in bars already held (e.g. late trades), in
+which case the bars are combined rather than duplicated'''
+
+from datetime import timedelta
+
+import numpy as np
+
+from SuperSimpleStocks.TradeStore import toEpochNanos
+
+#--------------------------------------------------------------------------------------------------------
+
+#Each bar records the timestamps of its first and last trade (epoch nanoseconds), so that open and close stay correct
+#whatever order trades are folded in
+
+BAR_DTYPE = np.dtype([('start', np.int64), ('first', np.int64), ('last', np.int64),
+                      ('open', np.float64), ('high', np.float64), ('low', np.float64), ('close', np.float64),
+                      ('volume', np.int64), ('notional', np.float64), ('count', np.int64)])
+
+#--------------------------------------------------------------------------------------------------------
+
+class BarSeries(object):
+
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, resolution):
+
+        #Resolution (bar length) in nanoseconds
+
+        if type(resolution) is not int:
+            raise TypeError("Invalid type for bar resolution : Requiring integer nanoseconds (got "+ \
+                            str(type(resolution))+")")
+        elif resolution <= 0:
+            raise ValueError("Invalid bar resolution : Requiring positive nanoseconds (got "+ str(resolution)+")")
+
+        self._resolution = resolution
+        self._bars = np.zeros(self.INITIAL_CAPACITY, dtype=BAR_DTYPE)
+        self._size = 0
+
+#--------------------------------------------------------------------------------------------------------
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @property
+    def bars(self):
+        return self._bars[:self._size]
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        return self._bars.nbytes
+
+    def _reserve(self, count):
+
+        if self._size + count > len(self._bars):
+            bars = np.zeros(max(2 * (self._size + count), self.INITIAL_CAPACITY), dtype=BAR_DTYPE)
+            bars[:self._size] = self._bars[:self._size]
+            self._bars = bars
+
+#--------------------------------------------------------------------------------------------------------
+
+    def addTrade(self, timestamp, quantity, price):
+
+        '''Fold in one trade (timestamp in epoch nanoseconds). A trade in the latest bar updates it in place and a
+        trade past it opens a new bar, both O(1); an older trade is merged into (or inserted as) its own bar'''
+
+        start = timestamp - timestamp % self._resolution
+        size = self._size
+
+        if size and self._bars[size - 1]['start'] == start:
+            bar = self._bars[size - 1]
+            if timestamp >= bar['last']:
+                bar['last'] = timestamp
+                bar['close'] = price
+            elif timestamp < bar['first']:
+                bar['first'] = timestamp
+                bar['open'] = price
+            if price > bar['high']:
+                bar['high'] = price
+            if price < bar['low']:
+                bar['low'] = price
+            bar['volume'] += quantity
+            bar['notional'] += price * quantity
+            bar['count'] += 1
+
+        elif size == 0 or start > self._bars[size - 1]['start']:
+            self._reserve(1)
+            self._bars[size] = (start, timestamp, timestamp, price, price, price, price, quantity, price * quantity, 1)
+            self._size = size + 1
+
+        else:
+            self._mergeBars(np.array([(start, timestamp, timestamp, price, price, price, price, quantity,
+                                       price * quantity, 1)], dtype=BAR_DTYPE))
+
+    def addTrades(self, timestamps, quantities, prices):
+
+        '''Fold a batch of trades, as arrays sorted by timestamp (epoch nanoseconds), into the series'''
+
+        count = len(timestamps)
+        if count == 0:
+            return
+
+        #One new bar per run of trades in the same interval
+        starts = timestamps - timestamps % self._resolution
+        firsts = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+        lasts = np.concatenate((firsts[1:] - 1, [count - 1]))
+
+        new = np.zeros(len(firsts), dtype=BAR_DTYPE)
+        new['start'] = starts[firsts]
+        new['first'] = timestamps[firsts]
+        new['last'] = timestamps[lasts]
+        new['open'] = prices[firsts]
+        new['close'] = prices[lasts]
+        new['high'] = np.maximum.reduceat(prices, firsts)
+        new['low'] = np.minimum.reduceat(prices, firsts)
+        new['volume'] = np.add.reduceat(quantities, firsts)
+        new['notional'] = np.add.reduceat(prices * quantities, firsts)
+        new['count'] = lasts - firsts + 1
+
+        self._mergeBars(new)
+
+    def addBars(self, bars):
+
+        '''Fold in bars already built at this resolution (e.g. saved by Archive), as a BAR_DTYPE array sorted by
+        start with one bar per interval. Bars for intervals already held are combined with them'''
+
+        bars = np.asarray(bars)
+        if bars.dtype != BAR_DTYPE:
+            raise TypeError("Invalid type for bars : Requiring BAR_DTYPE records (got "+ str(bars.dtype)+")")
+        elif len(bars) and np.any(bars['start'] % self._resolution != 0):
+            raise ValueError("Invalid bars : Requiring starts aligned to the resolution "+ str(self._resolution))
+        elif len(bars):
+            self._mergeBars(bars.copy())
+
+    def _mergeBars(self, new):
+
+        #Combine bars (sorted, one per interval) into the series: bars for intervals already held are folded into
+        #the existing entries, the rest are inserted at their sorted positions
+
+        bars = self._bars[:self._size]
+        positions = np.searchsorted(bars['start'], new['start'])
+        held = positions < self._size
+        held[held] = bars['start'][positions[held]] == new['start'][held]
+
+        if np.any(held):
+            index = positions[held]
+            old, add = bars[index], new[held]
+
+            earlier = add['first'] < old['first']
+            old['open'] = np.where(earlier, add['open'], old['open'])
+            old['first'] = np.where(earlier, add['first'], old['first'])
+            later = add['last'] >= old['last']
+            old['close'] = np.where(later, add['close'], old['close'])
+            old['last'] = np.where(later, add['last'], old['last'])
+            old['high'] = np.maximum(old['high'], add['high'])
+            old['low'] = np.minimum(old['low'], add['low'])
+            for field in ('volume', 'notional', 'count'):
+                old[field] += add[field]
+
+            bars[index] = old
+            new, positions = new[~held], positions[~held]
+
+        count = len(new)
+        if count == 0:
+            return
+
+        self._reserve(count)
+        size = self._size
+
+        if size == 0 or positions[0] == size:
+            self._bars[size:size + count] = new
+        else:
+            first = int(positions[0])
+            is_new = np.zeros(size - first + count, dtype=bool)
+            is_new[positions - first + np.arange(count)] = True
+            merged = np.empty(len(is_new), dtype=BAR_DTYPE)
+            merged[is_new] = new
+            merged[~is_new] = self._bars[first:size]
+            self._bars[first:size + count] = merged
+
+        self._size = size + count
+
+#--------------------------------------------------------------------------------------------------------
+
+    def range(self, start=None, end=None):
+
+        '''Copy of the bars starting in [start, end) (epoch nanoseconds, open-ended when None), as a record array'''
+
+        bars = self._bars[:self._size]
+        first = 0 if start is None else int(np.searchsorted(bars['start'], start, side='left'))
+        stop = self._size if end is None else int(np.searchsorted(bars['start'], end, side='left'))
+        return bars[first:max(first, stop)].copy().view(np.recarray)
+
+    def volumeWeightedPrice(self, start=None, end=None):
+
+        #VWAP over the bars starting in [start, end), None when nothing traded. Accurate to the bar resolution
+
+        bars = self.range(start, end)
+        volume = int(bars['volume'].sum())
+        return float(bars['notional'].sum()) / volume if volume > 0 else None
+
+#--------------------------------------------------------------------------------------------------------
+
+class BarBuilder(object):
+
+    '''Bar series at any number of resolutions for one stock, kept up to date as trades are added. Like the
+    window engine, it only listens to the stock's trades once a resolution is registered, and a new resolution is
+    built in one vectorised pass over the trades currently held in the stock's trade store'''
+
+    def __init__(self, stock):
+        self._stock = stock
+        self._series = {}
+        self._listening = False
+
+    @staticmethod
+    def _resolution(resolution):
+
+        if type(resolution) is not timedelta:
+            raise TypeError("Invalid type for bar resolution : Requiring timedelta (got "+ str(type(resolution))+")")
+        elif resolution <= timedelta(0):
+            raise ValueError("Invalid bar resolution : Requiring positive timedelta (got "+ str(resolution)+")")
+        else:
+            return resolution // timedelta(microseconds=1) * 1000
+
+    @property
+    def resolutions(self):
+        return sorted(timedelta(microseconds=x // 1000) for x in self._series)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def addResolution(self, resolution):
+
+        with self._stock.lock:
+            nanos = self._resolution(resolution)
+            if nanos not in self._series:
+                self._series[nanos] = self._build(nanos)
+
+            if not self._listening:
+                self._stock.addTradeListener(self._tradesAdded)
+                self._stock.addResetListener(self._tradesReset)
+                self._listening = True
+
+    def removeResolution(self, resolution):
+
+        with self._stock.lock:
+            self._series.pop(self._resolution(resolution), None)
+            if not self._series and self._listening:
+                self._stock.removeTradeListener(self._tradesAdded)
+                self._stock.removeResetListener(self._tradesReset)
+                self._listening = False
+
+    def series(self, resolution):
+
+        nanos = self._resolution(resolution)
+        if nanos in self._series:
+            return self._series[nanos]
+        else:
+            raise ValueError("Invalid bar resolution, no bars kept at "+ str(resolution))
+
+    def _build(self, nanos):
+
+        #A series at `nanos` built from the trades currently held in the stock's store
+
+        series = BarSeries(nanos)
+        store = self._stock._trade_store
+        series.addTrades(store.timestamps, store.quantities, store.prices)
+        return series
+
+    def _tradesReset(self, stock):
+
+        #Reset listener: the stock's trades were replaced, so every series is rebuilt from the new trades
+
+        for nanos in self._series:
+            self._series[nanos] = self._build(nanos)
+
+    def _tradesAdded(self, stock, timestamps, share_quantities, sides, trade_prices):
+
+        if len(timestamps) == 1:
+            for series in self._series.values():
+                series.addTrade(timestamps[0], share_quantities[0], trade_prices[0])
+        else:
+            for series in self._series.values():
+                series.addTrades(timestamps, share_quantities, trade_prices)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def range(self, resolution, start=None, end=None):
+
+        '''Bars at `resolution` starting in [start, end) (datetimes, open-ended when None), as a record array with
+        fields start/first/last (epoch ns), open/high/low/close, volume, notional and count'''
+
+        with self._stock.lock:
+            return self.series(resolution).range(None if start is None else toEpochNanos(start),
+                                                 None if end is None else toEpochNanos(end))
+
+    def volumeWeightedPrice(self, start=None, end=None, resolution=None):
+
+        '''Coarse VWAP from bars alone, no raw trades touched: over the bars starting in [start, end), at the given
+        resolution or by default the coarsest one whose bar boundaries line up with both ends of the range'''
+
+        with self._stock.lock:
+            if resolution is None:
+                if not self._series:
+                    raise ValueError("Unable to calculate bar VWAP, no bar resolutions registered")
+                bounds = [toEpochNanos(x) for x in (start, end) if x is not None]
+                aligned = [x for x in self._series if all(b % x == 0 for b in bounds)]
+                series = self._series[max(aligned) if aligned else min(self._series)]
+            else:
+                series = self.series(resolution)
+
+            vwap = series.volumeWeightedPrice(None if start is None else toEpochNanos(start),
+                                              None if end is None else toEpochNanos(end))
+            if vwap is not None:
+                return vwap
+            else:
+                raise ValueError("Unable to calculate Volume Weighted Stock Price, non-zero quantity required")
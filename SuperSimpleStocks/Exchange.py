@@ -1,16 +1,111 @@
 __author__ = 'sachi'
 
 
-'''The Exchange object holds stocks as a dictionary, encapsulating attributes by property decorators'''
+'''The Exchange object holds stocks as a dictionary, encapsulating attributes by property decorators.
+It also maintains the GBCE All Share Index incrementally, as a running sum of the logarithms of each stock's index
+term, so that adding/removing a stock or a change in one stock's price is an O(1) update and reading the index is O(1).
 
-from SuperSimpleStocks.Stock import Stock
+In thread-safe mode the exchange guards its registry and index state with its own lock and puts every stock in
+thread-safe mode, so producers for different symbols only contend briefly on the index. To rule out deadlock,
+locks are only ever taken stock first, then exchange: the exchange never waits on a stock while holding its lock'''
+
+import heapq
+import math
+import os
+import threading
+import numpy as np
+
+from datetime import datetime, timedelta
+from enum import Enum, unique
+from time import perf_counter_ns
+from SuperSimpleStocks.Metrics import METRICS
+from SuperSimpleStocks.Registry import StockRegistry
+from SuperSimpleStocks.Subscriptions import Subscriptions
+from SuperSimpleStocks.Query import ExchangeRange
+from SuperSimpleStocks.Segments import SegmentStore
+from SuperSimpleStocks.Stock import Stock, StockType, NO_LOCK
+from SuperSimpleStocks.TradeStore import tradeColumns, toEpochNanos
+
+#--------------------------------------------------------------------------------------------------------
+
+#Record layout returned by Exchange.snapshot, NaN marks values that are not available for a stock
+
+SNAPSHOT_DTYPE = np.dtype([('symbol', 'U3'), ('vwap', np.float64), ('market_price', np.float64),
+                           ('dividend_yield', np.float64), ('pe_ratio', np.float64)])
+
+#Instruments for the hot paths (see Metrics), only updated while METRICS.enabled is set
+
+_INGEST_NS = METRICS.histogram('exchange.ingest_ns')
+_INDEX_NS = METRICS.histogram('exchange.gbce_index_ns')
+_TRADES_INGESTED = METRICS.counter('exchange.trades_ingested')
+_INDEX_UPDATES = METRICS.counter('exchange.index_updates')
+_INDEX_RECOMPUTES = METRICS.counter('exchange.index_recomputes')
+
+#--------------------------------------------------------------------------------------------------------
+
+#What each stock contributes to the GBCE All Share Index: its par value, its volume weighted price over the last
+#15 minutes, or its last trade price. The trade-driven bases are refreshed whenever the stock trades, and VWAP terms
+#also when the index is read, for stocks whose trades have since dropped out of the window (a stock with no trades
+#in the last 15 minutes has no term)
+
+@unique
+class IndexBasis(Enum):
+    ParValue = 1
+    VWAP = 2
+    LastPrice = 3
+
+#Window of the VWAP basis
+INDEX_VWAP_WINDOW = timedelta(minutes=15)
+_VWAP_WINDOW_NS = INDEX_VWAP_WINDOW // timedelta(microseconds=1) * 1000
+
+def combineIndexPartials(partials):
+
+    #GBCE All Share Index over the union of exchanges' stocks, from their (log_sum, term_count, zero_terms) partials
+
+    log_sum = math.fsum(x[0] for x in partials)
+    term_count = sum(x[1] for x in partials)
+
+    if term_count == 0:
+        return 0
+    elif sum(x[2] for x in partials) > 0:
+        return 0.0
+    else:
+        return math.exp(log_sum / term_count)
 
 #--------------------------------------------------------------------------------------------------------
 
 class Exchange(object):
 
-    def __init__(self, stocks={}):
-        self.stocks = stocks
+    #Number of incremental index updates after which the log-sum is recomputed from scratch, to stop
+    #floating point drift from accumulating
+    INDEX_RECOMPUTE_INTERVAL = 10000
+
+    #Most stocks listed by __repr__
+    REPR_STOCKS = 20
+
+    #Shortest time in seconds between two rounds of subscription updates
+    SUBSCRIPTION_INTERVAL = 0.1
+
+    def __init__(self, stocks=None, index_basis=IndexBasis.ParValue, retention=None, rollup_interval=None,
+                 thread_safe=False, clock=None, cold_directory=None):
+        self._stocks = {}
+        self._registry = StockRegistry()
+        self._registry.addColumn('index_term', np.float64, np.nan)
+        self._stock_listeners = []
+        self._subscriptions = None
+        self._expiries = []
+        self._expiry_of = {}
+        self._lock = NO_LOCK
+        self.thread_safe = thread_safe
+        self._retention = None
+        self._rollup_interval = None
+        self._cold_directory = None
+        self.clock = clock
+        self.index_basis = index_basis
+        self.stocks = {} if stocks is None else stocks
+        self.retention = retention
+        self.rollup_interval = rollup_interval
+        self.cold_directory = cold_directory
 #--------------------------------------------------------------------------------------------------------
 
     #Property decorators to ensure encapsulation/hiding/etc. for class attributes
@@ -24,50 +119,560 @@ class Exchange(object):
     def stocks(self, stocks):
 
         if type(stocks) is dict:
-            self._stocks = stocks
+            with self._lock:
+                replaced, self._stocks = self._stocks, stocks
+                for stock in replaced.values():
+                    self._registry.unregister(stock)
+                for stock in stocks.values():
+                    self._registry.register(stock)
+            for stock in replaced.values():
+                self._unwatch(stock)
+                self._notifyStock(stock, False)
+            for stock in list(stocks.values()):
+                self._adopt(stock)
+                self._watch(stock)
+                self._notifyStock(stock, True)
+            self.recomputeIndex()
         else:
             raise TypeError("Incorrectly Formatted StockList : Requiring StockDictionary object \
             (got "+ str(type(stocks))+")")
 
+#--------------------------------------------------------------------------------------------------------
+
+    @property
+    def thread_safe(self):
+        return self._lock is not NO_LOCK
+
+    @thread_safe.setter
+    def thread_safe(self, thread_safe):
+
+        if type(thread_safe) is not bool:
+            raise TypeError("Invalid type for thread safety : Requiring bool (got "+ str(type(thread_safe))+")")
+
+        #Like Stock.thread_safe, the lock is swapped under the current one and only when the setting changes
+        with self._lock:
+            if thread_safe != self.thread_safe:
+                self._lock = threading.RLock() if thread_safe else NO_LOCK
+        if thread_safe:
+            for stock in self._stockList():
+                stock.thread_safe = True
+
+    def _stockList(self):
+
+        #Copy of the stocks, safe to iterate while other threads add or remove stocks
+
+        with self._lock:
+            return list(self._stocks.values())
+
+#--------------------------------------------------------------------------------------------------------
+
+    @property
+    def index_basis(self):
+        return self._index_basis
+
+    @index_basis.setter
+    def index_basis(self, index_basis):
+
+        if type(index_basis) is IndexBasis:
+            self._index_basis = index_basis
+            self.recomputeIndex()
+        else:
+            raise TypeError("Invalid index basis : Requiring IndexBasis object (got "+ str(type(index_basis))+")")
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Exchange-wide trade retention. When set, the horizon and rollup interval are applied to every stock on the
+    #exchange and to stocks added later; when None, each stock keeps its own setting
+
+    @property
+    def retention(self):
+        return self._retention
+
+    @retention.setter
+    def retention(self, retention):
+        self._retention = Stock.validateInterval(retention, "retention horizon")
+        if retention is not None:
+            for stock in self._stockList():
+                stock.retention = retention
+
+    @property
+    def rollup_interval(self):
+        return self._rollup_interval
+
+    @rollup_interval.setter
+    def rollup_interval(self, rollup_interval):
+        self._rollup_interval = Stock.validateInterval(rollup_interval, "rollup interval")
+        if rollup_interval is not None:
+            for stock in self._stockList():
+                stock.rollup_interval = rollup_interval
+
+    #Exchange-wide cold storage. When set, every stock on the exchange (and added later) seals the trades it evicts
+    #into segments under cold_directory/<symbol> (see Segments module); when None, each stock keeps its own setting
+
+    @property
+    def cold_directory(self):
+        return self._cold_directory
+
+    @cold_directory.setter
+    def cold_directory(self, cold_directory):
+
+        if cold_directory is not None and type(cold_directory) is not str:
+            raise TypeError("Invalid cold storage directory : Requiring path string or None (got "+ \
+                            str(type(cold_directory))+")")
+        self._cold_directory = cold_directory
+        if cold_directory is not None:
+            for stock in self._stockList():
+                self._adoptColdStore(stock)
+
+    def _adoptColdStore(self, stock):
+        directory = os.path.join(self._cold_directory, stock.symbol)
+        if stock.cold_store is None or stock.cold_store.directory != directory:
+            stock.cold_store = SegmentStore(directory)
+
+    #Exchange-wide clock for "now" (see Stock.clock): when set it is applied to every stock on the exchange and to
+    #stocks added later, and used for the exchange's own windows (snapshot, the VWAP index basis)
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @clock.setter
+    def clock(self, clock):
+
+        if clock is not None and not callable(clock):
+            raise TypeError("Invalid clock : Requiring callable returning a datetime or None (got "+ \
+                            str(type(clock))+")")
+        self._clock = clock
+        if clock is not None:
+            for stock in self._stockList():
+                stock.clock = clock
 
-        self._stocks = stocks
+    def _now(self):
+        return datetime.utcnow() if self._clock is None else self._clock()
 
 #--------------------------------------------------------------------------------------------------------
 
     def addStock(self, stock):
 
         if type(stock) is Stock:
-            self._stocks[stock.symbol] = stock
+            self._adopt(stock)
+
+            with self._lock:
+                replaced = self._stocks.get(stock.symbol)
+                self._stocks[stock.symbol] = stock
+                self._registry.register(stock)
+
+            if replaced is not None:
+                self._unwatch(replaced)
+                self._notifyStock(replaced, False)
+            self._watch(stock)
+            self._refreshIndexTerm(stock)
+            self._notifyStock(stock, True)
         else:
              raise TypeError("Incorrectly Formatted Stock : Requiring Stock object (got "+ str(type(stock))+")")
 
+    def removeStock(self, stock_symbol):
+
+        with self._lock:
+            stock = self.getStock(stock_symbol)
+            del self._stocks[stock_symbol]
+            stock_id = self._registry.unregister(stock)
+            if stock_id is not None:
+                self._setIndexTerm(stock_id, None)
+
+        self._unwatch(stock)
+        self._notifyStock(stock, False)
+        return stock
+
     def getStock(self, stock_symbol):
 
-        if stock_symbol in self.stocks:
-            return self.stocks[stock_symbol]
+        stock = self._stocks.get(stock_symbol)
+        if stock is not None:
+            return stock
         else:
             raise ValueError("Invalid stock reference, no stocks found matching symbol "+ str(stock_symbol)+")")
 
+    #Every stock listed gets a dense integer ID, which keys the exchange's per-stock arrays (see Registry module)
+
+    @property
+    def registry(self):
+        return self._registry
+
+    def stockId(self, stock_symbol):
+        with self._lock:
+            return self._registry.idOf(stock_symbol)
+
+    def getStockById(self, stock_id):
+        with self._lock:
+            return self._registry.stock(stock_id)
+
+    def _adopt(self, stock):
+
+        #Apply the exchange-wide settings to a stock joining the exchange
+
+        if self._rollup_interval is not None and stock.rollup_interval != self._rollup_interval:
+            stock.rollup_interval = self._rollup_interval
+        if self._retention is not None:
+            stock.retention = self._retention
+        if self._clock is not None:
+            stock.clock = self._clock
+        if self._cold_directory is not None:
+            self._adoptColdStore(stock)
+        if self.thread_safe:
+            stock.thread_safe = True
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Stock listeners follow the exchange's membership (e.g. a Journal recording it), called as
+    #listener(stock, True) after a stock is added and listener(stock, False) after one is removed or replaced
+
+    def addStockListener(self, listener):
+        with self._lock:
+            self._stock_listeners = self._stock_listeners + [listener]
+
+    def removeStockListener(self, listener):
+        with self._lock:
+            self._stock_listeners = [x for x in self._stock_listeners if x != listener]
+
+    def _notifyStock(self, stock, added):
+        for listener in self._stock_listeners:
+            listener(stock, added)
+
+    #Push updates of the stocks' VWAPs and last trade prices and of the GBCE All Share Index (see Subscriptions
+    #module), coalesced to at most one round every SUBSCRIPTION_INTERVAL seconds, or every `interval` seconds once
+    #given to subscribe. The first subscription creates the exchange's hub and puts the exchange in thread-safe
+    #mode; close stops it
+
+    @property
+    def subscriptions(self):
+        with Subscriptions.CREATION_LOCK:
+            if self._subscriptions is None:
+                self._subscriptions = Subscriptions(self, self.SUBSCRIPTION_INTERVAL)
+            return self._subscriptions
+
+    def subscribe(self, topic, callback, symbol=None, window=timedelta(minutes=15), interval=None):
+        hub = self.subscriptions
+        if interval is not None:
+            hub.interval = interval
+        return hub.subscribe(topic, callback, symbol, window)
+
+    def close(self):
+
+        '''Stop the exchange's subscription hub and those of its stocks, and write the trades staged for the stocks'
+        cold stores to disk (see Stock.close). The exchange stays usable afterwards'''
+
+        with Subscriptions.CREATION_LOCK:
+            hub, self._subscriptions = self._subscriptions, None
+        if hub is not None:
+            hub.close()
+        for stock in self._stockList():
+            stock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+#--------------------------------------------------------------------------------------------------------
+
+    def ingest(self, symbols, timestamps=None, share_quantities=None, trade_types=None, trade_prices=None):
+
+        '''Bulk trade ingestion across many stocks. Takes either five equal-length columns (symbols plus the four
+        trade columns accepted by Stock.addTrades) or, as the only argument, an iterable of
+        (symbol, timestamp, share_quantity, trade_type, trade_price) tuples. Stocks can be given by their IDs (see
+        registry) instead of symbols. The whole batch is validated in one vectorised pass and every symbol is checked before anything is stored,
+        then each stock's trades are sorted once and merged into its storage'''
+
+        start_time = perf_counter_ns() if METRICS.enabled else 0
+
+        if timestamps is None and share_quantities is None and trade_types is None and trade_prices is None:
+            rows = list(symbols)
+            if not rows:
+                return
+            symbols, timestamps, share_quantities, trade_types, trade_prices = zip(*rows)
+
+        columns = tradeColumns(timestamps, share_quantities, trade_types, trade_prices)
+
+        symbols = np.asarray(symbols)
+        if len(symbols) != len(columns[0]):
+            raise ValueError("Mismatched trade columns : Requiring one symbol per trade (got "+ str(len(symbols))+ \
+                             " symbols for "+ str(len(columns[0]))+" trades)")
+
+        #Symbols are resolved to stock IDs in one pass, and grouping works on the IDs
+        with self._lock:
+            unique_ids, symbol_index = np.unique(self._registry.idsOf(symbols), return_inverse=True)
+            stocks = self._registry.stocksOf(unique_ids)
+
+        #Group rows by stock, and by timestamp within a stock (lexsort is stable, so ties keep batch order)
+        order = np.lexsort((columns[0], symbol_index))
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(symbol_index, minlength=len(stocks)))))
+        columns = [x[order] for x in columns]
+
+        for i, stock in enumerate(stocks):
+            group = slice(bounds[i], bounds[i + 1])
+            stock._addValidatedTrades(*(x[group] for x in columns))
+
+        if start_time:
+            _TRADES_INGESTED.inc(len(order))
+            _INGEST_NS.record(perf_counter_ns() - start_time)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def snapshot(self, window=timedelta(minutes=15), market_prices=None, symbols=None, as_of=None):
+
+        '''Volume weighted price, dividend yield and P/E ratio for all stocks (or those in `symbols`, in that order)
+        in one call, as a NumPy record array (see SNAPSHOT_DTYPE).
+        Each stock's VWAP over the trailing `window` comes from its running sums; the ratios are then computed for all
+        stocks at once. `market_prices` is an optional sequence aligned with the stocks, when absent each stock's VWAP
+        is used as its market price. Cases where Stock methods would raise ValueError (no trades in the window, a
+        non-positive market price, a zero dividend) give NaN instead. With `as_of` (a datetime) the window ends there
+        rather than at the exchange's clock, as in Stock.getVolumeWeightedStockPrice'''
+
+        #Per-stock attributes are read off the registry's parallel arrays. For a common stock the yield and P/E are
+        #driven by the last dividend, for a preferred stock by fixed dividend * par value
+        with self._lock:
+            ids = self._registry.idsOf(list(self._stocks) if symbols is None else symbols)
+            stocks = self._registry.stocksOf(ids)
+            common = self._registry.stock_types[ids] == StockType.Common.value
+            dividend = np.where(common, self._registry.last_dividends[ids],
+                                self._registry.fixed_dividends[ids] * self._registry.par_values[ids])
+
+        result = np.zeros(len(stocks), dtype=SNAPSHOT_DTYPE)
+        if not stocks:
+            return result
+
+        if as_of is None:
+            period_start, until = toEpochNanos(self._now() - window), None
+        else:
+            period_start, until = toEpochNanos(as_of - window), toEpochNanos(as_of)
+        vwap = np.empty(len(stocks), dtype=np.float64)
+        for i, stock in enumerate(stocks):
+            with stock.lock:
+                stock_vwap = stock._trade_store.volumeWeightedPrice(period_start, until)
+            vwap[i] = np.nan if stock_vwap is None else stock_vwap
+
+        if market_prices is None:
+            price = vwap
+        else:
+            price = np.asarray(market_prices, dtype=np.float64)
+            if price.shape != vwap.shape:
+                raise ValueError("Mismatched market prices : Requiring one price per stock (got "+ str(len(price))+ \
+                                 " prices for "+ str(len(stocks))+" stocks)")
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['dividend_yield'] = np.where(price > 0, dividend / price, np.nan)
+            result['pe_ratio'] = np.where(dividend > 0, price / dividend, np.nan)
+
+        result['symbol'] = [x.symbol for x in stocks]
+        result['vwap'] = vwap
+        result['market_price'] = price
+        return result.view(np.recarray)
+
+    def query(self, start=None, end=None, symbols=None):
+
+        '''Stock.query across the exchange: the trades of every stock (or those in `symbols`, in that order) from
+        `start` (inclusive) to `end` (exclusive), as an ExchangeRange of per-stock read-only views (see Query
+        module). Filters apply to all stocks, and aggregates come back as one array entry per stock, e.g.
+        exchange.query(t1, t2).where(side=TradeType.SELL).vwap()'''
+
+        with self._lock:
+            stocks = self._registry.stocksOf(self._registry.idsOf(list(self._stocks) if symbols is None else symbols))
+        return ExchangeRange(x.query(start, end) for x in stocks)
+
 #--------------------------------------------------------------------------------------------------------
 
     def GBCEAllShareIndex(self):
 
-        #Calculates Geometric Mean (GBCE) of stocks in exchange
+        #Geometric Mean (GBCE) of the index terms of stocks in exchange, read off the running log-sum:
+        #exp(sum(log(term)) / count). A zero term makes the whole product, and so the index, zero
 
-        stock_count = len(self.stocks)
+        if not METRICS.enabled:
+            return combineIndexPartials([self.indexPartial()])
 
-        if stock_count is 0:
-            return 0
+        start_time = perf_counter_ns()
+        index = combineIndexPartials([self.indexPartial()])
+        _INDEX_NS.record(perf_counter_ns() - start_time)
+        return index
+
+    def indexPartial(self):
+
+        #The index state as (log_sum, term_count, zero_terms), which can be combined across exchanges holding
+        #disjoint sets of stocks (see ShardedExchange)
+
+        if self._expiries:
+            self._expireIndexTerms()
+        with self._lock:
+            return self._log_sum, self._term_count, self._zero_terms
+
+    def recomputeIndex(self):
+
+        #Rebuild the index state from scratch, fetching every stock's term again (e.g. after a change of basis).
+        #Par values are already held in the registry, so that basis is filled in with one array copy
+
+        with self._lock:
+            terms = self._registry.column('index_term')
+            terms[:] = np.nan
+            self._log_sum = 0.0
+            self._term_count = 0
+            self._zero_terms = 0
+            self._index_updates = 0
+            self._expiries = []
+            self._expiry_of = {}
+            if self._index_basis is IndexBasis.ParValue:
+                listed = self._registry.ids
+                terms[listed] = self._registry.par_values[listed]
+
+        if self._index_basis is not IndexBasis.ParValue:
+            for stock in self._stockList():
+                self._refreshIndexTerm(stock)
+
+        with self._lock:
+            self._resumIndex()
+
+    def _resumIndex(self):
+
+        #Exact sum of the logs of the current terms, run periodically so floating point drift cannot accumulate.
+        #Works from the registry's index term column only (NaN for stocks without a term), so it never needs a
+        #stock's lock
+
+        if METRICS.enabled:
+            _INDEX_RECOMPUTES.inc()
+        terms = self._registry.column('index_term')
+        terms = terms[~np.isnan(terms)]
+        self._log_sum = math.fsum(np.log(terms[terms > 0]).tolist())
+        self._term_count = len(terms)
+        self._zero_terms = int(np.count_nonzero(terms <= 0))
+        self._index_updates = 0
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Incremental index maintenance. Each stock is watched through its listeners, and its term is swapped in the
+    #log-sum whenever it changes. A change to the stock's attributes also refreshes its row in the registry
+
+    def _watch(self, stock):
+        stock.addChangeListener(self._stockChanged)
+        stock.addTradeListener(self._stockTraded)
+
+    def _unwatch(self, stock):
+        stock.removeChangeListener(self._stockChanged)
+        stock.removeTradeListener(self._stockTraded)
+
+    def _stockChanged(self, stock):
+        with stock.lock:
+            with self._lock:
+                self._registry.update(stock)
+            self._refreshIndexTerm(stock)
+
+    def _stockTraded(self, stock, timestamps, share_quantities, sides, trade_prices):
+        if self._index_basis is not IndexBasis.ParValue:
+            self._refreshIndexTerm(stock)
+
+    def _indexTerm(self, stock):
+
+        #The stock's contribution to the index, or None if it has none yet (no trades for a trade-driven basis),
+        #and for the VWAP basis the time (epoch ns) it next changes without a trade: when the oldest trade in the
+        #window drops out. Called with the stock's lock held
+
+        store = stock._trade_store
+        if self._index_basis is IndexBasis.ParValue:
+            return stock.par_value, None
+        elif len(store) == 0:
+            return None, None
+        elif self._index_basis is IndexBasis.VWAP:
+            after = toEpochNanos(self._now() - INDEX_VWAP_WINDOW)
+            start = store.bisect(after)
+            if start == len(store):
+                return None, None
+            return store.volumeWeightedPrice(after), int(store.timestamps[start]) + _VWAP_WINDOW_NS
         else:
-            par_value_product = 1
+            return store.prices[-1].item(), None
+
+    def _refreshIndexTerm(self, stock):
+
+        with stock.lock:
+            term, expiry = self._indexTerm(stock)
+            with self._lock:
+                stock_id = self._registry.find(stock)
+                if stock_id is not None:
+                    self._setIndexTerm(stock_id, term)
+                    if self._expiry_of.get(stock_id) != expiry:
+                        self._scheduleExpiry(stock_id, expiry)
+
+    def _scheduleExpiry(self, stock_id, expiry):
+
+        #Called with the exchange's lock held. Entries superseded by a later schedule stay in the heap, and are
+        #skipped when they come up
+
+        if expiry is None:
+            self._expiry_of.pop(stock_id, None)
+        else:
+            self._expiry_of[stock_id] = expiry
+            heapq.heappush(self._expiries, (expiry, stock_id))
+
+    def _expireIndexTerms(self):
 
+        #VWAP basis: refresh the terms due to change by now, so the index covers the 15 minutes up to the time it
+        #is read rather than up to each stock's last trade. Each due stock is refreshed once, however many of its
+        #trades have dropped out
 
-            for x in self.stocks.values():
-                par_value_product = x.par_value * par_value_product
-            return pow(par_value_product, 1/stock_count)
+        now = toEpochNanos(self._now())
+        due = []
+        with self._lock:
+            expiries = self._expiries
+            while expiries and expiries[0][0] <= now:
+                expiry, stock_id = heapq.heappop(expiries)
+                if self._expiry_of.get(stock_id) == expiry:
+                    del self._expiry_of[stock_id]
+                    try:
+                        due.append(self._registry.stock(stock_id))
+                    except ValueError:
+                        pass
+
+        for stock in due:
+            self._refreshIndexTerm(stock)
+
+    def _setIndexTerm(self, stock_id, term):
+
+        #Called with the exchange's lock held. The terms live in the registry's index term column, NaN for none
+
+        terms = self._registry.column('index_term')
+        old = terms.item(stock_id)
+        if old != old:
+            old = None
+        if old == term:
+            return
+
+        if old is not None:
+            self._term_count -= 1
+            if old > 0:
+                self._log_sum -= math.log(old)
+            else:
+                self._zero_terms -= 1
+
+        terms[stock_id] = np.nan if term is None else term
+        if term is not None:
+            self._term_count += 1
+            if term > 0:
+                self._log_sum += math.log(term)
+            else:
+                self._zero_terms += 1
+
+        self._index_updates += 1
+        if METRICS.enabled:
+            _INDEX_UPDATES.inc()
+        if self._index_updates >= self.INDEX_RECOMPUTE_INTERVAL:
+            self._resumIndex()
 
 #--------------------------------------------------------------------------------------------------------
 
     def __repr__(self):
-        return "Stocks:\n"+"\n".join(str(x) for x in self.stocks.values())+"\n"
+
+        #Lists at most REPR_STOCKS stocks, each with a bounded number of trades (see Stock.__repr__)
+
+        stocks = self._stockList()
+        shown = [str(x) for x in stocks[:self.REPR_STOCKS]]
+        if len(stocks) > self.REPR_STOCKS:
+            shown.append("... "+ str(len(stocks) - self.REPR_STOCKS)+" more stocks ...")
+        return "Stocks:\n"+"\n".join(shown)+"\n"
 
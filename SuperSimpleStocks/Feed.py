@@ -0,0 +1,324 @@
+__author__ = 'sachi'
+
+
+'''The trade feed below is an asyncio front-end for getting trades into an Exchange (or ShardedExchange) from
+streaming sources: TCP or Unix socket connections, or the replay of a recorded file. Each source is read in chunks
+of whole lines, the lines from all sources are gathered into micro-batches (by size, or by age so a quiet feed
+is not held back), decoded in one vectorised pass and passed through a bounded queue to Exchange.ingest, which
+runs in a worker thread so reading continues while a batch is applied.
+
+When the queue is full, the reader that completed a batch waits for room, and stops reading its source meanwhile,
+so a burst slows the senders down (through the socket's flow control) instead of exhausting memory.
+
+A trade message is one line: symbol,timestamp,share_quantity,trade_type,trade_price, with the timestamp either in
+epoch nanoseconds or ISO 8601 (naive UTC) and the trade type BUY or SELL (see encodeTrade)'''
+
+import asyncio
+import time
+
+from datetime import datetime
+
+import numpy as np
+
+from SuperSimpleStocks.Trade import TradeType
+from SuperSimpleStocks.TradeStore import toEpochNanos
+
+#--------------------------------------------------------------------------------------------------------
+
+_SIDES = dict((t.name.encode(), t.value) for t in TradeType)
+
+def encodeTrade(symbol, timestamp, share_quantity, trade_type, trade_price):
+
+    #One trade message, as bytes ending in a newline
+
+    if type(timestamp) is datetime:
+        timestamp = toEpochNanos(timestamp)
+    return b",".join((symbol.encode(), str(timestamp).encode(), str(share_quantity).encode(), trade_type.name.encode(),
+                      str(trade_price).encode())) + b"\n"
+
+def decodeTrades(lines):
+
+    '''Decode trade messages (bytes, without newlines) into columns accepted by Exchange.ingest: symbols, epoch-ns
+    timestamps, quantities, trade type values and prices. A well formed batch is decoded column by column in NumPy;
+    otherwise each line is decoded on its own and the malformed ones are dropped, as are rows the exchange would
+    reject (e.g. non-positive prices). Returns the columns and the number of messages dropped'''
+
+    lines = [x for x in lines if x.strip()]
+    try:
+        fields = np.array([x.split(b',') for x in lines], dtype=np.bytes_)
+        if fields.ndim != 2 or fields.shape[1] != 5:
+            raise ValueError("Mixed field counts")
+        columns = (fields[:, 0].astype(np.str_), _decodeTimestamps(fields[:, 1]), fields[:, 2].astype(np.int64),
+                   _decodeSides(fields[:, 3]), fields[:, 4].astype(np.float64))
+    except (ValueError, OverflowError):
+        rows = [x for x in map(_decodeTrade, lines) if x is not None]
+        columns = (np.array([x[0] for x in rows], dtype=np.str_), np.array([x[1] for x in rows], dtype=np.int64),
+                   np.array([x[2] for x in rows], dtype=np.int64), np.array([x[3] for x in rows], dtype=np.int8),
+                   np.array([x[4] for x in rows], dtype=np.float64))
+
+    #Values the exchange would reject are dropped here, so one bad message cannot cost the whole batch
+    valid = (columns[2] > 0) & (columns[3] > 0) & np.isfinite(columns[4]) & (columns[4] > 0)
+    if not np.all(valid):
+        columns = tuple(x[valid] for x in columns)
+
+    return columns, len(lines) - len(columns[0])
+
+def _decodeTimestamps(field):
+    if np.all(np.char.isdigit(field)):
+        return field.astype(np.int64)
+    else:
+        return field.astype('datetime64[ns]').view(np.int64)
+
+def _decodeSides(field):
+
+    #Trade type values, 0 for an unknown trade type
+
+    sides = np.zeros(len(field), dtype=np.int8)
+    for name, value in _SIDES.items():
+        sides[field == name] = value
+    return sides
+
+def _decodeTrade(line):
+
+    #One message as a row, or None if malformed (including integers too large for int64)
+
+    try:
+        symbol, timestamp, quantity, side, price = (x.strip() for x in line.split(b','))
+        return (symbol.decode(), _decodeTimestamps(np.array([timestamp]))[0], int(np.int64(int(quantity))),
+                _SIDES.get(side, 0), float(price))
+    except (ValueError, OverflowError):
+        return None
+
+#--------------------------------------------------------------------------------------------------------
+
+#Sources are async iterables of lists of complete lines (bytes, without newlines)
+
+async def streamSource(reader, chunk_size=1 << 16):
+
+    remainder = b''
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        yield lines
+    if remainder:
+        yield [remainder]
+
+async def tcpSource(host, port, chunk_size=1 << 16):
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        async for lines in streamSource(reader, chunk_size):
+            yield lines
+    finally:
+        writer.close()
+
+async def unixSource(path, chunk_size=1 << 16):
+
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        async for lines in streamSource(reader, chunk_size):
+            yield lines
+    finally:
+        writer.close()
+
+async def fileSource(path, chunk_size=1 << 20, rate=None):
+
+    '''Replay a file of trade messages, as fast as possible or at about `rate` messages per second'''
+
+    start_time, sent = time.monotonic(), 0
+    with open(path, 'rb') as f:
+        remainder = b''
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+
+            if rate is not None:
+                sent += len(lines)
+                await asyncio.sleep(max(0.0, sent / rate - (time.monotonic() - start_time)))
+            yield lines
+
+        if remainder:
+            yield [remainder]
+
+#--------------------------------------------------------------------------------------------------------
+
+class TradeFeed(object):
+
+    '''Feeds trades from any number of sources into `exchange`. Batches hold up to `batch_size` messages and are
+    sent on once their oldest message has waited `batch_delay` seconds; at most `max_queued_batches` wait to be
+    applied. Only the feed's worker thread writes to the exchange, so reading it from other threads at the same
+    time needs a thread-safe exchange'''
+
+    def __init__(self, exchange, batch_size=10000, batch_delay=0.01, max_queued_batches=16):
+
+        if type(batch_size) is not int or type(max_queued_batches) is not int:
+            raise TypeError("Invalid type for batch size or queue length : Requiring positive integers (got "+ \
+                            str(type(batch_size))+", "+ str(type(max_queued_batches))+")")
+        elif batch_size <= 0 or max_queued_batches <= 0:
+            raise ValueError("Invalid batch size or queue length : Requiring positive integers (got "+ \
+                             str(batch_size)+", "+ str(max_queued_batches)+")")
+        elif type(batch_delay) not in (int, float) or batch_delay <= 0:
+            raise ValueError("Invalid batch delay : Requiring positive seconds (got "+ str(batch_delay)+")")
+
+        self._exchange = exchange
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._max_queued_batches = max_queued_batches
+        self._queue = None
+        self._applier = None
+        self._pending = []
+        self._pending_since = None
+        self._stopping = False
+
+        self._received = 0
+        self._applied = 0
+        self._rejected = 0
+        self._errors = 0
+        self._last_error = None
+        self._batches = 0
+        self._max_queue_depth = 0
+        self._lag = 0.0
+        self._max_lag = 0.0
+        self._total_lag = 0.0
+        self._trade_age = None
+
+#--------------------------------------------------------------------------------------------------------
+
+    @property
+    def stats(self):
+
+        '''Counts of messages received, trades applied and messages rejected (malformed, invalid, for unknown
+        symbols or in a batch the exchange failed to ingest), batches applied, batches that failed (errors, with
+        the last error raised), the current and highest queue depth, the ingest lag in seconds (from a batch's
+        first message arriving to the batch being applied: last, mean and max), and the age of the newest trade
+        applied, measured against its timestamp'''
+
+        return {'received': self._received, 'applied': self._applied, 'rejected': self._rejected,
+                'batches': self._batches, 'errors': self._errors, 'last_error': self._last_error,
+                'queue_depth': 0 if self._queue is None else self._queue.qsize(),
+                'max_queue_depth': self._max_queue_depth,
+                'lag': self._lag, 'mean_lag': self._total_lag / self._batches if self._batches else 0.0,
+                'max_lag': self._max_lag, 'trade_age': self._trade_age}
+
+    def stop(self):
+
+        #Stop reading the sources; what has been read is still applied before run() returns
+
+        self._stopping = True
+
+#--------------------------------------------------------------------------------------------------------
+
+    async def run(self, *sources):
+
+        '''Read all sources concurrently until each is exhausted (or stop() is called), apply everything read, and
+        return the final stats'''
+
+        self._queue = asyncio.Queue(self._max_queued_batches)
+        self._stopping = False
+        self._applier = asyncio.create_task(self._applyBatches())
+        flusher = asyncio.create_task(self._flushPeriodically())
+
+        try:
+            await asyncio.gather(*(self._read(x) for x in sources))
+        finally:
+            flusher.cancel()
+            await self._flush()
+            await self._enqueue(None)
+            await self._applier
+
+        return self.stats
+
+    async def _read(self, source):
+
+        async for lines in source:
+            self._received += len(lines)
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.extend(lines)
+
+            if len(self._pending) >= self._batch_size:
+                await self._flush()
+            if self._stopping:
+                break
+
+    async def _flushPeriodically(self):
+
+        while True:
+            await asyncio.sleep(self._batch_delay)
+            if self._pending and time.monotonic() - self._pending_since >= self._batch_delay:
+                await self._flush()
+
+    async def _flush(self):
+
+        #Decode the pending lines and queue them as one batch, waiting for room when the queue is full
+
+        if not self._pending:
+            return
+        lines, received_at, self._pending = self._pending, self._pending_since, []
+
+        columns, rejected = decodeTrades(lines)
+        self._rejected += rejected
+
+        if await self._enqueue((columns, received_at)):
+            self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        else:
+            self._rejected += len(columns[0])
+
+    async def _enqueue(self, batch):
+
+        #Queue a batch (or None, the end marker) for the applier, waiting for room. Should the applier have
+        #stopped, nothing is queued, since nothing would take it off the queue, and the sources stop being read
+
+        if not self._applier.done():
+            put = asyncio.ensure_future(self._queue.put(batch))
+            await asyncio.wait((put, self._applier), return_when=asyncio.FIRST_COMPLETED)
+            if put.done():
+                return True
+            put.cancel()
+        self._stopping = True
+        return False
+
+#--------------------------------------------------------------------------------------------------------
+
+    async def _applyBatches(self):
+
+        while True:
+            batch = await self._queue.get()
+            if batch is None:
+                break
+            columns, received_at = batch
+            try:
+                applied, rejected = await asyncio.to_thread(self._apply, columns)
+            except Exception as error:
+                applied, rejected = 0, len(columns[0])
+                self._errors += 1
+                self._last_error = error
+
+            self._applied += applied
+            self._rejected += rejected
+            if applied:
+                self._trade_age = (toEpochNanos(datetime.utcnow()) - int(columns[1].max())) / 1e9
+
+            self._lag = time.monotonic() - received_at
+            self._total_lag += self._lag
+            self._max_lag = max(self._max_lag, self._lag)
+            self._batches += 1
+
+    def _apply(self, columns):
+
+        #Runs in the worker thread, returning the number of trades applied and rejected. Trades for symbols the
+        #exchange does not list are dropped
+
+        known = np.isin(columns[0], list(self._exchange.stocks))
+        if not np.all(known):
+            columns = tuple(x[known] for x in columns)
+
+        if len(columns[0]):
+            self._exchange.ingest(*columns)
+        return len(columns[0]), len(known) - len(columns[0])
@@ -0,0 +1,306 @@
+__author__ = 'sachi'
+
+
+'''The journal below makes an Exchange durable across restarts. Once attached, it follows the exchange through its
+listeners and appends every trade stored to a per-symbol file of fixed-width binary records (JOURNAL_DTYPE, 25 bytes
+a trade), and every stock definition (added, changed or removed) to a line of JSON in stocks.jsonl.
+
+Restoring maps each trade file into memory and hands the mapped columns to the stock in one bulk merge, so tens of
+millions of trades are rebuilt at memory speed rather than one addTrade at a time. A record cut short by a crash is
+ignored on restore and dropped when the file is reopened for appending.
+
+Writes go through buffered files, which are flushed and fsync'ed every `sync_every` trades or `sync_interval`
+seconds, whichever comes first (see Journal), trading durability of the last few trades for write speed'''
+
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from SuperSimpleStocks.Exchange import Exchange
+from SuperSimpleStocks.Stock import Stock, StockType
+from SuperSimpleStocks.TradeStore import TRADE_RECORD_DTYPE, toSeconds, fromSeconds
+
+#--------------------------------------------------------------------------------------------------------
+
+#Trade record layout (see TradeStore), with single trades packed by the equivalent struct. Each trade file
+#starts with a 16-byte header: magic and record size
+
+JOURNAL_DTYPE = TRADE_RECORD_DTYPE
+_RECORD = struct.Struct('<qqdb')
+_MAGIC = b'SSSTRADE'
+_HEADER = struct.Struct('<8sq')
+
+STOCKS_FILE = 'stocks.jsonl'
+TRADES_SUFFIX = '.trades'
+
+def readTrades(path):
+
+    '''Trades journaled in the file at `path`, as a read-only memory-mapped record array (nothing is read until
+    the columns are used). A partial record at the end is left out'''
+
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        magic, record_size = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != _MAGIC or record_size != JOURNAL_DTYPE.itemsize:
+        raise ValueError("Invalid trade journal : Unrecognised header in "+ str(path))
+
+    count = (size - _HEADER.size) // JOURNAL_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=JOURNAL_DTYPE)
+    return np.memmap(path, dtype=JOURNAL_DTYPE, mode='r', offset=_HEADER.size, shape=(count,))
+
+#--------------------------------------------------------------------------------------------------------
+
+class Journal(object):
+
+    '''Journal of one exchange's stocks and trades in `directory` (created if needed). Attach it to an exchange to
+    start recording, or restore it into one first to pick up where an earlier process stopped:
+
+        journal = Journal('data/journal')
+        exchange = journal.restore()      #rebuilds the stocks and trades, then attaches
+
+    Only trades stored after attaching are recorded, plus the trades a stock already holds when it is added; replacing
+    a stock's trades (Stock.trades) starts its trade file afresh.
+    `sync_every` (trades) and `sync_interval` (seconds) bound how much is lost on a crash; None switches either off'''
+
+    def __init__(self, directory, sync_every=10000, sync_interval=1.0):
+
+        if sync_every is not None and (type(sync_every) is not int or sync_every <= 0):
+            raise ValueError("Invalid journal sync count : Requiring positive integer or None (got "+ \
+                             str(sync_every)+")")
+        elif sync_interval is not None and (type(sync_interval) not in (int, float) or sync_interval <= 0):
+            raise ValueError("Invalid journal sync interval : Requiring positive seconds or None (got "+ \
+                             str(sync_interval)+")")
+
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._sync_every = sync_every
+        self._sync_interval = sync_interval
+        self._exchange = None
+        self._files = {}
+        self._dirty = set()
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._stocks_file = open(os.path.join(directory, STOCKS_FILE), 'a')
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def _tradesPath(self, symbol):
+        return os.path.join(self._directory, symbol + TRADES_SUFFIX)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def restore(self, exchange=None):
+
+        '''Rebuild the journaled stocks and their trades into `exchange` (by default a new Exchange), attach the
+        journal to it and return it. Each stock's trades are merged in bulk straight from the memory-mapped file'''
+
+        if exchange is None:
+            exchange = Exchange()
+
+        definitions = {}
+        path = os.path.join(self._directory, STOCKS_FILE)
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        definition = json.loads(line)
+                    except ValueError:
+                        continue
+                    if definition.get('removed'):
+                        definitions.pop(definition['symbol'], None)
+                    else:
+                        definitions[definition['symbol']] = definition
+
+        #Rewrite the definitions file with only the latest definition of each stock, so it does not grow without
+        #bound over restarts
+        with self._lock:
+            self._stocks_file.close()
+            with open(path + '.tmp', 'w') as f:
+                f.writelines(json.dumps(x) + '\n' for x in definitions.values())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            self._stocks_file = open(path, 'a')
+
+        for symbol, definition in definitions.items():
+            stock = Stock(symbol, StockType[definition['stock_type']], definition['last_dividend'],
+                          definition['par_value'], definition['fixed_dividend'], fromSeconds(definition['retention']),
+                          fromSeconds(definition['rollup_interval']))
+
+            trades_path = self._tradesPath(symbol)
+            if os.path.exists(trades_path):
+                records = readTrades(trades_path)
+                stock._addValidatedTrades(records['timestamp'], records['quantity'], records['side'],
+                                          records['price'])
+                del records
+
+            exchange.addStock(stock)
+
+        self.attach(exchange, record_existing=False)
+        return exchange
+
+    def attach(self, exchange, record_existing=True):
+
+        #Start journaling `exchange`: its current stocks (with the trades they hold, unless record_existing is
+        #False because they came from this journal) and, through a stock listener, stocks added later
+
+        if self._exchange is not None:
+            raise ValueError("Invalid journal use, already attached to an exchange")
+        self._exchange = exchange
+
+        for stock in list(exchange.stocks.values()):
+            if record_existing:
+                self._stockAdded(stock, True)
+            else:
+                self._watch(stock)
+        exchange.addStockListener(self._stockAdded)
+
+    def detach(self):
+
+        if self._exchange is not None:
+            self._exchange.removeStockListener(self._stockAdded)
+            for stock in list(self._exchange.stocks.values()):
+                self._unwatch(stock)
+            self._exchange = None
+        self.sync()
+
+    def close(self):
+
+        self.detach()
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+            self._stocks_file.close()
+
+#--------------------------------------------------------------------------------------------------------
+
+    def _watch(self, stock):
+        stock.addChangeListener(self._writeDefinition)
+        stock.addTradeListener(self._writeTrades)
+        stock.addResetListener(self._rewriteTrades)
+
+    def _unwatch(self, stock):
+        stock.removeChangeListener(self._writeDefinition)
+        stock.removeTradeListener(self._writeTrades)
+        stock.removeResetListener(self._rewriteTrades)
+
+    def _stockAdded(self, stock, added):
+
+        #Stock listener. A stock joining the exchange starts a fresh trade file holding the trades it brings
+
+        if not added:
+            self._unwatch(stock)
+            with self._lock:
+                self._stocks_file.write(json.dumps({'symbol': stock.symbol, 'removed': True}) + '\n')
+                self._stocks_file.flush()
+            return
+
+        with stock.lock:
+            self._writeDefinition(stock)
+            self._rewriteTrades(stock)
+            self._watch(stock)
+
+    def _writeDefinition(self, stock):
+
+        #Change listener: the stock's full definition, the latest line for a symbol wins on restore
+
+        definition = {'symbol': stock.symbol, 'stock_type': stock.stock_type.name,
+                      'last_dividend': stock.last_dividend, 'par_value': stock.par_value,
+                      'fixed_dividend': stock.fixed_dividend, 'retention': toSeconds(stock.retention),
+                      'rollup_interval': toSeconds(stock.rollup_interval)}
+        with self._lock:
+            self._stocks_file.write(json.dumps(definition) + '\n')
+            self._stocks_file.flush()
+
+    def _rewriteTrades(self, stock):
+
+        #Reset listener (and for stocks joining): start the stock's trade file afresh with the trades it holds now
+
+        with self._lock:
+            f = self._files.pop(stock.symbol, None)
+            if f is not None:
+                self._dirty.discard(f)
+                f.close()
+            self._openTrades(stock.symbol, truncate=True)
+            store = stock._trade_store
+            if len(store):
+                self._append(stock.symbol, store.timestamps, store.quantities, store.sides, store.prices)
+
+    def _writeTrades(self, stock, timestamps, share_quantities, sides, trade_prices):
+
+        #Trade listener, called with the stock's lock held
+
+        with self._lock:
+            self._append(stock.symbol, timestamps, share_quantities, sides, trade_prices)
+
+    def _openTrades(self, symbol, truncate=False):
+
+        #Open (creating, or continuing after any partial last record) a symbol's trade file for appending
+
+        path = self._tradesPath(symbol)
+        if truncate or not os.path.exists(path) or os.path.getsize(path) < _HEADER.size:
+            f = open(path, 'wb', buffering=1 << 20)
+            f.write(_HEADER.pack(_MAGIC, JOURNAL_DTYPE.itemsize))
+        else:
+            f = open(path, 'r+b', buffering=1 << 20)
+            size = os.path.getsize(path)
+            f.truncate(size - (size - _HEADER.size) % JOURNAL_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+
+        self._files[symbol] = f
+        return f
+
+    def _append(self, symbol, timestamps, share_quantities, sides, trade_prices):
+
+        #Called with the journal's lock held
+
+        f = self._files.get(symbol)
+        if f is None:
+            f = self._openTrades(symbol)
+
+        count = len(timestamps)
+        if count == 1:
+            f.write(_RECORD.pack(int(timestamps[0]), int(share_quantities[0]), float(trade_prices[0]), int(sides[0])))
+        else:
+            records = np.empty(count, dtype=JOURNAL_DTYPE)
+            records['timestamp'] = timestamps
+            records['quantity'] = share_quantities
+            records['price'] = trade_prices
+            records['side'] = sides
+            f.write(records.tobytes())
+
+        self._dirty.add(f)
+        self._unsynced += count
+        if (self._sync_every is not None and self._unsynced >= self._sync_every) or \
+           (self._sync_interval is not None and time.monotonic() - self._synced_at >= self._sync_interval):
+            self._sync()
+
+#--------------------------------------------------------------------------------------------------------
+
+    def sync(self):
+
+        #Flush and fsync everything written so far
+
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+
+        for f in self._dirty:
+            if not f.closed:
+                f.flush()
+                os.fsync(f.fileno())
+        if not self._stocks_file.closed:
+            os.fsync(self._stocks_file.fileno())
+        self._dirty = set()
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
@@ -0,0 +1,221 @@
+__author__ = 'sachi'
+
+
+'''The classes below instrument the hot paths of Exchange, Stock and Trade: counters (trades added, evicted, Trade
+objects built, ...), latency histograms (addTrade, addTrades, getVolumeWeightedStockPrice, GBCEAllShareIndex,
+ingest) and gauges read on collection (per-symbol trade counts and bytes held, see Metrics.watchExchange).
+
+All instruments report to the process-wide registry METRICS, which starts disabled. While disabled each instrumented
+call costs one attribute check, so the instrumentation stays in place in production:
+
+    METRICS.enabled = True
+    METRICS.watchExchange(exchange)
+    METRICS.addExporter(lambda snapshot: print(snapshot['histograms']['stock.add_trade_ns']))
+    METRICS.startExporting(interval=10)
+
+Histograms record into fixed power-of-two buckets (bucket i holds values of bit length i), so recording a value is an
+integer operation and a list increment, with quantiles accurate to within a factor of two. Updates are not locked:
+under concurrent writers an occasional count can be lost, which is the price of keeping them cheap'''
+
+import threading
+import time
+
+#--------------------------------------------------------------------------------------------------------
+
+#Histogram buckets: one per bit length of a non-negative integer value, so up to 2^64 ns (centuries)
+HISTOGRAM_BUCKETS = 65
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Gauge(object):
+
+    '''A value set by the instrumented code, or read from `function` whenever metrics are collected. The function
+    may return a dict (e.g. one value per symbol)'''
+
+    def __init__(self, function=None):
+        self.value = None
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        return self.function() if self.function is not None else self.value
+
+class Histogram(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+
+        #Values are non-negative integers (e.g. nanoseconds, trade counts)
+
+        self.counts[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+
+        #Upper bound of the bucket holding the q-th quantile (capped at the largest value seen), or None when empty
+
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bits, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << bits) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.total, 'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'buckets': dict(((1 << x) - 1, c) for x, c in enumerate(self.counts) if c)}
+
+#--------------------------------------------------------------------------------------------------------
+
+class Metrics(object):
+
+    '''Registry of named instruments. Instrumented code looks its instruments up once (counter, histogram, gauge
+    create them on first use) and guards every update with `if METRICS.enabled`'''
+
+    def __init__(self, enabled=False):
+
+        self.enabled = enabled
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._exporters = []
+        self._exporting = None
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.setdefault(name, Counter())
+
+    def histogram(self, name):
+        with self._lock:
+            return self._histograms.setdefault(name, Histogram())
+
+    def gauge(self, name, function=None):
+
+        #Registering a function for an existing gauge replaces the old one
+
+        with self._lock:
+            gauge = self._gauges.setdefault(name, Gauge(function))
+            if function is not None:
+                gauge.function = function
+            return gauge
+
+    def removeGauge(self, name):
+        with self._lock:
+            self._gauges.pop(name, None)
+
+    def reset(self):
+
+        #Zero the counters and histograms (gauges are left alone)
+
+        with self._lock:
+            for counter in self._counters.values():
+                counter.value = 0
+            for histogram in self._histograms.values():
+                histogram.reset()
+
+#--------------------------------------------------------------------------------------------------------
+
+    def watchExchange(self, exchange, prefix='exchange'):
+
+        '''Gauges following `exchange`: its number of stocks, total trades and bytes of trade storage, and per-symbol
+        trade counts and bytes (as dicts keyed by symbol). They are read on collection, so cost nothing in between'''
+
+        def stocks():
+            return exchange._stockList()
+
+        self.gauge(prefix + '.stocks', lambda: len(stocks()))
+        self.gauge(prefix + '.trades', lambda: sum(len(x._trade_store) for x in stocks()))
+        self.gauge(prefix + '.trade_bytes', lambda: sum(x._trade_store.nbytes for x in stocks()))
+        self.gauge(prefix + '.symbol_trades', lambda: dict((x.symbol, len(x._trade_store)) for x in stocks()))
+        self.gauge(prefix + '.symbol_bytes', lambda: dict((x.symbol, x._trade_store.nbytes) for x in stocks()))
+
+    def unwatchExchange(self, prefix='exchange'):
+        for name in ('stocks', 'trades', 'trade_bytes', 'symbol_trades', 'symbol_bytes'):
+            self.removeGauge(prefix + '.' + name)
+
+    def collect(self):
+
+        '''A snapshot of every instrument: {'time', 'counters': {name: value}, 'gauges': {name: value},
+        'histograms': {name: summary}} (see Histogram.summary)'''
+
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = list(self._histograms.items())
+            gauges = list(self._gauges.items())
+
+        return {'time': time.time(),
+                'counters': dict((name, x.value) for name, x in counters),
+                'gauges': dict((name, x.read()) for name, x in gauges),
+                'histograms': dict((name, x.summary()) for name, x in histograms)}
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Exporters are callables taking a snapshot (see collect), e.g. to push it to a monitoring system
+
+    def addExporter(self, exporter):
+        with self._lock:
+            self._exporters = self._exporters + [exporter]
+
+    def removeExporter(self, exporter):
+        with self._lock:
+            self._exporters = [x for x in self._exporters if x != exporter]
+
+    def export(self):
+
+        snapshot = self.collect()
+        for exporter in self._exporters:
+            exporter(snapshot)
+        return snapshot
+
+    def startExporting(self, interval):
+
+        '''Export every `interval` seconds from a daemon thread, until stopExporting'''
+
+        if type(interval) not in (int, float) or interval <= 0:
+            raise ValueError("Invalid export interval : Requiring positive seconds (got "+ str(interval)+")")
+        self.stopExporting()
+
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                self.export()
+
+        self._exporting = stop, threading.Thread(target=run, name='metrics-export', daemon=True)
+        self._exporting[1].start()
+
+    def stopExporting(self):
+
+        if self._exporting is not None:
+            stop, thread = self._exporting
+            stop.set()
+            thread.join()
+            self._exporting = None
+
+#--------------------------------------------------------------------------------------------------------
+
+METRICS = Metrics()
@@ -0,0 +1,238 @@
+__author__ = 'sachi'
+
+
+'''The classes below answer time-range questions about stored trades ("BUY trades between T1 and T2 above price X:
+how many, what volume, what VWAP?") without building Trade objects. Stock.query returns a TradeRange: read-only views
+over the slice of the stock's columns between two times, found by bisection, so nothing is copied. Filters on side,
+price and quantity are evaluated as one vectorised boolean mask, and the aggregates (count, volume, notional, VWAP,
+min/max price) are computed over the columns where the mask holds; without filters, volume, notional and VWAP come
+straight from the store's running sums. Exchange.query does the same for many stocks at once (ExchangeRange), with
+aggregates as arrays aligned with its symbols.
+
+The views share memory with the stock's storage: they hold the trades in the range at the time of the query, but an
+out-of-order trade later inserted into the range shifts the rows underneath them. Copy the columns (or use
+summary) for results that must not change'''
+
+import numpy as np
+
+from SuperSimpleStocks.Trade import Trade, TradeType
+from SuperSimpleStocks.TradeStore import TRADE_TYPES
+
+#--------------------------------------------------------------------------------------------------------
+
+#Record layout returned by ExchangeRange.summary, NaN marks aggregates that are not available (no trades)
+
+QUERY_DTYPE = np.dtype([('symbol', 'U3'), ('count', np.int64), ('volume', np.int64), ('notional', np.float64),
+                        ('vwap', np.float64), ('min_price', np.float64), ('max_price', np.float64)])
+
+def _readOnly(view):
+    view = view[:]
+    view.flags.writeable = False
+    return view
+
+#--------------------------------------------------------------------------------------------------------
+
+class TradeRange(object):
+
+    '''Trades of one stock over a time range, as read-only column views (epoch-ns timestamps, quantities, side
+    codes, prices), optionally narrowed by where(). Columns of a filtered range are copies holding only the trades
+    that pass'''
+
+    def __init__(self, symbol, timestamps, quantities, sides, prices, volume=None, notional=None, mask=None):
+
+        self._symbol = symbol
+        self._columns = tuple(_readOnly(x) for x in (timestamps, quantities, sides, prices))
+        self._volume = volume
+        self._notional = notional
+        self._mask = mask
+
+    @property
+    def symbol(self):
+        return self._symbol
+
+    def _column(self, index):
+        column = self._columns[index]
+        return column if self._mask is None else column[self._mask]
+
+    @property
+    def timestamps(self):
+        return self._column(0)
+
+    @property
+    def datetimes(self):
+
+        #Timestamps as datetime64[ns] values (still a view when unfiltered)
+
+        return self._column(0).view('datetime64[ns]')
+
+    @property
+    def quantities(self):
+        return self._column(1)
+
+    @property
+    def sides(self):
+        return self._column(2)
+
+    @property
+    def prices(self):
+        return self._column(3)
+
+    @property
+    def mask(self):
+
+        #Boolean mask over the unfiltered range, or None when no filter is applied
+
+        return self._mask
+
+    def __len__(self):
+        return self.count()
+
+#--------------------------------------------------------------------------------------------------------
+
+    def where(self, side=None, min_price=None, max_price=None, min_quantity=None, max_quantity=None, mask=None):
+
+        '''The trades in this range that pass every given filter: side (TradeType or its value), inclusive price and
+        quantity bounds, and/or a boolean `mask` aligned with the unfiltered range (e.g. built from its columns).
+        Filters combine with those already applied'''
+
+        timestamps, quantities, sides, prices = self._columns
+        keep = np.ones(len(timestamps), dtype=bool) if self._mask is None else self._mask.copy()
+
+        if side is not None:
+            keep &= sides == (side.value if type(side) is TradeType else side)
+        if min_price is not None:
+            keep &= prices >= min_price
+        if max_price is not None:
+            keep &= prices <= max_price
+        if min_quantity is not None:
+            keep &= quantities >= min_quantity
+        if max_quantity is not None:
+            keep &= quantities <= max_quantity
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != keep.shape:
+                raise ValueError("Mismatched filter mask : Requiring one value per trade in the range (got "+ \
+                                 str(len(mask))+" for "+ str(len(keep))+" trades)")
+            keep &= mask
+
+        return TradeRange(self._symbol, timestamps, quantities, sides, prices, mask=keep)
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Aggregates. Those that are undefined for an empty range (VWAP, min/max price) give None
+
+    def count(self):
+        return len(self._columns[0]) if self._mask is None else int(np.count_nonzero(self._mask))
+
+    def volume(self):
+
+        if self._mask is None:
+            if self._volume is None:
+                self._volume = int(self._columns[1].sum())
+            return self._volume
+        return int(self._columns[1].sum(where=self._mask))
+
+    def notional(self):
+
+        quantities, prices = self._columns[1], self._columns[3]
+        if self._mask is None:
+            if self._notional is None:
+                self._notional = float(np.dot(prices, quantities))
+            return self._notional
+        return float(np.sum(prices * quantities, where=self._mask))
+
+    def vwap(self):
+        volume = self.volume()
+        return self.notional() / volume if volume > 0 else None
+
+    def minPrice(self):
+        if self.count() == 0:
+            return None
+        return float(self._columns[3].min(initial=np.inf, where=True if self._mask is None else self._mask))
+
+    def maxPrice(self):
+        if self.count() == 0:
+            return None
+        return float(self._columns[3].max(initial=-np.inf, where=True if self._mask is None else self._mask))
+
+    def summary(self):
+        return {'symbol': self._symbol, 'count': self.count(), 'volume': self.volume(), 'notional': self.notional(),
+                'vwap': self.vwap(), 'min_price': self.minPrice(), 'max_price': self.maxPrice()}
+
+    def trades(self):
+
+        #The trades in the range as Trade objects, for when they really are needed
+
+        return [Trade.trusted(t, q, TRADE_TYPES[s], p)
+                for t, q, s, p in zip(self.datetimes.astype('datetime64[us]').tolist(), self.quantities.tolist(),
+                                      self.sides.tolist(), self.prices.tolist())]
+
+    def __repr__(self):
+        return "< TradeRange : "+ str(self._symbol)+" | "+ str(self.count())+" trades >"
+
+#--------------------------------------------------------------------------------------------------------
+
+class ExchangeRange(object):
+
+    '''Trades of many stocks over the same time range: one TradeRange per stock (see symbols and __getitem__).
+    where() filters every stock alike, and the aggregates return one value per stock, aligned with symbols, as
+    NumPy arrays (NaN where a value is undefined)'''
+
+    def __init__(self, ranges):
+        self._ranges = list(ranges)
+
+    @property
+    def symbols(self):
+        return [x.symbol for x in self._ranges]
+
+    @property
+    def ranges(self):
+        return list(self._ranges)
+
+    def __getitem__(self, symbol):
+
+        for trade_range in self._ranges:
+            if trade_range.symbol == symbol:
+                return trade_range
+        raise KeyError(symbol)
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def where(self, side=None, min_price=None, max_price=None, min_quantity=None, max_quantity=None):
+        return ExchangeRange(x.where(side, min_price, max_price, min_quantity, max_quantity) for x in self._ranges)
+
+    def _aggregate(self, name, dtype):
+        return np.array([np.nan if x is None else x for x in (getattr(r, name)() for r in self._ranges)], dtype=dtype)
+
+    def count(self):
+        return self._aggregate('count', np.int64)
+
+    def volume(self):
+        return self._aggregate('volume', np.int64)
+
+    def notional(self):
+        return self._aggregate('notional', np.float64)
+
+    def vwap(self):
+        return self._aggregate('vwap', np.float64)
+
+    def minPrice(self):
+        return self._aggregate('minPrice', np.float64)
+
+    def maxPrice(self):
+        return self._aggregate('maxPrice', np.float64)
+
+    def summary(self):
+
+        #All aggregates for every stock as one record array (see QUERY_DTYPE)
+
+        result = np.zeros(len(self._ranges), dtype=QUERY_DTYPE)
+        result['symbol'] = self.symbols
+        for name, aggregate in (('count', 'count'), ('volume', 'volume'), ('notional', 'notional'),
+                                ('vwap', 'vwap'), ('min_price', 'minPrice'), ('max_price', 'maxPrice')):
+            result[name] = self._aggregate(aggregate, result.dtype[name])
+        return result.view(np.recarray)
+
+    def __repr__(self):
+        return "< ExchangeRange : "+ str(len(self._ranges))+" stocks | "+ str(int(self.count().sum()))+" trades >"
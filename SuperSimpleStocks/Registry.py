@@ -0,0 +1,243 @@
+__author__ = 'sachi'
+
+
+'''The registry below gives every stock on an Exchange a dense integer ID (0, 1, 2, ... in order of first listing) and
+keeps the stocks' attributes in parallel NumPy arrays indexed by that ID: packed symbol code, stock type, dividends
+and par value, plus any per-stock columns the exchange adds for its own state (e.g. index terms). Exchange-wide
+calculations then index arrays instead of walking a dict of Stock objects.
+
+A symbol keeps its ID for the life of the registry: a removed stock leaves its row inactive, and the symbol gets the
+same row back if listed again. Symbols map to IDs through their packed codes (see packSymbol), so whole columns
+of symbols are resolved in one sorted search'''
+
+import numpy as np
+
+#--------------------------------------------------------------------------------------------------------
+
+#A 3-character symbol packs into one int64, 21 bits (any unicode code point) per character
+
+_CHAR_BITS = 21
+
+def packSymbol(symbol):
+    return (ord(symbol[0]) << 2 * _CHAR_BITS) | (ord(symbol[1]) << _CHAR_BITS) | ord(symbol[2])
+
+def unpackSymbol(code):
+    mask = (1 << _CHAR_BITS) - 1
+    return chr(code >> 2 * _CHAR_BITS) + chr((code >> _CHAR_BITS) & mask) + chr(code & mask)
+
+def symbolCodes(symbols):
+
+    #packSymbol over an array of symbols, vectorised. Symbols that are not 3 characters long give -1
+
+    symbols = np.asarray(symbols).reshape(-1)
+    if symbols.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    if symbols.dtype.kind != 'U':
+        symbols = symbols.astype('U')
+
+    chars = symbols.astype('U3').view(np.uint32).reshape(-1, 3).astype(np.int64)
+    codes = (chars[:, 0] << 2 * _CHAR_BITS) | (chars[:, 1] << _CHAR_BITS) | chars[:, 2]
+    return np.where(np.char.str_len(symbols) == 3, codes, -1)
+
+#--------------------------------------------------------------------------------------------------------
+
+class StockRegistry(object):
+
+    '''ID-indexed registry of an exchange's stocks. The exchange keeps it up to date (and guards it with its own
+    lock); the column properties are read-only views, one row per ID issued, to be used with `active` to
+    pick out the stocks currently listed. Stock types are held as their StockType value, a fixed dividend that is
+    not set as NaN'''
+
+    INITIAL_CAPACITY = 16
+
+    def __init__(self):
+
+        self._ids = {}
+        self._stocks = []
+        self._size = 0
+        self._columns = {}
+        self._fills = {}
+        self._lookup = None
+
+        self.addColumn('code', np.int64, -1)
+        self.addColumn('active', np.bool_, False)
+        self.addColumn('stock_type', np.int8, 0)
+        self.addColumn('last_dividend', np.float64, np.nan)
+        self.addColumn('fixed_dividend', np.float64, np.nan)
+        self.addColumn('par_value', np.float64, np.nan)
+
+    def addColumn(self, name, dtype, fill):
+
+        #A further per-stock column, with `fill` in every row until set
+
+        if name in self._columns:
+            raise ValueError("Invalid registry column : Column "+ str(name)+" already exists")
+        capacity = len(self._columns['code']) if self._columns else self.INITIAL_CAPACITY
+        self._columns[name] = np.full(capacity, fill, dtype=dtype)
+        self._fills[name] = fill
+
+    def column(self, name):
+
+        #Writable view of a column, one row per ID issued
+
+        return self._columns[name][:self._size]
+
+    def _view(self, name):
+        view = self._columns[name][:self._size]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def codes(self):
+        return self._view('code')
+
+    @property
+    def active(self):
+        return self._view('active')
+
+    @property
+    def stock_types(self):
+        return self._view('stock_type')
+
+    @property
+    def last_dividends(self):
+        return self._view('last_dividend')
+
+    @property
+    def fixed_dividends(self):
+        return self._view('fixed_dividend')
+
+    @property
+    def par_values(self):
+        return self._view('par_value')
+
+    @property
+    def symbols(self):
+        return np.array([unpackSymbol(int(x)) for x in self._columns['code'][:self._size]], dtype='U3')
+
+    @property
+    def ids(self):
+
+        #IDs of the stocks currently listed, in ID order
+
+        return np.flatnonzero(self._columns['active'][:self._size])
+
+    def __len__(self):
+
+        #Number of IDs issued, listed or not
+
+        return self._size
+
+#--------------------------------------------------------------------------------------------------------
+
+    def register(self, stock):
+
+        '''List `stock` (replacing any stock with the same symbol) and return its ID'''
+
+        stock_id = self._ids.get(stock.symbol)
+        if stock_id is None:
+            stock_id = self._size
+            if stock_id == len(self._columns['code']):
+                for name, column in self._columns.items():
+                    grown = np.full(2 * len(column), self._fills[name], dtype=column.dtype)
+                    grown[:stock_id] = column[:stock_id]
+                    self._columns[name] = grown
+            self._ids[stock.symbol] = stock_id
+            self._stocks.append(None)
+            self._size += 1
+            self._columns['code'][stock_id] = packSymbol(stock.symbol)
+
+        self._stocks[stock_id] = stock
+        self._columns['active'][stock_id] = True
+        self.update(stock)
+        return stock_id
+
+    def unregister(self, stock):
+
+        #Mark the stock's row inactive, if `stock` is the one listed
+
+        stock_id = self.find(stock)
+        if stock_id is not None:
+            self._stocks[stock_id] = None
+            self._columns['active'][stock_id] = False
+        return stock_id
+
+    def update(self, stock):
+
+        #Copy the stock's attributes into its row, e.g. after a change of dividend
+
+        stock_id = self.find(stock)
+        if stock_id is not None:
+            self._columns['stock_type'][stock_id] = stock.stock_type.value
+            self._columns['last_dividend'][stock_id] = stock.last_dividend
+            self._columns['fixed_dividend'][stock_id] = np.nan if stock.fixed_dividend is None else stock.fixed_dividend
+            self._columns['par_value'][stock_id] = stock.par_value
+
+#--------------------------------------------------------------------------------------------------------
+
+    def find(self, stock):
+
+        #ID of `stock` if it is the stock listed under its symbol, else None
+
+        stock_id = self._ids.get(stock.symbol)
+        if stock_id is not None and self._stocks[stock_id] is stock:
+            return stock_id
+        return None
+
+    def idOf(self, symbol):
+
+        stock_id = self._ids.get(symbol)
+        if stock_id is not None and self._stocks[stock_id] is not None:
+            return stock_id
+        raise ValueError("Invalid stock reference, no stocks found matching symbol "+ str(symbol)+")")
+
+    def stock(self, stock_id):
+
+        if 0 <= stock_id < self._size and self._stocks[stock_id] is not None:
+            return self._stocks[stock_id]
+        raise ValueError("Invalid stock reference, no stocks listed with ID "+ str(stock_id)+")")
+
+    def idsOf(self, symbols):
+
+        '''IDs of the listed stocks with the given symbols, as an int64 array, found by a sorted search over the
+        packed symbol codes. Integer arrays are taken as IDs already and only checked. Raises ValueError naming the
+        first symbol (or ID) not listed'''
+
+        symbols = np.asarray(symbols)
+        if symbols.dtype.kind in 'iu':
+            ids = symbols.astype(np.int64).reshape(-1)
+            listed = (ids >= 0) & (ids < self._size)
+            listed[listed] = self._columns['active'][ids[listed]]
+            if not np.all(listed):
+                raise ValueError("Invalid stock reference, no stocks listed with ID "+ str(ids[np.argmin(listed)])+")")
+            return ids
+
+        #The sorted codes are rebuilt whenever IDs have been issued since they were last sorted
+        lookup = self._lookup
+        if lookup is None or lookup[0] != self._size:
+            size = self._size
+            codes = self._columns['code'][:size]
+            order = np.argsort(codes)
+            lookup = self._lookup = (size, codes[order], order)
+
+        codes = symbolCodes(symbols)
+        size, sorted_codes, order = lookup
+        position = np.minimum(np.searchsorted(sorted_codes, codes), max(len(sorted_codes) - 1, 0))
+        if len(sorted_codes) == 0:
+            found = np.zeros(len(codes), dtype=bool)
+            ids = np.zeros(len(codes), dtype=np.int64)
+        else:
+            found = sorted_codes[position] == codes
+            ids = order[position].astype(np.int64)
+            found &= self._columns['active'][ids]
+
+        if not np.all(found):
+            raise ValueError("Invalid stock reference, no stocks found matching symbol "+ \
+                             str(symbols.reshape(-1)[np.argmin(found)])+")")
+        return ids
+
+    def stocksOf(self, stock_ids):
+
+        #Stock objects for an array of IDs
+
+        return [self.stock(int(x)) for x in stock_ids]
@@ -0,0 +1,392 @@
+__author__ = 'sachi'
+
+
+'''The segment store below is the cold tier of a stock's trade history. With a retention horizon set, a stock keeps
+only its recent trades in memory (see Stock.retention); given a SegmentStore, the trades it evicts are kept in the
+store instead of being dropped. Evicted trades are staged in memory until they reach `segment_trades` trades or span
+`segment_span`, and are then sealed into an immutable segment file: a NumPy .npy file of fixed-width records
+(SEGMENT_DTYPE) sorted by timestamp. Sealing runs on a background writer thread shared by all stores, so eviction
+(and with it addTrade) only copies the evicted rows. Each sealed segment's summary (time range, count, volume,
+notional, min/max price) is appended as one line to the index file, segments.jsonl, next to the segments.
+
+Segments are memory-mapped read-only when a query needs them, so the operating system pages in only what is read.
+The summaries are held in memory as columns sorted by first timestamp, with running totals and the running latest
+last timestamp, so a query over a time range finds the segments it covers by bisection: those wholly inside are
+answered from the running totals, and only the (usually two) segments its ends fall in are read. Staged trades
+are included in every query. Segments may overlap in time when late trades arrive after older ones were sealed,
+which changes nothing for aggregates; trades read back across segments are sorted by timestamp.
+
+Resident memory is bounded by the staged trades (at most one segment's worth) and the summaries. Staged trades
+are only in memory until sealed: call flush (e.g. through Exchange.close) before shutting down'''
+
+import json
+import os
+import queue
+import threading
+
+from collections import OrderedDict
+from datetime import timedelta
+
+import numpy as np
+
+from SuperSimpleStocks.Query import TradeRange
+from SuperSimpleStocks.TradeStore import TRADE_RECORD_DTYPE
+
+#--------------------------------------------------------------------------------------------------------
+
+SEGMENT_DTYPE = TRADE_RECORD_DTYPE
+SEGMENTS_FILE = 'segments.jsonl'
+
+#Summaries of sealed segments, one row per segment
+INDEX_DTYPE = np.dtype([('sequence', np.int64), ('first', np.int64), ('last', np.int64), ('count', np.int64),
+                        ('volume', np.int64), ('notional', np.float64), ('min_price', np.float64),
+                        ('max_price', np.float64)])
+
+def _summarise(records):
+    return {'first': int(records['timestamp'][0]), 'last': int(records['timestamp'][-1]), 'count': len(records),
+            'volume': int(records['quantity'].sum()), 'notional': float(np.dot(records['price'], records['quantity'])),
+            'min_price': float(records['price'].min()), 'max_price': float(records['price'].max())}
+
+def _sortedRecords(records):
+    if len(records) > 1 and np.any(records['timestamp'][1:] < records['timestamp'][:-1]):
+        return records[np.argsort(records['timestamp'], kind='stable')]
+    return records
+
+def _slice(records, start, end):
+
+    #Rows of sorted records in [start, end), epoch ns with None for open ends
+
+    timestamps = records['timestamp']
+    first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+    stop = len(records) if end is None else int(np.searchsorted(timestamps, end, side='left'))
+    return records[first:max(first, stop)]
+
+#--------------------------------------------------------------------------------------------------------
+
+class _SegmentIndex(object):
+
+    '''Segment summaries sorted by first timestamp, with running totals (count and volume, and notional, one more
+    row than segments) and the running latest last timestamp. Arrays are only written in place past the rows
+    already published, or replaced, so a snapshot taken under the store's lock can be read without it'''
+
+    def __init__(self):
+
+        self._size = 0
+        self._rows = np.zeros(16, dtype=INDEX_DTYPE)
+        self._latest = np.zeros(16, dtype=np.int64)
+        self._totals = np.zeros((17, 2), dtype=np.int64)
+        self._notionals = np.zeros(17, dtype=np.float64)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, summary):
+
+        size, rows = self._size, self._rows
+        row = tuple(summary[x] for x in INDEX_DTYPE.names)
+
+        if size == 0 or summary['first'] >= rows['first'][size - 1]:
+            if size == len(rows):
+                self._rows, self._latest = np.resize(rows, 2 * size), np.resize(self._latest, 2 * size)
+                self._totals = np.resize(self._totals, (2 * size + 1, 2))
+                self._notionals = np.resize(self._notionals, 2 * size + 1)
+            self._rows[size] = row
+            self._latest[size] = summary['last'] if size == 0 else max(self._latest[size - 1], summary['last'])
+            self._totals[size + 1] = self._totals[size] + (summary['count'], summary['volume'])
+            self._notionals[size + 1] = self._notionals[size] + summary['notional']
+            self._size = size + 1
+        else:
+            #A late segment starts before the latest one: rebuild (rare, and only on the writer thread)
+            rows = np.sort(np.append(rows[:size], np.array([row], dtype=INDEX_DTYPE)), order='first', kind='stable')
+            self._rows = rows
+            self._latest = np.maximum.accumulate(rows['last'])
+            self._totals = np.zeros((len(rows) + 1, 2), dtype=np.int64)
+            self._totals[1:] = np.cumsum(np.column_stack((rows['count'], rows['volume'])), axis=0)
+            self._notionals = np.concatenate(([0.0], np.cumsum(rows['notional'])))
+            self._size = len(rows)
+
+    def snapshot(self):
+        size = self._size
+        return self._rows[:size], self._latest[:size], self._totals[:size + 1], self._notionals[:size + 1]
+
+#--------------------------------------------------------------------------------------------------------
+
+class _SegmentWriter(object):
+
+    '''The background thread sealing segments for every store. At most `max_queued` segments wait to be
+    written; beyond that, eviction waits for the writer (so memory stays bounded if the disk falls behind)'''
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_queued=8):
+        self._queue = queue.Queue(max_queued)
+        self._thread = threading.Thread(target=self._run, name='segment-writer', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def shared(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = _SegmentWriter()
+            return cls._instance
+
+    def submit(self, store, records):
+        self._queue.put((store, records))
+
+    def _run(self):
+        while True:
+            store, records = self._queue.get()
+            store._write(records)
+
+#--------------------------------------------------------------------------------------------------------
+
+class SegmentStore(object):
+
+    '''Trade segments of one stock in `directory` (created if needed; segments already there are picked up, so
+    history survives restarts). Staged trades are sealed into a segment once they reach `segment_trades` trades or
+    span `segment_span`. At most `open_segments` segments stay mapped at a time'''
+
+    def __init__(self, directory, segment_trades=1 << 18, segment_span=timedelta(hours=1), open_segments=16):
+
+        if type(segment_trades) is not int or segment_trades <= 0:
+            raise ValueError("Invalid segment size : Requiring positive integer (got "+ str(segment_trades)+")")
+        elif type(segment_span) is not timedelta or segment_span <= timedelta(0):
+            raise ValueError("Invalid segment span : Requiring positive timedelta (got "+ str(segment_span)+")")
+        elif type(open_segments) is not int or open_segments <= 0:
+            raise ValueError("Invalid open segment count : Requiring positive integer (got "+ str(open_segments)+")")
+
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._segment_trades = segment_trades
+        self._segment_span = segment_span // timedelta(microseconds=1) * 1000
+        self._open_segments = open_segments
+        self._mapped = OrderedDict()
+
+        #Staged trades (sorted blocks, as evicted), segments queued for the writer and segments it failed to write
+        #(see last_error, retried by flush), all still in memory
+        self._staged = []
+        self._staged_count = 0
+        self._sealing = []
+        self._failed = []
+        self._lock = threading.Lock()
+        self._sealed = threading.Condition(self._lock)
+        self.last_error = None
+
+        self._index = _SegmentIndex()
+        self._sequence = 0
+        path = os.path.join(directory, SEGMENTS_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        summary = json.loads(line)
+                    except ValueError:
+                        continue    #A line cut short by a crash while appending
+                    self._index.add(summary)
+                    self._sequence = max(self._sequence, summary['sequence'] + 1)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def segments(self):
+
+        #Summaries of the sealed segments, by first timestamp: file, sequence, first and last timestamp (epoch ns),
+        #count, volume, notional, min_price and max_price
+
+        rows = self._index.snapshot()[0]
+        return [dict(zip(INDEX_DTYPE.names, x), file=self._fileName(x[0])) for x in rows.tolist()]
+
+    def __len__(self):
+
+        #Number of trades held, sealed or not
+
+        with self._lock:
+            totals = self._index.snapshot()[2]
+            return int(totals[-1, 0]) + self._staged_count + sum(len(x) for x in self._sealing + self._failed)
+
+    @staticmethod
+    def _fileName(sequence):
+        return 'segment-%08d.npy' % sequence
+
+#--------------------------------------------------------------------------------------------------------
+
+    def add(self, timestamps, share_quantities, sides, trade_prices):
+
+        '''Stage trades (storage form, sorted by timestamp), e.g. those just evicted from a stock. They are copied,
+        and handed to the writer once a segment's worth is staged'''
+
+        count = len(timestamps)
+        if count == 0:
+            return
+
+        records = np.empty(count, dtype=SEGMENT_DTYPE)
+        records['timestamp'] = timestamps
+        records['quantity'] = share_quantities
+        records['price'] = trade_prices
+        records['side'] = sides
+
+        with self._lock:
+            self._staged.append(records)
+            self._staged_count += count
+            full = self._staged_count >= self._segment_trades or \
+                   int(records['timestamp'][-1]) - int(self._staged[0]['timestamp'][0]) >= self._segment_span
+            records = self._takeStaged() if full else None
+        if records is not None:
+            _SegmentWriter.shared().submit(self, records)
+
+    def _takeStaged(self):
+
+        #Called with the lock held: the staged trades as one sorted block, moved to the segments being sealed
+
+        records = _sortedRecords(np.concatenate(self._staged))
+        self._staged, self._staged_count = [], 0
+        self._sealing.append(records)
+        return records
+
+    def flush(self):
+
+        '''Seal whatever is staged (retrying segments that failed to be written) and wait until every segment handed
+        to the writer has been written or has failed again'''
+
+        with self._lock:
+            retry, self._failed = self._failed, []
+            self._sealing.extend(retry)
+            if self._staged:
+                retry.append(self._takeStaged())
+        for records in retry:
+            _SegmentWriter.shared().submit(self, records)
+        with self._lock:
+            while self._sealing:
+                self._sealed.wait()
+
+    def _write(self, records):
+
+        #Writer thread: the segment file is complete on disk before its summary is appended to the index, so a crash
+        #leaves at worst an unused file. On failure the trades stay in memory (and queryable), see last_error
+
+        try:
+            with self._lock:
+                sequence = self._sequence
+                self._sequence += 1
+
+            summary = dict(_summarise(records), sequence=sequence)
+            path = os.path.join(self._directory, self._fileName(sequence))
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, records)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+            with open(os.path.join(self._directory, SEGMENTS_FILE), 'a') as f:
+                f.write(json.dumps(summary) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as error:
+            summary = None
+            self.last_error = error
+
+        with self._lock:
+            if summary is None:
+                self._failed.append(records)
+            else:
+                self._index.add(summary)
+            self._sealing = [x for x in self._sealing if x is not records]
+            self._sealed.notify_all()
+
+    def _records(self, sequence):
+
+        #A segment's records, memory-mapped read-only. Least recently used mappings are released past the limit
+
+        records = self._mapped.pop(sequence, None)
+        if records is None:
+            records = np.load(os.path.join(self._directory, self._fileName(sequence)), mmap_mode='r')
+        self._mapped[sequence] = records
+        while len(self._mapped) > self._open_segments:
+            self._mapped.popitem(last=False)
+        return records
+
+#--------------------------------------------------------------------------------------------------------
+
+    def _plan(self, start, end):
+
+        '''Which segments a query over [start, end) needs: the range of rows wholly inside it (answered from the
+        running totals), the other rows overlapping it (to be read), and the blocks still in memory'''
+
+        with self._lock:
+            rows, latest, totals, notionals = self._index.snapshot()
+            in_memory = self._staged + self._sealing + self._failed
+
+        first = rows['first']
+        stop = len(rows) if end is None else int(np.searchsorted(first, end, side='left'))
+        begin = 0 if start is None else int(np.searchsorted(latest, start, side='left'))
+
+        #Rows from `inside` start at or after `start`; rows before `outside` all end before `end`
+        inside = begin if start is None else max(begin, int(np.searchsorted(first, start, side='left')))
+        outside = stop if end is None else min(stop, int(np.searchsorted(latest, end, side='left')))
+        if outside < inside:
+            outside = inside
+
+        partial = [x for x in list(range(begin, min(inside, stop))) + list(range(outside, stop))
+                   if start is None or rows['last'][x] >= start]
+        return rows, (totals, notionals), (inside, outside), partial, in_memory
+
+    def summary(self, start=None, end=None):
+
+        '''Count, volume, notional and min/max price of the stored trades in [start, end) (epoch ns, None for open
+        ends), as a dict. Segments wholly inside the range are answered from the running totals of their summaries,
+        only those the ends fall in are read'''
+
+        rows, (totals, notionals), (inside, outside), partial, in_memory = self._plan(start, end)
+
+        parts = []
+        if outside > inside:
+            count, volume = (totals[outside] - totals[inside]).tolist()
+            parts.append({'count': count, 'volume': volume, 'notional': float(notionals[outside] - notionals[inside]),
+                          'min_price': float(rows['min_price'][inside:outside].min()),
+                          'max_price': float(rows['max_price'][inside:outside].max())})
+        for x in partial:
+            if (start is None or rows['first'][x] >= start) and (end is None or rows['last'][x] < end):
+                parts.append(dict(zip(INDEX_DTYPE.names, rows[x].tolist())))
+            else:
+                records = _slice(self._records(int(rows['sequence'][x])), start, end)
+                if len(records):
+                    parts.append(_summarise(records))
+        for block in in_memory:
+            records = _slice(block, start, end)
+            if len(records):
+                parts.append(_summarise(records))
+
+        result = {'count': 0, 'volume': 0, 'notional': 0.0, 'min_price': None, 'max_price': None}
+        for part in parts:
+            result['count'] += part['count']
+            result['volume'] += part['volume']
+            result['notional'] += part['notional']
+            result['min_price'] = part['min_price'] if result['min_price'] is None else \
+                                  min(result['min_price'], part['min_price'])
+            result['max_price'] = part['max_price'] if result['max_price'] is None else \
+                                  max(result['max_price'], part['max_price'])
+        return result
+
+    def query(self, symbol, start=None, end=None):
+
+        '''The stored trades in [start, end) as a TradeRange. Within one segment the columns are views of the
+        mapped file; spanning several (or staged trades), they are gathered (and sorted, if segments overlap) into
+        memory'''
+
+        rows, totals, (inside, outside), partial, in_memory = self._plan(start, end)
+
+        positions = sorted(set(range(inside, outside)) | set(partial))
+        parts = [_slice(self._records(int(rows['sequence'][x])), start, end) for x in positions]
+        parts += [_slice(x, start, end) for x in in_memory]
+        parts = [x for x in parts if len(x)]
+        if len(parts) == 1:
+            records = parts[0]
+        elif parts:
+            records = _sortedRecords(np.concatenate(parts))
+        else:
+            records = np.zeros(0, dtype=SEGMENT_DTYPE)
+
+        return TradeRange(symbol, records['timestamp'], records['quantity'], records['side'], records['price'])
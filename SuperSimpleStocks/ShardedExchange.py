@@ -0,0 +1,670 @@
+__author__ = 'sachi'
+
+
+'''The sharded exchange below spreads stocks over a pool of worker processes, so that ingestion is not bound by one
+interpreter's GIL. Each worker runs an ordinary Exchange over the stocks assigned to it (by a stable hash of the
+symbol), and the front-end mirrors the Exchange API: addStock/getStock/removeStock, ingest, snapshot and
+GBCEAllShareIndex.
+
+Trade batches are handed to the workers through one shared memory block per shard: the front-end validates a batch,
+splits it by shard and writes each part's columns into that shard's block, and only a short message (block name and
+row count) goes down the pipe; all shards then merge their parts in parallel. Cross-shard queries combine per-shard
+partial results, e.g. the index from each shard's (log_sum, term_count, zero_terms).
+
+The workers keep each stock's trade columns in a shared memory block of their own (see _SharedTradeStore), so the
+front-end reads a stock's trades by mapping that block read-only rather than having them pickled through the pipe.
+
+Stocks held by the workers are reached through ShardedStock handles, which forward each call to the owning shard.
+Each shard's pipe carries one request at a time, under a lock of its own, so calls from several threads that reach
+different shards run concurrently'''
+
+import multiprocessing
+import threading
+import weakref
+import zlib
+
+from contextlib import ExitStack
+
+from datetime import timedelta
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from SuperSimpleStocks.Exchange import Exchange, IndexBasis, SNAPSHOT_DTYPE, combineIndexPartials
+from SuperSimpleStocks.Stock import Stock, NO_LOCK
+from SuperSimpleStocks.Trade import Trade
+from SuperSimpleStocks.TradeStore import TradeStore, TradeSequence, tradeColumns
+
+#--------------------------------------------------------------------------------------------------------
+
+#Layout of a batch in a shard's shared memory block: each column stored contiguously, widest first so every column
+#stays aligned. Codes identify the stock within its shard
+
+_BATCH_COLUMNS = (np.int64, np.int64, np.float64, np.int32, np.int8)
+_BATCH_ROW_BYTES = sum(np.dtype(x).itemsize for x in _BATCH_COLUMNS)
+
+def _batchViews(buffer, count):
+
+    #Timestamp, quantity, price, code and side columns of a `count`-row batch held in `buffer`
+
+    views, offset = [], 0
+    for dtype in _BATCH_COLUMNS:
+        views.append(np.ndarray(count, dtype=dtype, buffer=buffer, offset=offset))
+        offset += count * np.dtype(dtype).itemsize
+    return views
+
+#Layout of a trade store in a shared memory block: the TradeStore columns for `capacity` rows (prefix sums for one
+#more), widest first
+
+_STORE_COLUMNS = (('timestamps', np.int64, 0), ('quantities', np.int64, 0), ('prices', np.float64, 0),
+                  ('cum_quantities', np.int64, 1), ('cum_notionals', np.float64, 1), ('sides', np.int8, 0))
+
+def _storeViews(block, capacity):
+
+    #TradeStore columns (by name) of a `capacity`-row store held in a shared memory block. The columns are views of
+    #one root array, and the block is closed once the last array over it is gone, so any view handed out stays valid
+    #after the block is unlinked or replaced
+
+    root = np.ndarray(block.size, dtype=np.uint8, buffer=block.buf)
+    weakref.finalize(root, block.close)
+
+    views, offset = {}, 0
+    for name, dtype, extra in _STORE_COLUMNS:
+        views[name] = np.ndarray(capacity + extra, dtype=dtype, buffer=root, offset=offset)
+        offset += (capacity + extra) * np.dtype(dtype).itemsize
+    return views
+
+def _storeBytes(capacity):
+    return sum((capacity + extra) * np.dtype(dtype).itemsize for name, dtype, extra in _STORE_COLUMNS)
+
+class _SharedTradeStore(TradeStore):
+
+    '''Worker-side trade store whose columns live in a shared memory block (see layout). When the columns are
+    reallocated the store moves to a new block and unlinks the old one'''
+
+    def _allocate(self, capacity):
+        self._block = shared_memory.SharedMemory(create=True, size=max(_storeBytes(capacity), 1))
+        views = _storeViews(self._block, capacity)
+        return tuple(views[x] for x in ('timestamps', 'quantities', 'prices', 'sides', 'cum_quantities',
+                                        'cum_notionals'))
+
+    def _reserve(self, count):
+        block = self._block
+        TradeStore._reserve(self, count)
+        if self._block is not block:
+            block.unlink()
+
+    def layout(self):
+
+        #Where the front-end finds the live trades: block name, capacity and the live rows (head, size)
+
+        self._flush()
+        return self._block.name, self.capacity, self._head, self._size
+
+    def close(self):
+        self._timestamps = self._quantities = self._prices = self._sides = None
+        self._cum_quantities = self._cum_notionals = None
+        self._block.unlink()
+
+#--------------------------------------------------------------------------------------------------------
+
+class _Shard(object):
+
+    #State of one worker process: an Exchange over the shard's stocks, and the stocks by code. Each method is a
+    #command the front-end can send
+
+    def __init__(self, index_basis, retention, rollup_interval):
+        self._exchange = Exchange(index_basis=index_basis, retention=retention, rollup_interval=rollup_interval)
+        self._stocks = {}
+        self._buffer = None
+
+    def close(self):
+        self._exchange.close()
+        if self._buffer is not None:
+            self._buffer.close()
+        for stock in self._stocks.values():
+            stock._trade_store.close()
+
+    def addStock(self, code, definition, columns):
+        stock = Stock(*definition)
+        stock._trade_store = _SharedTradeStore()
+        if columns is not None:
+            stock._addValidatedTrades(*columns)
+        replaced = self._stocks.get(code)
+        self._exchange.addStock(stock)
+        self._stocks[code] = stock
+        if replaced is not None:
+            replaced._trade_store.close()
+
+    def removeStock(self, code):
+        stock = self._stocks.pop(code)
+        self._exchange.removeStock(stock.symbol)
+        stock._trade_store.close()
+
+    def getAttribute(self, code, name):
+        return getattr(self._stocks[code], name)
+
+    def setAttribute(self, code, name, value):
+        setattr(self._stocks[code], name, value)
+
+    def call(self, code, name, args):
+        return getattr(self._stocks[code], name)(*args)
+
+    def tradeLayout(self, code):
+        return self._stocks[code]._trade_store.layout()
+
+    def setExchangeAttribute(self, name, value):
+        setattr(self._exchange, name, value)
+
+    def ingest(self, buffer_name, count):
+
+        #Merge a batch the front-end wrote to shared memory. The block is only replaced when the front-end needs a
+        #bigger one, so it is attached once and reused
+
+        if self._buffer is None or self._buffer.name != buffer_name:
+            if self._buffer is not None:
+                self._buffer.close()
+            self._buffer = shared_memory.SharedMemory(name=buffer_name)
+
+        timestamps, quantities, prices, codes, sides = _batchViews(self._buffer.buf, count)
+
+        codes_held = np.unique(codes)
+        order = np.lexsort((timestamps, codes))
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(np.searchsorted(codes_held, codes)))))
+        columns = [x[order] for x in (timestamps, quantities, sides, prices)]
+
+        for i, code in enumerate(codes_held.tolist()):
+            group = slice(bounds[i], bounds[i + 1])
+            self._stocks[code]._addValidatedTrades(*(x[group] for x in columns))
+
+    def snapshot(self, window, market_prices, symbols, as_of):
+        return np.asarray(self._exchange.snapshot(window, market_prices, symbols, as_of))
+
+    def indexPartial(self):
+        return self._exchange.indexPartial()
+
+    def describe(self, limit):
+        return len(self._stocks), [str(x) for x in list(self._stocks.values())[:limit]]
+
+def _serveShard(connection, index_basis, retention, rollup_interval):
+
+    #Worker process main loop: run commands from the front-end until told to close (or the pipe closes), replying
+    #with ('ok', result) or ('error', exception) so errors surface in the caller
+
+    shard = _Shard(index_basis, retention, rollup_interval)
+    while True:
+        try:
+            command, args = connection.recv()
+        except EOFError:
+            break
+        if command == 'close':
+            break
+
+        try:
+            reply = ('ok', getattr(shard, command)(*args))
+        except Exception as e:
+            reply = ('error', e)
+
+        try:
+            connection.send(reply)
+        except Exception as e:
+            connection.send(('error', RuntimeError("Shard reply could not be sent : "+ repr(e))))
+
+    shard.close()
+
+def _shutdown(connections, processes, buffers, mapped):
+
+    #Stop the workers and release the shared memory blocks; runs on close() or when the front-end is collected
+
+    mapped.clear()
+
+    for connection in connections:
+        try:
+            connection.send(('close', ()))
+        except (OSError, ValueError):
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    for connection in connections:
+        connection.close()
+    for i, buffer in enumerate(buffers):
+        if buffer is not None:
+            buffer.close()
+            buffer.unlink()
+            buffers[i] = None
+
+#--------------------------------------------------------------------------------------------------------
+
+class ShardedExchange(object):
+
+    '''Exchange whose stocks live in `shards` worker processes (default: one per CPU). Each call fans out to the
+    shards involved, which work in parallel; calls from several threads only wait for each other on the shards
+    they share.
+    `start_method` picks the multiprocessing start method (platform default when None). Call close(), or use the
+    exchange as a context manager, to stop the workers'''
+
+    def __init__(self, shards=None, index_basis=IndexBasis.ParValue, retention=None, rollup_interval=None,
+                 start_method=None):
+
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+        if type(shards) is not int:
+            raise TypeError("Invalid type for shard count : Requiring positive integer (got "+ str(type(shards))+")")
+        elif shards < 1:
+            raise ValueError("Invalid shard count : Requiring positive integer (got "+ str(shards)+")")
+        if type(index_basis) is not IndexBasis:
+            raise TypeError("Invalid index basis : Requiring IndexBasis object (got "+ str(type(index_basis))+")")
+
+        self._index_basis = index_basis
+        self._retention = Stock.validateInterval(retention, "retention horizon")
+        self._rollup_interval = Stock.validateInterval(rollup_interval, "rollup interval")
+
+        #Registry: symbol -> (shard, code), in the order stocks were added, guarded by _lock. Each shard's pipe (and
+        #batch block) is guarded by its own lock, always taken after _lock and in shard order
+        self._lock = threading.RLock()
+        self._shard_locks = [threading.RLock() for x in range(shards)]
+        self._symbols = {}
+        self._next_codes = [0] * shards
+
+        #Trade store blocks mapped from the workers: symbol -> (block name, column views), guarded by _mapped_lock,
+        #taken last
+        self._mapped = {}
+        self._mapped_lock = threading.Lock()
+
+        #Workers must share the front-end's resource tracker: one of their own would unlink the shared memory
+        #blocks as soon as the worker exits
+        resource_tracker.ensure_running()
+        context = multiprocessing.get_context(start_method)
+        self._connections, self._processes = [], []
+        self._buffers = [None] * shards
+        self._finalizer = weakref.finalize(self, _shutdown, self._connections, self._processes, self._buffers,
+                                           self._mapped)
+
+        for x in range(shards):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=_serveShard, daemon=True,
+                                      args=(worker_connection, index_basis, retention, rollup_interval))
+            process.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+#--------------------------------------------------------------------------------------------------------
+
+    @property
+    def shards(self):
+        return len(self._connections)
+
+    def shardOf(self, stock_symbol):
+
+        #Stable (process-independent) assignment of a symbol to a shard
+
+        return zlib.crc32(stock_symbol.encode()) % len(self._connections)
+
+    def close(self):
+        with self._lock, self._holding(range(self.shards)), self._mapped_lock:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Requests to the workers. Several shards are always sent their commands before any reply is awaited, so they
+    #run concurrently; every reply is collected before an error is raised, to keep the pipes in step. Callers hold
+    #the locks of the shards they talk to (see _holding)
+
+    def _holding(self, shards):
+
+        #Context holding the locks of `shards`, taken in shard order
+
+        stack = ExitStack()
+        for shard in sorted(shards):
+            stack.enter_context(self._shard_locks[shard])
+        return stack
+
+    def _send(self, shard, command, *args):
+        if not self._finalizer.alive:
+            raise ValueError("Invalid operation, sharded exchange is closed")
+        self._connections[shard].send((command, args))
+
+    def _receive(self, shard):
+        return self._connections[shard].recv()
+
+    def _request(self, shard, command, *args):
+        with self._shard_locks[shard]:
+            self._send(shard, command, *args)
+            return self._result([self._receive(shard)])[0]
+
+    def _broadcast(self, command, arguments):
+
+        #Send command(*arguments[shard]) to each shard in `arguments` (a dict), returning {shard: result}
+
+        with self._holding(arguments):
+            for shard, args in arguments.items():
+                self._send(shard, command, *args)
+            replies = [self._receive(shard) for shard in arguments]
+            return dict(zip(arguments, self._result(replies)))
+
+    @staticmethod
+    def _result(replies):
+        for status, value in replies:
+            if status == 'error':
+                raise value
+        return [x[1] for x in replies]
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Exchange-wide settings, applied by every shard's Exchange
+
+    @property
+    def index_basis(self):
+        return self._index_basis
+
+    @index_basis.setter
+    def index_basis(self, index_basis):
+
+        if type(index_basis) is IndexBasis:
+            self._broadcast('setExchangeAttribute', {x: ('index_basis', index_basis) for x in range(self.shards)})
+            self._index_basis = index_basis
+        else:
+            raise TypeError("Invalid index basis : Requiring IndexBasis object (got "+ str(type(index_basis))+")")
+
+    @property
+    def retention(self):
+        return self._retention
+
+    @retention.setter
+    def retention(self, retention):
+        self._retention = Stock.validateInterval(retention, "retention horizon")
+        self._broadcast('setExchangeAttribute', {x: ('retention', retention) for x in range(self.shards)})
+
+    @property
+    def rollup_interval(self):
+        return self._rollup_interval
+
+    @rollup_interval.setter
+    def rollup_interval(self, rollup_interval):
+        self._rollup_interval = Stock.validateInterval(rollup_interval, "rollup interval")
+        self._broadcast('setExchangeAttribute', {x: ('rollup_interval', rollup_interval) for x in range(self.shards)})
+
+#--------------------------------------------------------------------------------------------------------
+
+    @property
+    def stocks(self):
+        with self._lock:
+            return {x: ShardedStock(self, x) for x in self._symbols}
+
+    def addStock(self, stock):
+
+        '''Hand a stock (definition, settings and any trades it already holds) to its shard. The Stock object itself
+        stays with the caller and is not updated afterwards; use getStock for a handle on the shard's copy'''
+
+        if type(stock) is not Stock:
+            raise TypeError("Incorrectly Formatted Stock : Requiring Stock object (got "+ str(type(stock))+")")
+
+        with stock.lock:
+            definition = (stock.symbol, stock.stock_type, stock.last_dividend, stock.par_value, stock.fixed_dividend,
+                          stock.retention, stock.rollup_interval)
+            store = stock._trade_store
+            columns = (store.timestamps.copy(), store.quantities.copy(), store.sides.copy(), store.prices.copy()) \
+                      if len(store) else None
+
+        with self._lock:
+            shard, code = self._symbols.get(stock.symbol, (self.shardOf(stock.symbol), None))
+            if code is None:
+                code = self._next_codes[shard]
+                self._next_codes[shard] += 1
+            self._request(shard, 'addStock', code, definition, columns)
+            self._symbols[stock.symbol] = (shard, code)
+
+    def removeStock(self, stock_symbol):
+
+        with self._lock:
+            shard, code = self._locate(stock_symbol)
+            self._request(shard, 'removeStock', code)
+            del self._symbols[stock_symbol]
+            with self._mapped_lock:
+                self._mapped.pop(stock_symbol, None)
+
+    def getStock(self, stock_symbol):
+        self._locate(stock_symbol)
+        return ShardedStock(self, stock_symbol)
+
+    def _locate(self, stock_symbol):
+
+        location = self._symbols.get(stock_symbol)
+        if location is not None:
+            return location
+        else:
+            raise ValueError("Invalid stock reference, no stocks found matching symbol "+ str(stock_symbol)+")")
+
+#--------------------------------------------------------------------------------------------------------
+
+    def ingest(self, symbols, timestamps=None, share_quantities=None, trade_types=None, trade_prices=None):
+
+        '''Bulk trade ingestion, taking the same arguments as Exchange.ingest. The batch is validated here in one
+        vectorised pass and every symbol is checked before anything is sent; the shards then sort and merge their
+        parts of the batch in parallel'''
+
+        if timestamps is None and share_quantities is None and trade_types is None and trade_prices is None:
+            rows = list(symbols)
+            if not rows:
+                return
+            symbols, timestamps, share_quantities, trade_types, trade_prices = zip(*rows)
+
+        columns = tradeColumns(timestamps, share_quantities, trade_types, trade_prices)
+
+        symbols = np.asarray(symbols)
+        if len(symbols) != len(columns[0]):
+            raise ValueError("Mismatched trade columns : Requiring one symbol per trade (got "+ str(len(symbols))+ \
+                             " symbols for "+ str(len(columns[0]))+" trades)")
+        if len(symbols) == 0:
+            return
+
+        unique_symbols, symbol_index = np.unique(symbols, return_inverse=True)
+        with self._lock:
+            locations = np.array([self._locate(str(x)) for x in unique_symbols], dtype=np.int64).reshape(-1, 2)
+        self._dispatch(locations[symbol_index, 0], locations[symbol_index, 1], *columns)
+
+    def _dispatch(self, shards, codes, timestamps, share_quantities, sides, trade_prices):
+
+        #Write each shard's rows into its shared memory block (growing it as needed), then let all shards merge.
+        #The shards' locks are held throughout, since their blocks are reused by the next batch
+
+        order = np.argsort(shards, kind='stable')
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(shards, minlength=self.shards))))
+        involved = [x for x in range(self.shards) if bounds[x + 1] > bounds[x]]
+
+        with self._holding(involved):
+            arguments = {}
+            for shard in involved:
+                self._writeBatch(shard, order[bounds[shard]:bounds[shard + 1]], codes, timestamps, share_quantities,
+                                 sides, trade_prices, arguments)
+            self._broadcast('ingest', arguments)
+
+    def _writeBatch(self, shard, rows, codes, timestamps, share_quantities, sides, trade_prices, arguments):
+
+        count = len(rows)
+
+        buffer = self._buffers[shard]
+        if buffer is None or buffer.size < count * _BATCH_ROW_BYTES:
+            if buffer is not None:
+                buffer.close()
+                buffer.unlink()
+            buffer = shared_memory.SharedMemory(create=True, size=2 * count * _BATCH_ROW_BYTES)
+            self._buffers[shard] = buffer
+
+        views = _batchViews(buffer.buf, count)
+        for view, column in zip(views, (timestamps, share_quantities, trade_prices, codes, sides)):
+            view[:] = column[rows]
+        del views
+
+        arguments[shard] = (buffer.name, count)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def snapshot(self, window=timedelta(minutes=15), market_prices=None, symbols=None, as_of=None):
+
+        '''Exchange.snapshot across all shards, as one record array in registration order (or the order of
+        `symbols`). Each shard computes its part, and the parts are put back together here'''
+
+        with self._lock:
+            symbols = list(self._symbols) if symbols is None else list(symbols)
+            locations = [self._locate(x)[0] for x in symbols]
+
+        if market_prices is not None:
+            market_prices = np.asarray(market_prices, dtype=np.float64)
+            if len(market_prices) != len(symbols):
+                raise ValueError("Mismatched market prices : Requiring one price per stock (got "+ \
+                                 str(len(market_prices))+" prices for "+ str(len(symbols))+" stocks)")
+
+        positions = {}
+        for i, shard in enumerate(locations):
+            positions.setdefault(shard, []).append(i)
+
+        parts = self._broadcast('snapshot', {shard: (window,
+                                                     None if market_prices is None else market_prices[rows],
+                                                     [symbols[x] for x in rows], as_of)
+                                             for shard, rows in positions.items()})
+
+        result = np.zeros(len(symbols), dtype=SNAPSHOT_DTYPE)
+        for shard, rows in positions.items():
+            result[rows] = parts[shard]
+        return result.view(np.recarray)
+
+    def GBCEAllShareIndex(self):
+
+        #Geometric mean over all shards, from each shard's partial log-sum and term counts
+
+        return combineIndexPartials(list(self._broadcast('indexPartial', {x: () for x in range(self.shards)}).values()))
+
+    def _tradeStore(self, stock_symbol):
+
+        '''Read-only TradeStore over a stock's live trades in its worker's shared memory block, mapped here without
+        copying. The block is mapped while the shard is held, so the worker cannot move the store meanwhile, and
+        stays mapped for as long as the views returned are in use'''
+
+        with self._lock:
+            shard, code = self._locate(stock_symbol)
+
+        with self._shard_locks[shard]:
+            self._send(shard, 'tradeLayout', code)
+            name, capacity, head, size = self._result([self._receive(shard)])[0]
+            with self._mapped_lock:
+                mapped = self._mapped.get(stock_symbol)
+                if mapped is None or mapped[0] != name:
+                    mapped = self._mapped[stock_symbol] = \
+                             (name, _storeViews(shared_memory.SharedMemory(name=name), capacity))
+
+        views = mapped[1]
+        columns = [views[x][head:size] for x in ('timestamps', 'quantities', 'sides', 'prices')] + \
+                  [views[x][head:size + 1] for x in ('cum_quantities', 'cum_notionals')]
+        for column in columns:
+            column.flags.writeable = False
+        return TradeStore.fromColumns(*columns)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def __repr__(self):
+
+        #Like Exchange.__repr__, lists at most Exchange.REPR_STOCKS stocks
+
+        described = self._broadcast('describe', {x: (Exchange.REPR_STOCKS,) for x in range(self.shards)})
+        count = sum(described[x][0] for x in range(self.shards))
+        shown = [x for shard in range(self.shards) for x in described[shard][1]][:Exchange.REPR_STOCKS]
+        if count > len(shown):
+            shown.append("... "+ str(count - len(shown))+" more stocks ...")
+        return "Stocks:\n"+"\n".join(shown)+"\n"
+
+#--------------------------------------------------------------------------------------------------------
+
+class ShardedStock(object):
+
+    '''Handle on a stock held by a ShardedExchange worker, with the Stock API: attribute reads and writes and method
+    calls are forwarded to the shard (with any error raised here). `trades` reads the worker's trade columns
+    through shared memory, without copying: like Stock.query views, it holds the trades at the time of the call,
+    but an out-of-order trade later inserted shifts the rows underneath it. Bulk addTrades goes through the
+    exchange's shared memory path'''
+
+    def __init__(self, exchange, symbol):
+        self._exchange = exchange
+        self._symbol = symbol
+
+    @property
+    def symbol(self):
+        return self._symbol
+
+    def _request(self, command, *args):
+        with self._exchange._lock:
+            shard, code = self._exchange._locate(self._symbol)
+        return self._exchange._request(shard, command, code, *args)
+
+    def _forward(name):
+
+        #Property reading and writing the shard's stock attribute `name`
+
+        return property(lambda self: self._request('getAttribute', name),
+                        lambda self, value: self._request('setAttribute', name, value))
+
+    stock_type = _forward('stock_type')
+    last_dividend = _forward('last_dividend')
+    fixed_dividend = _forward('fixed_dividend')
+    par_value = _forward('par_value')
+    retention = _forward('retention')
+    rollup_interval = _forward('rollup_interval')
+    rollups = _forward('rollups')
+    del _forward
+
+#--------------------------------------------------------------------------------------------------------
+
+    @property
+    def trades(self):
+        return TradeSequence(self._exchange._tradeStore(self._symbol), NO_LOCK)
+
+    def dividend_yield(self, market_price):
+        return self._request('call', 'dividend_yield', (market_price,))
+
+    def PERatio(self, market_price):
+        return self._request('call', 'PERatio', (market_price,))
+
+    def getVolumeWeightedStockPrice(self, window=timedelta(minutes=15), as_of=None):
+        return self._request('call', 'getVolumeWeightedStockPrice', (window, as_of))
+
+    def vwapAsOf(self, as_of, window=timedelta(minutes=15)):
+        return self._request('call', 'vwapAsOf', (as_of, window))
+
+    def lastTradePrice(self):
+        return self._request('call', 'lastTradePrice', ())
+
+    def addTrade(self, timestamp, share_quantity, trade_type, trade_price):
+        self._request('call', 'addTrade', (timestamp, share_quantity, trade_type, trade_price))
+
+    def addTrades(self, timestamps, share_quantities=None, trade_types=None, trade_prices=None):
+
+        if share_quantities is None and trade_types is None and trade_prices is None:
+            rows = [(x.timestamp, x.share_quantity, x.trade_type, x.trade_price) if type(x) is Trade
+                    else tuple(x) for x in timestamps]
+            if not rows:
+                return
+            timestamps, share_quantities, trade_types, trade_prices = zip(*rows)
+
+        columns = tradeColumns(timestamps, share_quantities, trade_types, trade_prices)
+        if len(columns[0]) == 0:
+            return
+
+        with self._exchange._lock:
+            shard, code = self._exchange._locate(self._symbol)
+        count = len(columns[0])
+        self._exchange._dispatch(np.full(count, shard), np.full(count, code), *columns)
+
+    def evictTrades(self, before):
+        return self._request('call', 'evictTrades', (before,))
+
+    def __repr__(self):
+        return self._request('call', '__repr__', ())
@@ -2,15 +2,44 @@ __author__ = 'sachi'
 
 
 '''The stock class below holds the necessary attributs to specify stocks on the exchange ,
-it also holds information about trades, keeping them inside a sorted-(tree based)-list for efficient lookup.
+it also holds information about trades, keeping them in sorted columnar arrays (see TradeStore) for efficient lookup.
 This is is important especially since a high volume of trades are expected, and the microseconds of lag in looking up
 trade data (that an increase/decrease of algorithmic complexity would entail) could lead to inconsistent/inaccurate
 calculations involving that data'''
 
-import bisect
+import threading
+import numpy as np
 
+from contextlib import nullcontext
 from datetime import timedelta
+from time import perf_counter_ns
 from SuperSimpleStocks.Trade import *
+from SuperSimpleStocks.TradeStore import TradeStore, TradeSequence, toEpochNanos, epochNanosColumn, tradeColumns, \
+    sortedByTimestamp
+from SuperSimpleStocks.Bars import BarSeries, BarBuilder
+from SuperSimpleStocks.Windows import WindowEngine
+from SuperSimpleStocks.Metrics import METRICS
+from SuperSimpleStocks.Subscriptions import Subscriptions
+from SuperSimpleStocks.Query import TradeRange
+from SuperSimpleStocks.Segments import SegmentStore
+
+#Sentinel eviction time for stocks without a retention horizon (later than any int64 timestamp)
+_NEVER = 2 ** 63
+
+#Stand-in for a lock when thread safety is off, so the hot paths can always use `with self._lock`
+NO_LOCK = nullcontext()
+
+#Side codes of the valid trade types, looked up by addTrade rather than reading TradeType.value (slow for an Enum)
+_SIDE_CODES = dict((x, x.value) for x in (TradeType.BUY, TradeType.SELL))
+
+#Instruments for the hot paths (see Metrics), only updated while METRICS.enabled is set
+_ADD_TRADE_NS = METRICS.histogram('stock.add_trade_ns')
+_ADD_TRADES_NS = METRICS.histogram('stock.add_trades_ns')
+_ADD_TRADES_BATCH = METRICS.histogram('stock.add_trades_batch')
+_VWAP_NS = METRICS.histogram('stock.vwap_ns')
+_VWAP_WINDOW_TRADES = METRICS.histogram('stock.vwap_window_trades')
+_TRADES_ADDED = METRICS.counter('stock.trades_added')
+_TRADES_EVICTED = METRICS.counter('stock.trades_evicted')
 
 #--------------------------------------------------------------------------------------------------------
 
@@ -25,15 +54,50 @@ class StockType(Enum):
 
 class Stock(object):
 
-    '''All values here will be set through the properites below, to enable type and validity checks'''
-
-    def __init__(self, symbol, stock_type, last_dividend, par_value, fixed_dividend=None):
+    '''All values here will be set through the properites below, to enable type and validity checks.
+    With a retention horizon set, trades older than the horizon (measured back from the latest trade) are evicted
+    in bulk, and with a rollup interval set they are first summarised into per-interval bars (see Bars module).
+    With a cold store set, evicted trades are also kept there, sealed in the background into memory-mapped segment
+    files (see Segments module), which queryHistory and historySummary read along with the trades still in memory.
+
+    With thread_safe set, every trade write and read (and the listeners they trigger) runs under a per-stock
+    re-entrant lock, so writers to different stocks never block each other and readers see each stock in a
+    consistent state. Locks are always taken stock first, then exchange (see Exchange)'''
+
+    #Eviction waits until this fraction of the retention horizon has expired, so that it runs in batches
+    EVICTION_SLACK = 0.1
+
+    #Most trades listed by __repr__
+    REPR_TRADES = 10
+
+    #Shortest time in seconds between two rounds of subscription updates, unless given to subscribe
+    SUBSCRIPTION_INTERVAL = 0.1
+
+    #Fixed attribute slots rather than a per-instance __dict__ (weak references are still allowed)
+    __slots__ = ('_lock', '_change_listeners', '_trade_listeners', '_reset_listeners', '_symbol', '_stock_type', '_last_dividend',
+                 '_fixed_dividend', '_par_value', '_trade_store', '_windows', '_bars', '_retention', '_rollup_interval',
+                 '_rollups', '_evict_at', '_clock', '_subscriptions', '_cold_store', '__weakref__')
+
+    def __init__(self, symbol, stock_type, last_dividend, par_value, fixed_dividend=None, retention=None,
+                 rollup_interval=None, thread_safe=False, clock=None):
+        self._lock = NO_LOCK
+        self.thread_safe = thread_safe
+        self.clock = clock
+        self._change_listeners = []
+        self._trade_listeners = []
+        self._reset_listeners = []
+        self._subscriptions = None
+        self._cold_store = None
         self.symbol = symbol
         self.stock_type = stock_type
         self.last_dividend = last_dividend
         self.fixed_dividend = fixed_dividend
         self.par_value = par_value
-        self.trades = []
+        self._trade_store = TradeStore()
+        self._windows = WindowEngine(self)
+        self._bars = BarBuilder(self)
+        self.retention = retention
+        self.rollup_interval = rollup_interval
 #--------------------------------------------------------------------------------------------------------
 
 #Getter and setter functions for each property sets `_property', which works to hide it and encapsulate it,
@@ -67,6 +131,7 @@ class Stock(object):
             raise ValueError("Invalid stock type: Requiring Preferred or Common (got "+ str(stock_type)+")")
         else:
             self._stock_type = stock_type
+            self._notifyChange()
 
 #--------------------------------------------------------------------------------------------------------
 
@@ -83,6 +148,7 @@ class Stock(object):
             raise ValueError("Invalid value for last dividend: Requiring positive integer (got "+ str(last_dividend)+")")
         else:
             self._last_dividend = last_dividend
+            self._notifyChange()
 
 #--------------------------------------------------------------------------------------------------------
 
@@ -108,6 +174,7 @@ class Stock(object):
             raise ValueError("Invalid value for last dividend: Requiring number between 1 and 100 (got "+ str(fixed_dividend)+")")
         else:
             self._fixed_dividend = fixed_dividend
+            self._notifyChange()
 
 #--------------------------------------------------------------------------------------------------------
 
@@ -126,6 +193,238 @@ class Stock(object):
 
         else:
             self._par_value = par_value
+            self._notifyChange()
+
+#--------------------------------------------------------------------------------------------------------
+
+    @property
+    def thread_safe(self):
+        return self._lock is not NO_LOCK
+
+    @thread_safe.setter
+    def thread_safe(self, thread_safe):
+
+        if type(thread_safe) is not bool:
+            raise TypeError("Invalid type for thread safety : Requiring bool (got "+ str(type(thread_safe))+")")
+
+        #The lock is only swapped while holding the current one, so no update in progress under it is cut short,
+        #and left alone when the setting does not change, so holders of it keep excluding each other
+        with self._lock:
+            if thread_safe != self.thread_safe:
+                self._lock = threading.RLock() if thread_safe else NO_LOCK
+
+    @property
+    def lock(self):
+
+        #Hold this to read or update several things about the stock as one consistent step
+
+        return self._lock
+
+#--------------------------------------------------------------------------------------------------------
+
+    #The clock gives the current time (a naive UTC datetime) for queries that default to "now", such as the VWAP
+    #over the last 15 minutes. It is datetime.utcnow unless replaced, e.g. by a simulated clock for replays.
+    #Setting None restores the default
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @clock.setter
+    def clock(self, clock):
+
+        if clock is None:
+            self._clock = datetime.utcnow
+        elif callable(clock):
+            self._clock = clock
+        else:
+            raise TypeError("Invalid clock : Requiring callable returning a datetime or None (got "+ \
+                            str(type(clock))+")")
+
+#--------------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def validateInterval(interval, description):
+
+        #Retention horizons and rollup intervals are positive timedeltas, or None when switched off
+
+        if interval is None:
+            return None
+        elif type(interval) is not timedelta:
+            raise TypeError("Invalid type for "+ description +" : Requiring timedelta or None (got "+ \
+                            str(type(interval))+")")
+        elif interval <= timedelta(0):
+            raise ValueError("Invalid "+ description +" : Requiring positive timedelta (got "+ str(interval)+")")
+        else:
+            return interval
+
+    @property
+    def retention(self):
+        return self._retention
+
+    @retention.setter
+    def retention(self, retention):
+        with self._lock:
+            self._retention = Stock.validateInterval(retention, "retention horizon")
+            self._scheduleEviction()
+
+    @property
+    def rollup_interval(self):
+        return self._rollup_interval
+
+    @rollup_interval.setter
+    def rollup_interval(self, rollup_interval):
+
+        #Changing the interval starts a new series of rollups
+
+        with self._lock:
+            self._rollup_interval = Stock.validateInterval(rollup_interval, "rollup interval")
+            if rollup_interval is None:
+                self._rollups = None
+            else:
+                self._rollups = BarSeries(rollup_interval // timedelta(microseconds=1) * 1000)
+
+    @property
+    def rollups(self):
+        return self._rollups
+
+    @property
+    def cold_store(self):
+        return self._cold_store
+
+    @cold_store.setter
+    def cold_store(self, cold_store):
+
+        #SegmentStore receiving evicted trades, or None to drop them (after any rollup) as before. Replacing a store
+        #flushes the old one
+
+        if cold_store is not None and type(cold_store) is not SegmentStore:
+            raise TypeError("Invalid cold store : Requiring SegmentStore object or None (got "+ \
+                            str(type(cold_store))+")")
+        with self._lock:
+            replaced, self._cold_store = self._cold_store, cold_store
+        if replaced is not None and replaced is not cold_store:
+            replaced.flush()
+
+    @property
+    def windows(self):
+
+        #Sliding window metrics (see Windows module): register windows with addWindow, read them with value
+
+        return self._windows
+
+    @property
+    def bars(self):
+
+        #OHLCV bars at registered resolutions (see Bars module): addResolution, then range or volumeWeightedPrice
+
+        return self._bars
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Listeners let an owner (e.g. an Exchange maintaining its index) follow a stock without polling it.
+    #Change listeners are called as listener(stock) after the type, a dividend, the par value or the whole trade
+    #history is set; trade listeners as listener(stock, timestamps, share_quantities, sides, trade_prices) after
+    #trades are stored, with the columns in storage form (epoch-ns timestamps, TradeType values as sides). Reset
+    #listeners are called as listener(stock) after the whole trade history is replaced (see trades), before the
+    #change listeners, so state built from the trades (journal, windows, bars) can be rebuilt.
+    #Listeners run under the stock's lock. The lists are replaced rather than mutated, so a notification in
+    #progress is never disturbed
+
+    def addChangeListener(self, listener):
+        with self._lock:
+            self._change_listeners = self._change_listeners + [listener]
+
+    def removeChangeListener(self, listener):
+        with self._lock:
+            self._change_listeners = [x for x in self._change_listeners if x != listener]
+
+    def addTradeListener(self, listener):
+        with self._lock:
+            self._trade_listeners = self._trade_listeners + [listener]
+
+    def removeTradeListener(self, listener):
+        with self._lock:
+            self._trade_listeners = [x for x in self._trade_listeners if x != listener]
+
+    def addResetListener(self, listener):
+        with self._lock:
+            self._reset_listeners = self._reset_listeners + [listener]
+
+    def removeResetListener(self, listener):
+        with self._lock:
+            self._reset_listeners = [x for x in self._reset_listeners if x != listener]
+
+    #Push updates of the stock's VWAP or last trade price (see Subscriptions module), coalesced to at most one round
+    #every SUBSCRIPTION_INTERVAL seconds, or every `interval` seconds once given to subscribe. The first subscription
+    #creates the stock's hub and puts the stock in thread-safe mode; close stops it
+
+    @property
+    def subscriptions(self):
+        with Subscriptions.CREATION_LOCK:
+            if self._subscriptions is None:
+                self._subscriptions = Subscriptions(self, self.SUBSCRIPTION_INTERVAL)
+            return self._subscriptions
+
+    def subscribe(self, topic, callback, window=timedelta(minutes=15), interval=None):
+        hub = self.subscriptions
+        if interval is not None:
+            hub.interval = interval
+        return hub.subscribe(topic, callback, window=window)
+
+    def close(self):
+
+        #Stop the stock's subscription hub, if any, and write any trades staged for its cold store to disk. The
+        #stock stays usable, and a later subscription starts a new hub
+
+        with Subscriptions.CREATION_LOCK:
+            hub, self._subscriptions = self._subscriptions, None
+        if hub is not None:
+            hub.close()
+        if self._cold_store is not None:
+            self._cold_store.flush()
+
+    def _notifyChange(self):
+        if self._change_listeners:
+            with self._lock:
+                for listener in self._change_listeners:
+                    listener(self)
+
+    def _notifyTrades(self, timestamps, share_quantities, sides, trade_prices):
+        for listener in self._trade_listeners:
+            listener(self, timestamps, share_quantities, sides, trade_prices)
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Trades are stored column-wise, the property hands out a lazy list-like view over them. Assigning a list of
+    #Trade objects replaces the stored trades
+
+    @property
+    def trades(self):
+        return TradeSequence(self._trade_store, self._lock)
+
+    @trades.setter
+    def trades(self, trades):
+
+        trades = list(trades)
+        for trade in trades:
+            if type(trade) is not Trade:
+                raise TypeError("Incorrectly Formatted Trade : Requiring Trade object (got "+ str(type(trade))+")")
+
+        #Trades are validated Trade objects, so they are sorted on their raw timestamps and stored in one merge
+        trades.sort(key=TRADE_KEY)
+
+        with self._lock:
+            self._trade_store.clear()
+            if trades:
+                self._trade_store.merge(np.array([toEpochNanos(x.timestamp) for x in trades], dtype=np.int64),
+                                        np.array([x.share_quantity for x in trades], dtype=np.int64),
+                                        np.array([x.trade_type.value for x in trades], dtype=np.int8),
+                                        np.array([x.trade_price for x in trades], dtype=np.float64))
+            self._scheduleEviction()
+            for listener in self._reset_listeners:
+                listener(self)
+            self._notifyChange()
 
 #--------------------------------------------------------------------------------------------------------
 
@@ -161,46 +460,265 @@ class Stock(object):
 #--------------------------------------------------------------------------------------------------------
 
 
-    def getVolumeWeightedStockPrice(self):
+    def getVolumeWeightedStockPrice(self, window=timedelta(minutes=15), as_of=None):
 
+        '''VWAP of the trades in the `window` up to `as_of` (a datetime): trades later than as_of - window and no
+        later than as_of. Without as_of the window ends at the stock's clock (see clock) and takes in any later trades
+        too, so the default is the VWAP of the last fifteen minutes'''
 
-        #Calculate the timestamp for fifteen minutes ago
-        periodPast = datetime.utcnow()-timedelta(minutes=15)
+        start_time = perf_counter_ns() if METRICS.enabled else 0
 
-        #Find place in list where 15minutes ago would fit.
-        #If item is already present in list, the insertion point will be before (to the left of) any existing entries
+        #Calculate the timestamp for the start of the window
+        window = Stock.validateInterval(window, "window")
+        if as_of is None:
+            periodPast, until = self._clock() - window, None
+        else:
+            periodPast, until = Trade.validateTimestamp(as_of) - window, toEpochNanos(as_of)
 
-        period_start_point = bisect.bisect(self.trades, periodPast)
+        #Totals for trades in the window come from the store's running sums: two bisections and a subtraction,
+        #no scan or copy of the trades themselves. Out-of-order trades are accounted for as they are inserted
 
-        #Get a slice of the trades list that corresponds to this last 15 minutes
-        period_trades = self.trades[period_start_point:]
+        with self._lock:
+            vwap = self._trade_store.volumeWeightedPrice(toEpochNanos(periodPast), until)
+            if start_time:
+                store = self._trade_store
+                _VWAP_WINDOW_TRADES.record(max(0, (len(store) if until is None else store.bisect(until)) - \
+                                                  store.bisect(toEpochNanos(periodPast))))
 
-        #Calculate the quantities and volume weighted stock price for non-zero trades
-        quantities = sum(x.share_quantity for x in period_trades)
-        volume = sum(x.trade_price * x.share_quantity for x in period_trades)
+        if start_time:
+            _VWAP_NS.record(perf_counter_ns() - start_time)
 
-        if quantities>0:
-            return volume/quantities
+        if vwap is not None:
+            return vwap
         else:
             raise ValueError("Unable to calculate Volume Weighted Stock Price, non-zero quantity required")
 
+    def vwapAsOf(self, as_of, window=timedelta(minutes=15)):
+
+        '''Batch form of getVolumeWeightedStockPrice(window, as_of): the VWAP as of each of many times (datetimes,
+        datetime64 values or epoch nanoseconds, in any order), as a float64 array with NaN where no shares traded.
+        All windows are answered in one vectorised pass over the running sums, e.g. a day of one-second points
+        in milliseconds'''
+
+        untils = epochNanosColumn(as_of)
+        afters = untils - Stock.validateInterval(window, "window") // timedelta(microseconds=1) * 1000
+
+        with self._lock:
+            return self._trade_store.volumeWeightedPrices(afters, untils)
+
+    def query(self, start=None, end=None):
+
+        '''Trades from `start` (inclusive) to `end` (exclusive), as a TradeRange of read-only views over the stored
+        columns (see Query module), with no copying. The bounds may be datetimes, datetime64 values or epoch
+        nanoseconds, and either may be left open. Filter with where(), then use the aggregates, e.g.
+        stock.query(t1, t2).where(side=TradeType.BUY, min_price=100).vwap()'''
+
+        with self._lock:
+            return self._queryRange(start, end)
+
+    def _queryRange(self, start, end):
+
+        #Called with the stock's lock held. Totals for the whole range come from the running sums
+
+        store = self._trade_store
+        first = 0 if start is None else store.bisectLeft(int(epochNanosColumn([start])[0]))
+        stop = len(store) if end is None else max(first, store.bisectLeft(int(epochNanosColumn([end])[0])))
+        volume, notional = store.totals(first, stop)
+        return TradeRange(self._symbol, store.timestamps[first:stop], store.quantities[first:stop],
+                          store.sides[first:stop], store.prices[first:stop], volume, notional)
+
+    def queryHistory(self, start=None, end=None):
+
+        '''Like query, but over the whole history: the sealed trades in the cold store as well as those in memory.
+        Only the segments overlapping the range are read; the columns are copies when both tiers (or several
+        segments) contribute. Both tiers are read under the stock's lock, so no trade is seen twice or missed'''
+
+        start, end = self._historyBounds(start, end)
+        with self._lock:
+            hot = self._queryRange(start, end)
+            if self._cold_store is None:
+                return hot
+            cold = self._cold_store.query(self._symbol, start, end)
+
+        if cold.count() == 0:
+            return hot
+        elif hot.count() == 0:
+            return cold
+        columns = [np.concatenate((x, y)) for x, y in ((cold.timestamps, hot.timestamps),
+                   (cold.quantities, hot.quantities), (cold.sides, hot.sides), (cold.prices, hot.prices))]
+        if columns[0][cold.count()] < columns[0][cold.count() - 1]:
+            order = np.argsort(columns[0], kind='stable')
+            columns = [x[order] for x in columns]
+        return TradeRange(self._symbol, *columns)
+
+    def historySummary(self, start=None, end=None):
+
+        '''Count, volume, notional, VWAP and min/max price over the whole history from `start` to `end` (see
+        queryHistory), as a dict like TradeRange.summary. Sealed segments wholly inside the range are answered
+        from their summaries, so only the segments the bounds fall in are paged in'''
+
+        start, end = self._historyBounds(start, end)
+        with self._lock:
+            result = self._queryRange(start, end).summary()
+            if self._cold_store is None:
+                return result
+            cold = self._cold_store.summary(start, end)
+
+        for name in ('count', 'volume', 'notional'):
+            result[name] += cold[name]
+        for name, choose in (('min_price', min), ('max_price', max)):
+            if cold[name] is not None:
+                result[name] = cold[name] if result[name] is None else choose(result[name], cold[name])
+        result['vwap'] = result['notional'] / result['volume'] if result['volume'] > 0 else None
+        return result
+
+    @staticmethod
+    def _historyBounds(start, end):
+        return tuple(None if x is None else int(epochNanosColumn([x])[0]) for x in (start, end))
+
+    def lastTradePrice(self):
+
+        #Price of the latest trade by timestamp
+
+        with self._lock:
+            store = self._trade_store
+            if len(store) > 0:
+                return store.prices[-1].item()
+        raise ValueError("Unable to give last trade price, no trades recorded for "+ self.symbol)
+
 #--------------------------------------------------------------------------------------------------------
 
 
     def addTrade(self, timestamp, share_quantity, trade_type, trade_price):
 
-        '''Keep the trade-list sorted by timestamp, inserting new trade into appropriate position
-        using a bisection algorithm (O(log n) for insert and find)'''
+        '''Keep the trade columns sorted by timestamp. A trade no older than the last one is appended in O(1);
+        an older one is placed by bisection (O(log n) to find, tail shifted in contiguous memory). The fields are
+        validated as the Trade properties would, but no Trade object is built'''
+
+        start_time = perf_counter_ns() if METRICS.enabled else 0
+
+        Trade.validateTimestamp(timestamp)
+        Trade.validateShareQuantity(share_quantity)
+        side = _SIDE_CODES.get(trade_type) if type(trade_type) is TradeType else None
+        if side is None:
+            Trade.validateTradeType(trade_type)
+        trade_price = Trade.validateTradePrice(trade_price)
+
+        nanos = toEpochNanos(timestamp)
 
-        bisect.insort(self.trades, Trade(timestamp, share_quantity, trade_type, trade_price))
+        with self._lock:
+            self._trade_store.insert(nanos, share_quantity, side, trade_price)
+
+            if nanos >= self._evict_at:
+                self._evictExpired(nanos)
+
+            if self._trade_listeners:
+                self._notifyTrades((nanos,), (share_quantity,), (side,), (trade_price,))
+
+        if start_time:
+            _TRADES_ADDED.inc()
+            _ADD_TRADE_NS.record(perf_counter_ns() - start_time)
+
+    def addTrades(self, timestamps, share_quantities=None, trade_types=None, trade_prices=None):
+
+        '''Bulk version of addTrade. Takes either four equal-length columns (arrays or sequences, see
+        TradeStore.tradeColumns for the accepted forms) or, as the only argument, an iterable of Trade objects or
+        (timestamp, share_quantity, trade_type, trade_price) tuples. The batch is validated in one vectorised pass,
+        sorted once and merged into storage; nothing is stored if any trade is invalid'''
+
+        if share_quantities is None and trade_types is None and trade_prices is None:
+            rows = [(x.timestamp, x.share_quantity, x.trade_type, x.trade_price) if type(x) is Trade else tuple(x)
+                    for x in timestamps]
+            if not rows:
+                return
+            timestamps, share_quantities, trade_types, trade_prices = zip(*rows)
+
+        self._addValidatedTrades(*tradeColumns(timestamps, share_quantities, trade_types, trade_prices))
+
+    def _addValidatedTrades(self, timestamps, share_quantities, sides, trade_prices):
+
+        #Trusted path for columns already in storage form (see tradeColumns), e.g. from Exchange.ingest
+
+        start_time = perf_counter_ns() if METRICS.enabled else 0
+
+        timestamps, share_quantities, sides, trade_prices = \
+            sortedByTimestamp(timestamps, share_quantities, sides, trade_prices)
+        if len(timestamps) == 0:
+            return
+
+        with self._lock:
+            self._trade_store.merge(timestamps, share_quantities, sides, trade_prices)
+
+            if timestamps[-1] >= self._evict_at:
+                self._evictExpired(int(timestamps[-1]))
+
+            if self._trade_listeners:
+                self._notifyTrades(timestamps, share_quantities, sides, trade_prices)
+
+        if start_time:
+            _TRADES_ADDED.inc(len(timestamps))
+            _ADD_TRADES_BATCH.record(len(timestamps))
+            _ADD_TRADES_NS.record(perf_counter_ns() - start_time)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def evictTrades(self, before):
+
+        '''Evict all trades older than the `before` datetime, rolling them up first if a rollup interval is set.
+        Returns the number of trades evicted'''
+
+        before = toEpochNanos(Trade.validateTimestamp(before))
+        with self._lock:
+            return self._evict(before)
+
+    def _evict(self, before):
+
+        timestamps, share_quantities, sides, trade_prices = self._trade_store.evict(before)
+        if self._rollups is not None:
+            self._rollups.addTrades(timestamps, share_quantities, trade_prices)
+        if self._cold_store is not None:
+            self._cold_store.add(timestamps, share_quantities, sides, trade_prices)
+        if METRICS.enabled:
+            _TRADES_EVICTED.inc(len(timestamps))
+
+        self._scheduleEviction()
+        return len(timestamps)
+
+    def _evictExpired(self, newest):
+        self._evict(newest - self._retention // timedelta(microseconds=1) * 1000)
+
+    def _scheduleEviction(self):
+
+        #Next trade time at which expired trades are evicted: once the oldest trade is past the horizon by the slack.
+        #With no trades stored the next trade reschedules, without a horizon nothing is ever evicted
+
+        store = self._trade_store
+        if self._retention is None:
+            self._evict_at = _NEVER
+        elif len(store) == 0:
+            self._evict_at = 0
+        else:
+            self._evict_at = int(store.timestamps[0]) + \
+                             int(self._retention * (1 + self.EVICTION_SLACK) // timedelta(microseconds=1)) * 1000
 
 #--------------------------------------------------------------------------------------------------------
 
     def __repr__(self):
 
         #String representation for class, used when str()/print function is called on class
-        # The last bit form a string of trade descriptions using list comprehension
+        #Only the first and last REPR_TRADES // 2 trades are listed for longer histories, so printing a stock
+        #with millions of trades stays cheap
+
+        with self._lock:
+            count = len(self._trade_store)
+            if count <= self.REPR_TRADES:
+                shown = [str(self._trade_store.trade(x)) for x in range(count)]
+            else:
+                half = self.REPR_TRADES // 2
+                shown = [str(self._trade_store.trade(x)) for x in range(half)] + \
+                        ["... "+ str(count - 2 * half)+" more trades ..."] + \
+                        [str(self._trade_store.trade(x)) for x in range(count - half, count)]
 
         return "< "+self.symbol + " | Type : "+ str(self.stock_type.name) +" | LastDiv: "+ str(self.last_dividend) + \
                " | FixedDividend: " + str(self.fixed_dividend)+ " | Par_Value: "+ str(self.par_value)+ " >" + \
-               "\n\n\t\t"+"Trades".center(70,"=")+"\n\n\t"+"\n\t".join(str(x) for x in self.trades)+"\n"
+               "\n\n\t\t"+"Trades".center(70,"=")+"\n\n\t"+"\n\t".join(shown)+"\n"
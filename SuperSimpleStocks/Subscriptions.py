@@ -0,0 +1,326 @@
+__author__ = 'sachi'
+
+
+'''The classes below push VWAP, last trade price and GBCE All Share Index updates to subscribers, so clients do not
+have to poll for them. A Subscriptions hub follows an Exchange (or a single Stock) through its listeners: storing
+trades only marks the stock as changed, which costs the ingesting thread a set insertion under a short lock. A dispatcher thread then
+works out the new values and calls the subscribers, at most once per `interval` seconds, so a burst of 10k trades
+gives one notification with the latest value rather than 10k. Subscribers are only called when their value has
+changed, and never on the ingesting thread, so a slow subscriber delays later notifications but never ingestion.
+One dispatcher thread serves every hub in the process, each at its own interval.
+
+Reading values from the dispatcher thread needs the stocks' locks, so the hub puts its exchange (or stock) in
+thread-safe mode. Notifications are driven by trades and changes to the stocks: a VWAP whose window slides past
+its oldest trades without new trades arriving is not re-sent'''
+
+import threading
+import time
+
+from datetime import timedelta
+from enum import Enum, unique
+
+from SuperSimpleStocks.Metrics import METRICS
+
+#--------------------------------------------------------------------------------------------------------
+
+@unique
+class Topic(Enum):
+    VWAP = 1
+    LastPrice = 2
+    Index = 3
+
+_NOTIFICATIONS = METRICS.counter('subscriptions.notifications')
+_DISPATCHES = METRICS.counter('subscriptions.dispatches')
+
+class Subscription(object):
+
+    '''Handle returned by Subscriptions.subscribe. The callback is called as callback(symbol, value), with symbol
+    None for the index and value None when there is none (e.g. no trades in the VWAP window)'''
+
+    def __init__(self, hub, topic, symbol, callback, window):
+        self._hub = hub
+        self.topic = topic
+        self.symbol = symbol
+        self.callback = callback
+        self.window = window
+
+    def cancel(self):
+        self._hub.unsubscribe(self)
+
+    def __repr__(self):
+        return "< Subscription : "+ self.topic.name + ("" if self.symbol is None else " | "+ self.symbol)+" >"
+
+#--------------------------------------------------------------------------------------------------------
+
+class _Dispatcher(object):
+
+    '''The background thread dispatching updates for every hub: it sleeps until the earliest hub with changes
+    pending is due (its interval having passed since its last round), and runs the rounds of all hubs due'''
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._hubs = set()
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='subscriptions', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def shared(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = _Dispatcher()
+            return cls._instance
+
+    @property
+    def thread(self):
+        return self._thread
+
+    def add(self, hub):
+        with self._changed:
+            self._hubs.add(hub)
+
+    def remove(self, hub):
+        with self._changed:
+            self._hubs.discard(hub)
+
+    def wake(self):
+        with self._changed:
+            self._changed.notify()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while True:
+                    now = time.monotonic()
+                    waits = [x._last_dispatch + x._interval - now for x in self._hubs if x._pending]
+                    if any(x <= 0 for x in waits):
+                        break
+                    self._changed.wait(min(waits) if waits else None)
+                due = [x for x in self._hubs if x._pending and x._last_dispatch + x._interval <= now]
+
+            for hub in due:
+                hub._dispatchPending()
+
+#--------------------------------------------------------------------------------------------------------
+
+class Subscriptions(object):
+
+    '''Subscription hub for an Exchange or a single Stock (`source`), notifying at most once every `interval`
+    seconds. Usually reached through Exchange.subscribe or Stock.subscribe, which create one on first use'''
+
+    #Guards the creation of hubs on first use (see Exchange.subscriptions), which must not hold the source's lock
+    CREATION_LOCK = threading.Lock()
+
+    def __init__(self, source, interval=0.1):
+
+        self._source = source
+        self._exchange = source if hasattr(source, 'GBCEAllShareIndex') else None
+        self._interval = self._validInterval(interval)
+        self._subscriptions = []
+        self._delivered = {}
+        self._dirty = set()
+        self._index_dirty = False
+        self._pending = False
+        self._lock = threading.Lock()
+        self._dispatching = threading.Lock()
+        self._dispatcher = _Dispatcher.shared()
+        self._closed = False
+        self._last_dispatch = 0.0
+        self.stats = {'dispatches': 0, 'notifications': 0, 'errors': 0, 'last_error': None}
+
+        if not source.thread_safe:
+            source.thread_safe = True
+        if self._exchange is not None:
+            for stock in self._exchange._stockList():
+                self._watch(stock)
+            self._exchange.addStockListener(self._stockListed)
+        else:
+            self._watch(source)
+        self._dispatcher.add(self)
+
+    @staticmethod
+    def _validInterval(interval):
+        if type(interval) not in (int, float) or interval < 0:
+            raise ValueError("Invalid notification interval : Requiring non-negative seconds (got "+ \
+                             str(interval)+")")
+        return interval
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @interval.setter
+    def interval(self, interval):
+        self._interval = self._validInterval(interval)
+        self._dispatcher.wake()
+
+    @property
+    def subscriptions(self):
+        return list(self._subscriptions)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def subscribe(self, topic, callback, symbol=None, window=timedelta(minutes=15)):
+
+        '''Call `callback` with the latest value of `topic` for `symbol` (not needed for a stock's own hub, nor for
+        Topic.Index) whenever it changes, starting with its current value. `window` is the VWAP window'''
+
+        if type(topic) is not Topic:
+            raise TypeError("Invalid topic : Requiring Topic object (got "+ str(type(topic))+")")
+        elif not callable(callback):
+            raise TypeError("Invalid callback : Requiring callable (got "+ str(type(callback))+")")
+
+        if topic is Topic.Index:
+            if self._exchange is None:
+                raise ValueError("Invalid topic : Index updates are only available from an exchange")
+            stock, symbol = None, None
+        elif self._exchange is None:
+            stock = self._source
+            symbol = stock.symbol
+        else:
+            stock = self._exchange.getStock(symbol)
+
+        subscription = Subscription(self, topic, symbol, callback, window)
+        with self._lock:
+            self._subscriptions = self._subscriptions + [subscription]
+            if stock is None:
+                self._index_dirty = True
+            else:
+                self._dirty.add(stock)
+            self._pending = True
+        self._dispatcher.wake()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = [x for x in self._subscriptions if x is not subscription]
+            self._delivered.pop(subscription, None)
+
+    def close(self):
+
+        #Stop dispatching for this hub, waiting for a round in progress unless called from a subscriber, and stop
+        #following the source. Pending updates are dropped
+
+        if self._closed:
+            return
+        self._closed = True
+        self._dispatcher.remove(self)
+        if self._dispatcher.thread is not threading.current_thread():
+            with self._dispatching:
+                pass
+
+        if self._exchange is not None:
+            self._exchange.removeStockListener(self._stockListed)
+            for stock in self._exchange._stockList():
+                self._unwatch(stock)
+        else:
+            self._unwatch(self._source)
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Listeners, run on the thread storing trades or changing a stock: they only record what changed
+
+    def _watch(self, stock):
+        stock.addTradeListener(self._stockTraded)
+        stock.addChangeListener(self._stockChanged)
+
+    def _unwatch(self, stock):
+        stock.removeTradeListener(self._stockTraded)
+        stock.removeChangeListener(self._stockChanged)
+
+    def _stockListed(self, stock, added):
+        if added:
+            self._watch(stock)
+            self._stockChanged(stock)
+        else:
+            self._unwatch(stock)
+
+    def _stockTraded(self, stock, timestamps, share_quantities, sides, trade_prices):
+        self._stockChanged(stock)
+
+    def _stockChanged(self, stock):
+
+        #The dispatcher is only woken by the first change since the last round
+
+        with self._lock:
+            self._dirty.add(stock)
+            self._index_dirty = True
+            wake, self._pending = not self._pending, True
+        if wake:
+            self._dispatcher.wake()
+
+#--------------------------------------------------------------------------------------------------------
+
+    def _dispatchPending(self):
+
+        #One round, run by the dispatcher thread once `interval` has passed since the last (changes arriving
+        #meanwhile are coalesced). Errors are counted rather than raised, as the thread serves every hub
+
+        with self._dispatching:
+            if self._closed:
+                return
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                index_dirty, self._index_dirty = self._index_dirty, False
+                subscriptions = self._subscriptions
+                self._pending = False
+
+            self._last_dispatch = time.monotonic()
+            try:
+                self._dispatch(dirty, index_dirty, subscriptions)
+            except Exception as error:
+                self.stats['errors'] += 1
+                self.stats['last_error'] = error
+
+    def _dispatch(self, dirty, index_dirty, subscriptions):
+
+        symbols = set(x.symbol for x in dirty)
+        values = {}
+        for subscription in subscriptions:
+            if subscription.topic is Topic.Index:
+                if not index_dirty:
+                    continue
+            elif subscription.symbol not in symbols:
+                continue
+
+            key = (subscription.topic, subscription.symbol, subscription.window)
+            if key not in values:
+                values[key] = self._value(subscription)
+
+            value = values[key]
+            with self._lock:
+                if subscription not in self._subscriptions or \
+                   (subscription in self._delivered and self._delivered[subscription] == value):
+                    continue
+                self._delivered[subscription] = value
+
+            try:
+                subscription.callback(subscription.symbol, value)
+            except Exception as error:
+                self.stats['errors'] += 1
+                self.stats['last_error'] = error
+            self.stats['notifications'] += 1
+            if METRICS.enabled:
+                _NOTIFICATIONS.inc()
+
+        self.stats['dispatches'] += 1
+        if METRICS.enabled:
+            _DISPATCHES.inc()
+
+    def _value(self, subscription):
+
+        #The subscription's current value, read from the stock now listed under its symbol
+
+        try:
+            if subscription.topic is Topic.Index:
+                return self._exchange.GBCEAllShareIndex()
+
+            stock = self._source if self._exchange is None else self._exchange.getStock(subscription.symbol)
+            if subscription.topic is Topic.VWAP:
+                return stock.getVolumeWeightedStockPrice(subscription.window)
+            else:
+                return stock.lastTradePrice()
+        except ValueError:
+            return None
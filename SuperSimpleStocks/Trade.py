@@ -1,11 +1,16 @@
 __author__ = 'sachi'
 
+import math
+
 from datetime import datetime
 from enum import Enum, unique
+from operator import attrgetter
+from SuperSimpleStocks.Metrics import METRICS
 
 '''The trade class below holds the necessary attributes to specify trades for a stock/shares. It overloads three
 comparison operators so that trade objects can be ordered by timestamp, which is necessary to enable
-storage in an ordered list (see Stock module). Property decorators are used to encapsulate attributes, and an enumerated
+storage in an ordered list (see Stock module); for sorting and bisecting many trades, TRADE_KEY orders them by raw timestamp
+without going through the operators. Property decorators are used to encapsulate attributes, and an enumerated
 type (TradeType) to hold an unique trade-type
 '''
 
@@ -16,16 +21,42 @@ class TradeType(Enum):
     BUY = 1
     SELL = 2
 
+#Counts Trade objects built, which stored trades only become when read through Stock.trades (see Metrics)
+_TRADES_CREATED = METRICS.counter('trade.created')
+
+#Sort key for trades, e.g. sorted(trades, key=TRADE_KEY) or bisect.insort(trades, trade, key=TRADE_KEY)
+TRADE_KEY = attrgetter('_timestamp')
+
 #--------------------------------------------------------------------------------------------------------
 
 class Trade(object):
 
+    #Fixed attribute slots rather than a per-instance __dict__, as many trades can be alive at once
+    __slots__ = ('_timestamp', '_share_quantity', '_trade_type', '_trade_price')
+
     def __init__(self, timestamp, share_quantity, trade_type, trade_price):
+        if METRICS.enabled:
+            _TRADES_CREATED.inc()
         self.timestamp = timestamp
         self.share_quantity = share_quantity
         self.trade_type = trade_type
         self.trade_price = trade_price
 
+    @classmethod
+    def trusted(cls, timestamp, share_quantity, trade_type, trade_price):
+
+        #Build a trade from fields that are already known to be valid (e.g. read back from a TradeStore), skipping
+        #the property checks
+
+        trade = object.__new__(cls)
+        trade._timestamp = timestamp
+        trade._share_quantity = share_quantity
+        trade._trade_type = trade_type
+        trade._trade_price = trade_price
+        if METRICS.enabled:
+            _TRADES_CREATED.inc()
+        return trade
+
 #--------------------------------------------------------------------------------------------------------
 
     #The following allows trade objects to be compared to other trade objects or timestamps
@@ -49,6 +80,62 @@ class Trade(object):
         elif type(other) is datetime:
             return self._timestamp is other
 
+#--------------------------------------------------------------------------------------------------------
+
+    #The checks below are shared by the property setters and by Stock.addTrade, which stores trade fields
+    #directly in columnar arrays (see TradeStore module) without building a Trade object first
+
+    @staticmethod
+    def validateTimestamp(timestamp):
+        if type(timestamp) is datetime:
+            return timestamp
+        else:
+            raise TypeError("Incorrectly Formatted Timestamp : Requiring datetime object (got "+ str(type(timestamp))+")")
+
+    @staticmethod
+    def validateShareQuantity(share_quantity):
+
+        if type(share_quantity) is not int:
+            raise TypeError("Invalid type for share quantity : Requiring positive integer (got "+ str(type(share_quantity))+")")
+
+        elif share_quantity <= 0:
+            raise TypeError("Invalid value for share quantity : Requiring positive integer (got "+ str(share_quantity)+")")
+        else:
+            return share_quantity
+
+    @staticmethod
+    def validateTradeType(trade_type):
+
+        if type(trade_type) is not TradeType:
+            raise TypeError("Invalid trade type : Requiring StockType object (got "+ str(type(trade_type))+")")
+
+        elif (trade_type != TradeType.BUY and trade_type != TradeType.SELL):
+            raise ValueError("Invalid trade type: Requiring BUY or SELL (got "+ str(trade_type)+")")
+
+        else:
+            return trade_type
+
+    @staticmethod
+    def validateTradePrice(trade_price):
+
+        #Prices are stored in a float column, so any number float() can convert is accepted (e.g. Decimal or NumPy
+        #scalars), and given back as a float; plain positive floats and ints are let through as they are
+
+        if (type(trade_price) is float or type(trade_price) is int) and 0 < trade_price < math.inf:
+            return trade_price
+        elif type(trade_price) is bool:
+            raise TypeError("Invalid type for trade price : Requiring number (got "+ str(type(trade_price))+")")
+
+        try:
+            price = float(trade_price)
+        except (TypeError, ValueError):
+            raise TypeError("Invalid type for trade price : Requiring number (got "+ str(type(trade_price))+")")
+
+        if 0 < price < math.inf:
+            return price
+        else:
+            raise ValueError("Invalid value for trade price : Requiring positive number (got "+ str(trade_price)+")")
+
 #--------------------------------------------------------------------------------------------------------
 
     @property
@@ -57,10 +144,7 @@ class Trade(object):
 
     @timestamp.setter
     def timestamp(self, timestamp):
-        if type(timestamp) is datetime:
-            self._timestamp = timestamp
-        else:
-            raise TypeError("Incorrectly Formatted Timestamp : Requiring datetime object (got "+ str(type(timestamp))+")")
+        self._timestamp = Trade.validateTimestamp(timestamp)
 
 #--------------------------------------------------------------------------------------------------------
 
@@ -70,14 +154,7 @@ class Trade(object):
 
     @share_quantity.setter
     def share_quantity(self, share_quantity):
-
-        if type(share_quantity) is not int:
-            raise TypeError("Invalid type for share quantity : Requiring positive integer (got "+ str(type(share_quantity))+")")
-
-        elif share_quantity <= 0:
-            raise TypeError("Invalid value for share quantity : Requiring positive integer (got "+ str(share_quantity)+")")
-        else:
-            self._share_quantity = share_quantity
+        self._share_quantity = Trade.validateShareQuantity(share_quantity)
 
 #--------------------------------------------------------------------------------------------------------
 
@@ -87,15 +164,7 @@ class Trade(object):
 
     @trade_type.setter
     def trade_type(self, trade_type):
-
-        if type(trade_type) is not TradeType:
-            raise TypeError("Invalid trade type : Requiring StockType object (got "+ str(type(trade_type))+")")
-
-        elif (trade_type != TradeType.BUY and trade_type != TradeType.SELL):
-            raise ValueError("Invalid trade type: Requiring BUY or SELL (got "+ str(trade_type)+")")
-
-        else:
-            self._trade_type = trade_type
+        self._trade_type = Trade.validateTradeType(trade_type)
 
 #--------------------------------------------------------------------------------------------------------
 
@@ -105,7 +174,7 @@ class Trade(object):
 
     @trade_price.setter
     def trade_price(self, trade_price):
-        self._trade_price = trade_price
+        self._trade_price = Trade.validateTradePrice(trade_price)
 
 #--------------------------------------------------------------------------------------------------------
 
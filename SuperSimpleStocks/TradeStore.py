@@ -0,0 +1,505 @@
+__author__ = 'sachi'
+
+
+'''The trade store below keeps a stock's trades in columnar form, as contiguous growable NumPy arrays (one per field)
+ordered by timestamp, rather than as a list of Trade objects. Timestamps are held as int64 nanoseconds since the
+(naive, UTC) epoch, sides as the TradeType value. This costs roughly 25 bytes per trade and lets windowed calculations
+run over contiguous memory. Trade objects are only built on demand, when a caller indexes or iterates the TradeSequence
+view returned by Stock.trades.
+
+Alongside the columns the store keeps running (prefix) sums of quantity and price*quantity, so the totals for any
+time window are two bisections and a subtraction, whatever the number of trades in the window.
+
+Trades appended one at a time are staged in a Python list and written to the columns in blocks, since setting NumPy
+elements one by one costs more than the rest of Stock.addTrade put together. Every read flushes the staged trades
+first, so callers never see the difference'''
+
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from SuperSimpleStocks.Trade import Trade, TradeType
+
+#--------------------------------------------------------------------------------------------------------
+
+#Trade timestamps are naive UTC datetimes (see datetime.utcnow), so the epoch is naive as well
+
+EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+def toEpochNanos(timestamp):
+    return ((timestamp - EPOCH) // _MICROSECOND) * 1000
+
+def fromEpochNanos(nanos):
+    return EPOCH + timedelta(microseconds=int(nanos) // 1000)
+
+#Optional intervals (retention, rollup) as stored in JSON by the journal and the archive: seconds, or None
+
+def toSeconds(interval):
+    return None if interval is None else interval.total_seconds()
+
+def fromSeconds(seconds):
+    return None if seconds is None else timedelta(seconds=seconds)
+
+#Lookup from stored side code back to the enumerated trade type
+TRADE_TYPES = dict((t.value, t) for t in TradeType)
+TRADE_TYPE_CODES = np.array(sorted(TRADE_TYPES), dtype=np.int8)
+
+#One trade as a fixed-width record (little-endian, unpadded, 25 bytes), as written by the journal and the segment store
+TRADE_RECORD_DTYPE = np.dtype([('timestamp', '<i8'), ('quantity', '<i8'), ('price', '<f8'), ('side', 'i1')])
+
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+#--------------------------------------------------------------------------------------------------------
+
+def epochNanosColumn(timestamps):
+
+    #Timestamps given as datetime objects, datetime64 values or integer epoch nanoseconds, as an int64 array
+
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind == 'M':
+        return timestamps.astype('datetime64[ns]').view(np.int64)
+    elif timestamps.dtype.kind in 'iu':
+        return timestamps.astype(np.int64, copy=False)
+    elif timestamps.dtype.kind == 'O' and all(type(x) is datetime for x in timestamps.flat):
+        return timestamps.astype('datetime64[ns]').view(np.int64)
+    elif timestamps.size > 0:
+        raise TypeError("Incorrectly Formatted Timestamps : Requiring datetime objects, datetime64 or epoch nanoseconds \
+            (got "+ str(timestamps.dtype)+")")
+    else:
+        return timestamps.astype(np.int64)
+
+def tradeColumns(timestamps, share_quantities, trade_types, trade_prices):
+
+    '''Validate a batch of trades given column-wise, in one vectorised pass per column, returning NumPy arrays in
+    storage form (epoch-ns timestamps, int64 quantities, int8 side codes, float64 prices).
+    Timestamps may be datetime objects, datetime64 values or integer epoch nanoseconds; trade types may be TradeType
+    members or their integer values; prices may be numbers of any kind float() converts (e.g. Decimal). The checks
+    mirror those made by the Trade properties'''
+
+    timestamps = epochNanosColumn(timestamps)
+
+    share_quantities = np.asarray(share_quantities)
+    if share_quantities.size > 0 and share_quantities.dtype.kind not in 'iu':
+        raise TypeError("Invalid type for share quantities : Requiring positive integers (got "+ str(share_quantities.dtype)+")")
+    share_quantities = share_quantities.astype(np.int64, copy=False)
+    if np.any(share_quantities <= 0):
+        raise TypeError("Invalid value for share quantity : Requiring positive integer (got "+ \
+                        str(share_quantities[share_quantities <= 0][0])+")")
+
+    trade_types = np.asarray(trade_types)
+    if trade_types.dtype.kind == 'O':
+        trade_types = np.fromiter((Trade.validateTradeType(x).value for x in trade_types.flat), dtype=np.int8,
+                                  count=trade_types.size)
+    elif trade_types.size > 0 and trade_types.dtype.kind not in 'iu':
+        raise TypeError("Invalid trade types : Requiring TradeType objects or values (got "+ str(trade_types.dtype)+")")
+    else:
+        #Checked before narrowing to int8, so that out-of-range values cannot wrap onto a valid code
+        if not np.all(np.isin(trade_types, TRADE_TYPE_CODES)):
+            raise ValueError("Invalid trade type: Requiring BUY or SELL values "+ str(sorted(TRADE_TYPES))+")")
+        trade_types = trade_types.astype(np.int8)
+
+    trade_prices = np.asarray(trade_prices)
+    if trade_prices.dtype.kind == 'O':
+        #E.g. Decimal prices, converted one by one as a single trade's price would be
+        trade_prices = np.fromiter((Trade.validateTradePrice(x) for x in trade_prices.flat), dtype=np.float64,
+                                   count=trade_prices.size)
+    elif trade_prices.size > 0 and trade_prices.dtype.kind not in 'iuf':
+        raise TypeError("Invalid type for trade prices : Requiring numbers (got "+ str(trade_prices.dtype)+")")
+    trade_prices = trade_prices.astype(np.float64, copy=False)
+    invalid = ~(np.isfinite(trade_prices) & (trade_prices > 0))
+    if np.any(invalid):
+        raise ValueError("Invalid value for trade price : Requiring positive number (got "+ \
+                         str(trade_prices[invalid][0])+")")
+
+    lengths = set(len(x) for x in (timestamps, share_quantities, trade_types, trade_prices))
+    if len(lengths) > 1:
+        raise ValueError("Mismatched trade columns : Requiring equal lengths (got "+ str(sorted(lengths))+")")
+
+    return timestamps, share_quantities, trade_types, trade_prices
+
+def sortedByTimestamp(timestamps, *columns):
+
+    #Stable sort of validated columns by timestamp, skipped when they already arrive in order
+
+    if len(timestamps) < 2 or np.all(timestamps[1:] >= timestamps[:-1]):
+        return (timestamps,) + columns
+    order = np.argsort(timestamps, kind='stable')
+    return (timestamps[order],) + tuple(x[order] for x in columns)
+
+#--------------------------------------------------------------------------------------------------------
+
+class TradeStore(object):
+
+    '''Columns are over-allocated and doubled when full, so appends are amortised O(1). Only entries between the
+    head and `_size` are live: evicting old trades just advances the head, and the dead space is reclaimed the
+    next time the columns need room (when they are compacted, or shrunk if mostly empty). All indices taken or
+    returned by the public methods are relative to the first live trade'''
+
+    INITIAL_CAPACITY = 16
+
+    #Trades appended in order are staged until this many are waiting (or the store is read), then written as a block
+    STAGE_SIZE = 256
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+
+        #Prefix sums hold one more entry than the columns: _cum_x[i] is the total of the first i trades
+        self._timestamps, self._quantities, self._prices, self._sides, self._cum_quantities, self._cum_notionals = \
+            self._allocate(capacity)
+        self._cum_quantities[0] = 0
+        self._cum_notionals[0] = 0
+        self._head = 0
+        self._size = 0
+        self._staged = []
+
+    def _allocate(self, capacity):
+
+        #Fresh timestamp, quantity, price and side columns for `capacity` rows, and prefix sum columns for one more.
+        #Overridden by stores kept elsewhere than in private memory (see ShardedExchange)
+
+        return np.empty(capacity, dtype=np.int64), np.empty(capacity, dtype=np.int64), \
+               np.empty(capacity, dtype=np.float64), np.empty(capacity, dtype=np.int8), \
+               np.empty(capacity + 1, dtype=np.int64), np.empty(capacity + 1, dtype=np.float64)
+
+    @classmethod
+    def fromColumns(cls, timestamps, quantities, sides, prices, cum_quantities=None, cum_notionals=None):
+
+        '''Store adopting existing columns (validated, sorted by timestamp) without copying them, e.g. arrays
+        memory-mapped in NumPy's copy-on-write mode, which are only read from disk as they are used. The prefix sums
+        (one entry more than the columns, starting from zero) are computed unless given. The first write past the
+        adopted columns moves everything into fresh arrays, as for any store that is full'''
+
+        store = cls(0)
+        store._timestamps, store._quantities, store._sides, store._prices = timestamps, quantities, sides, prices
+        store._size = len(timestamps)
+
+        if cum_quantities is None or cum_notionals is None:
+            store._cum_quantities = np.zeros(store._size + 1, dtype=np.int64)
+            store._cum_notionals = np.zeros(store._size + 1, dtype=np.float64)
+            store._accumulate(0)
+        else:
+            store._cum_quantities, store._cum_notionals = cum_quantities, cum_notionals
+        return store
+
+#--------------------------------------------------------------------------------------------------------
+
+    #Views over the live part of each column, no copying involved
+
+    @property
+    def timestamps(self):
+        self._flush()
+        return self._timestamps[self._head:self._size]
+
+    @property
+    def quantities(self):
+        self._flush()
+        return self._quantities[self._head:self._size]
+
+    @property
+    def prices(self):
+        self._flush()
+        return self._prices[self._head:self._size]
+
+    @property
+    def sides(self):
+        self._flush()
+        return self._sides[self._head:self._size]
+
+    def __len__(self):
+        return self._size - self._head + len(self._staged)
+
+    @property
+    def capacity(self):
+        return len(self._timestamps)
+
+    @property
+    def nbytes(self):
+        return self._timestamps.nbytes + self._quantities.nbytes + self._prices.nbytes + self._sides.nbytes + \
+               self._cum_quantities.nbytes + self._cum_notionals.nbytes
+
+#--------------------------------------------------------------------------------------------------------
+
+    def _reserve(self, count):
+
+        #Make room for `count` more rows at the end. Dead rows before the head are dropped, and the columns are
+        #reallocated at twice the size they need to be, which grows them, keeps them or shrinks them after eviction
+
+        if self._size + count <= self.capacity:
+            return
+
+        live = self._size - self._head
+        capacity = max(2 * (live + count), self.INITIAL_CAPACITY)
+        if live + count <= self.capacity // 2 and capacity * 2 > self.capacity:
+            capacity = self.capacity
+
+        names = ('_timestamps', '_quantities', '_prices', '_sides', '_cum_quantities', '_cum_notionals')
+        for name, new in zip(names, self._allocate(capacity)):
+            old = getattr(self, name)
+            if name.startswith('_cum'):
+                #Prefix sums are rebased to start from zero again, which also sheds accumulated rounding
+                new[:live + 1] = old[self._head:self._size + 1] - old[self._head]
+            else:
+                new[:live] = old[self._head:self._size]
+            setattr(self, name, new)
+
+        self._head = 0
+        self._size = live
+
+    def _accumulate(self, start):
+
+        #Rebuild the prefix sums from (absolute) row `start` onwards, after rows have been inserted there
+
+        stop = self._size
+        quantities = self._quantities[start:stop]
+        np.cumsum(quantities, out=self._cum_quantities[start + 1:stop + 1])
+        self._cum_quantities[start + 1:stop + 1] += self._cum_quantities[start]
+        np.cumsum(self._prices[start:stop] * quantities, out=self._cum_notionals[start + 1:stop + 1])
+        self._cum_notionals[start + 1:stop + 1] += self._cum_notionals[start]
+
+#--------------------------------------------------------------------------------------------------------
+
+    def append(self, timestamp, quantity, side, price):
+
+        '''O(1) (amortised) fast-path for a trade no older than the last stored one, which is how almost all
+        trades arrive: the trade is staged, and written to the columns with the next block. Callers must check the
+        ordering, see insert'''
+
+        if not (_INT64_MIN <= timestamp <= _INT64_MAX and quantity <= _INT64_MAX):
+            raise OverflowError("Invalid trade : Requiring timestamp and quantity within int64 (got "+ \
+                                str(timestamp)+", "+ str(quantity)+")")
+
+        staged = self._staged
+        staged.append((timestamp, quantity, side, price))
+        if len(staged) >= self.STAGE_SIZE:
+            self._flush()
+
+    def _flush(self):
+
+        #Write the staged trades onto the end of the columns. A short run is set element by element, which is
+        #cheaper than building arrays for it when reads and single trades alternate
+
+        staged = self._staged
+        if not staged:
+            return
+        self._staged = []
+
+        count = len(staged)
+        self._reserve(count)
+        size = self._size
+
+        if count < 4:
+            for timestamp, quantity, side, price in staged:
+                self._timestamps[size] = timestamp
+                self._quantities[size] = quantity
+                self._prices[size] = price
+                self._sides[size] = side
+                self._cum_quantities[size + 1] = self._cum_quantities[size] + quantity
+                self._cum_notionals[size + 1] = self._cum_notionals[size] + price * quantity
+                size += 1
+            self._size = size
+        else:
+            timestamps, quantities, sides, prices = zip(*staged)
+            self._timestamps[size:size + count] = timestamps
+            self._quantities[size:size + count] = quantities
+            self._prices[size:size + count] = prices
+            self._sides[size:size + count] = sides
+            self._size = size + count
+            self._accumulate(size)
+
+    def insert(self, timestamp, quantity, side, price):
+
+        '''Insert one trade (timestamp in epoch nanoseconds, side as TradeType value) at its sorted position.
+        Trades sharing a timestamp keep their arrival order'''
+
+        staged = self._staged
+        if staged:
+            if timestamp >= staged[-1][0]:
+                self.append(timestamp, quantity, side, price)
+                return
+            self._flush()
+
+        if self._size == self._head or timestamp >= self._timestamps[self._size - 1]:
+            self.append(timestamp, quantity, side, price)
+            return
+
+        self._reserve(1)
+        size = self._size
+        position = self._head + int(np.searchsorted(self._timestamps[self._head:size], timestamp, side='right'))
+
+        #Shift the tail up by one slot (NumPy handles the overlapping copy)
+        for column in (self._timestamps, self._quantities, self._prices, self._sides):
+            column[position + 1:size + 1] = column[position:size]
+
+        self._timestamps[position] = timestamp
+        self._quantities[position] = quantity
+        self._prices[position] = price
+        self._sides[position] = side
+        self._size = size + 1
+        self._accumulate(position)
+
+    def merge(self, timestamps, quantities, sides, prices):
+
+        '''Merge a batch of already validated trades, given as equal-length arrays sorted by timestamp, in one pass.
+        A batch that starts no earlier than the last stored trade is a block copy onto the end; otherwise only the
+        rows from the earliest insertion point onwards are rewritten. Either way the prefix sums are rebuilt once'''
+
+        count = len(timestamps)
+        if count == 0:
+            return
+
+        self._flush()
+        self._reserve(count)
+        head, size = self._head, self._size
+
+        if size == head or timestamps[0] >= self._timestamps[size - 1]:
+            first = size
+            for column, values in ((self._timestamps, timestamps), (self._quantities, quantities),
+                                   (self._prices, prices), (self._sides, sides)):
+                column[size:size + count] = values
+        else:
+            #Positions of the new rows in the merged tail: after any stored rows with an equal timestamp, and in
+            #batch order among themselves
+            positions = head + np.searchsorted(self._timestamps[head:size], timestamps, side='right')
+            first = int(positions[0])
+            is_new = np.zeros(size - first + count, dtype=bool)
+            is_new[positions - first + np.arange(count)] = True
+
+            for column, values in ((self._timestamps, timestamps), (self._quantities, quantities),
+                                   (self._prices, prices), (self._sides, sides)):
+                merged = np.empty(len(is_new), dtype=column.dtype)
+                merged[is_new] = values
+                merged[~is_new] = column[first:size]
+                column[first:size + count] = merged
+
+        self._size = size + count
+        self._accumulate(first)
+
+    def evict(self, before):
+
+        '''Drop all trades older than `before` (epoch nanoseconds) by advancing the head, O(log n). Returns the
+        evicted rows as (timestamps, quantities, sides, prices) views, valid until the store is next modified'''
+
+        self._flush()
+        head = self._head
+        stop = head + int(np.searchsorted(self._timestamps[head:self._size], before, side='left'))
+        self._head = stop
+
+        return self._timestamps[head:stop], self._quantities[head:stop], self._sides[head:stop], \
+               self._prices[head:stop]
+
+    def clear(self):
+        self._head = 0
+        self._size = 0
+        self._staged = []
+
+#--------------------------------------------------------------------------------------------------------
+
+    def bisect(self, timestamp):
+
+        #Index of the first stored trade strictly later than timestamp (epoch nanoseconds)
+
+        self._flush()
+        return int(np.searchsorted(self._timestamps[self._head:self._size], timestamp, side='right'))
+
+    def bisectLeft(self, timestamp):
+
+        #Index of the first stored trade no earlier than timestamp (epoch nanoseconds)
+
+        self._flush()
+        return int(np.searchsorted(self._timestamps[self._head:self._size], timestamp, side='left'))
+
+    def totals(self, start, stop):
+
+        '''Total quantity and notional (price*quantity) of rows [start, stop), read off the prefix sums'''
+
+        self._flush()
+        start += self._head
+        stop += self._head
+        return int(self._cum_quantities[stop] - self._cum_quantities[start]), \
+               float(self._cum_notionals[stop] - self._cum_notionals[start])
+
+    def volumeWeightedPrice(self, after, until=None):
+
+        '''VWAP of trades later than `after` and no later than `until` (epoch nanoseconds, open-ended when None),
+        or None when no shares traded in that window'''
+
+        start = self.bisect(after)
+        stop = len(self) if until is None else self.bisect(until)
+        quantity, notional = self.totals(start, max(start, stop))
+        return notional / quantity if quantity > 0 else None
+
+    def volumeWeightedPrices(self, afters, untils):
+
+        '''Vectorised volumeWeightedPrice: one VWAP per pair of window bounds (int64 epoch-ns arrays), from two
+        sorted searches and the prefix sums, with NaN where no shares traded'''
+
+        timestamps = self.timestamps
+        start = np.searchsorted(timestamps, afters, side='right') + self._head
+        stop = np.maximum(np.searchsorted(timestamps, untils, side='right') + self._head, start)
+
+        quantities = self._cum_quantities[stop] - self._cum_quantities[start]
+        notionals = self._cum_notionals[stop] - self._cum_notionals[start]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(quantities > 0, notionals / quantities, np.nan)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def trade(self, index):
+
+        #Build a Trade object for one stored row
+
+        self._flush()
+        index += self._head
+        return Trade.trusted(fromEpochNanos(self._timestamps[index]), int(self._quantities[index]),
+                             TRADE_TYPES[int(self._sides[index])], self._prices[index].item())
+
+#--------------------------------------------------------------------------------------------------------
+
+class TradeSequence(Sequence):
+
+    '''Read-only, list-like view of a TradeStore. Trade objects are created lazily as elements are accessed;
+    slicing returns a plain list of Trades, as slicing the old trade list did. Each access holds the owning stock's
+    lock, and iteration works from a copy of the columns taken under it, so it sees one consistent state'''
+
+    #Rows converted to Python objects at a time while iterating
+    ITER_CHUNK = 65536
+
+    def __init__(self, store, lock):
+        self._store = store
+        self._lock = lock
+
+    def __len__(self):
+        return len(self._store)
+
+    def __getitem__(self, index):
+
+        with self._lock:
+            if isinstance(index, slice):
+                return [self._store.trade(i) for i in range(*index.indices(len(self._store)))]
+
+            size = len(self._store)
+            if index < 0:
+                index += size
+            if not 0 <= index < size:
+                raise IndexError("Trade index out of range")
+            return self._store.trade(index)
+
+    def __iter__(self):
+
+        #Iterates over a copy of the columns, converted to Python objects a chunk at a time (datetime64[us].tolist
+        #gives datetimes) and zipped into trusted Trades
+
+        with self._lock:
+            store = self._store
+            columns = (store.timestamps.view('datetime64[ns]').astype('datetime64[us]'), store.quantities.copy(),
+                       store.sides.copy(), store.prices.copy())
+
+        trusted = Trade.trusted
+        for start in range(0, len(columns[0]), self.ITER_CHUNK):
+            timestamps, quantities, sides, prices = (x[start:start + self.ITER_CHUNK].tolist() for x in columns)
+            for timestamp, quantity, side, price in zip(timestamps, quantities, sides, prices):
+                yield trusted(timestamp, quantity, TRADE_TYPES[side], price)
+
+    def __repr__(self):
+        return "[" + ", ".join(str(x) for x in self) + "]"
@@ -0,0 +1,354 @@
+__author__ = 'sachi'
+
+
+'''The window engine below maintains any number of sliding time windows (e.g. 1m/5m/15m/1h) over a stock's trades,
+each holding running aggregates that are updated as trades are added, so reading a windowed metric is O(1) rather than
+a rescan. Each window is an expiring deque: a new trade is appended and its contribution added to the running sums,
+trades falling out of the window are popped from the front and subtracted. Highs and lows are kept with monotonic
+deques. A trade's contributions are computed once and shared by all windows, so each trade costs one pass. A late
+trade (older than the newest in a window) is placed by bisection and patched into the monotonic deques where it
+falls, so it costs a bisection plus a shift of the (C level) deque entries after it, not a rescan of the window.
+
+Aggregates are sums of a per-trade value: the built-in ones below, plus any registered with addAggregate.
+The 'vwap', 'high' and 'low' metrics are derived from these and the monotonic deques'''
+
+import bisect
+import math
+
+from collections import deque
+from datetime import timedelta
+
+import numpy as np
+
+from SuperSimpleStocks.Trade import TradeType
+from SuperSimpleStocks.TradeStore import toEpochNanos
+
+#--------------------------------------------------------------------------------------------------------
+
+#Per-trade values summed by every window, called as value(timestamp, share_quantity, side, trade_price) with the
+#timestamp in epoch nanoseconds and the side as the TradeType value
+
+_BUY, _SELL = TradeType.BUY.value, TradeType.SELL.value
+
+BUILTIN_AGGREGATES = (
+    ('volume', lambda timestamp, quantity, side, price: quantity),
+    ('notional', lambda timestamp, quantity, side, price: price * quantity),
+    ('count', lambda timestamp, quantity, side, price: 1),
+    ('buy_volume', lambda timestamp, quantity, side, price: quantity if side == _BUY else 0),
+    ('sell_volume', lambda timestamp, quantity, side, price: quantity if side == _SELL else 0),
+)
+
+DERIVED_METRICS = ('vwap', 'high', 'low')
+
+#--------------------------------------------------------------------------------------------------------
+
+class SlidingWindow(object):
+
+    '''One window over the trades later than (now - length). Times are epoch nanoseconds, and `now` only moves
+    forward: it is the latest trade time seen or the latest time the window was read as of'''
+
+    #Running sums are recomputed exactly after this many expiries, to stop floating point drift from accumulating
+    RECOMPUTE_INTERVAL = 100000
+
+    def __init__(self, length, aggregate_count):
+        self._length = length
+        self._entries = deque()
+        self._maxima = deque()
+        self._minima = deque()
+        self._sums = [0] * aggregate_count
+        self._now = None
+        self._expiries = 0
+
+    @property
+    def length(self):
+        return self._length
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def newest(self):
+        return self._entries[-1][0] if self._entries else None
+
+#--------------------------------------------------------------------------------------------------------
+
+    def add(self, timestamp, price, values):
+
+        entries = self._entries
+        if self._now is not None and timestamp <= self._now - self._length:
+            return
+
+        if not entries or timestamp >= entries[-1][0]:
+            entries.append((timestamp, price, values))
+
+            maxima, minima = self._maxima, self._minima
+            while maxima and maxima[-1][1] <= price:
+                maxima.pop()
+            maxima.append((timestamp, price))
+            while minima and minima[-1][1] >= price:
+                minima.pop()
+            minima.append((timestamp, price))
+        else:
+            #Late trade still inside the window: placed by bisection after any trades with the same timestamp, and
+            #patched into the monotonic deques where it falls
+            entries.insert(bisect.bisect_right(entries, (timestamp, math.inf)), (timestamp, price, values))
+            self._insertExtreme(self._maxima, timestamp, price, 1)
+            self._insertExtreme(self._minima, timestamp, price, -1)
+
+        sums = self._sums
+        for i, value in enumerate(values):
+            sums[i] += value
+
+        if self._now is None or timestamp > self._now:
+            self.expire(timestamp)
+
+    def expire(self, now):
+
+        #Move the window end forward to `now`, popping (and subtracting) trades no later than now - length
+
+        if self._now is not None and now <= self._now:
+            return
+        self._now = now
+        cutoff = now - self._length
+
+        entries, sums = self._entries, self._sums
+        while entries and entries[0][0] <= cutoff:
+            for i, value in enumerate(entries.popleft()[2]):
+                sums[i] -= value
+            self._expiries += 1
+
+        for extremes in (self._maxima, self._minima):
+            while extremes and extremes[0][0] <= cutoff:
+                extremes.popleft()
+
+        if not entries:
+            self._sums = [0] * len(sums)
+        elif self._expiries >= self.RECOMPUTE_INTERVAL:
+            self._recompute()
+
+    def clear(self):
+        self._entries.clear()
+        self._maxima.clear()
+        self._minima.clear()
+        self._sums = [0] * len(self._sums)
+        self._now = None
+        self._expiries = 0
+
+#--------------------------------------------------------------------------------------------------------
+
+    def _recompute(self):
+
+        #Integer aggregates (volumes, counts) are summed exactly and stay ints; only float ones, such as the
+        #notional, need fsum
+
+        sums = []
+        for i in range(len(self._sums)):
+            values = [x[2][i] for x in self._entries]
+            sums.append(sum(values) if all(type(x) is int for x in values) else math.fsum(values))
+        self._sums = sums
+        self._expiries = 0
+
+    @staticmethod
+    def _insertExtreme(extremes, timestamp, price, sign):
+
+        #Patch a monotonic deque (sign 1 for the maxima, -1 for the minima) for a late trade placed after any trades
+        #with the same timestamp. The deque holds, in time order, each trade no later trade beats or ties, so the
+        #late trade only enters if it beats the first held trade after it, and then drops the held trades before
+        #it that it beats or ties (a run just before its position). Costs a bisection plus the trades dropped
+
+        key = sign * price
+        after = bisect.bisect_right(extremes, (timestamp, math.inf))
+        if after < len(extremes) and sign * extremes[after][1] >= key:
+            return
+
+        first = after
+        while first > 0 and sign * extremes[first - 1][1] <= key:
+            first -= 1
+        for i in range(after - first):
+            del extremes[first]
+        extremes.insert(first, (timestamp, price))
+
+    def total(self, index):
+        return self._sums[index]
+
+    def high(self):
+        return self._maxima[0][1] if self._maxima else None
+
+    def low(self):
+        return self._minima[0][1] if self._minima else None
+
+#--------------------------------------------------------------------------------------------------------
+
+class WindowEngine(object):
+
+    '''Sliding windows attached to one stock. The engine only listens to the stock's trades once a window is
+    registered; a window registered (or re-seeded after a new aggregate) on a stock with history starts from the
+    trades currently held in the stock's trade store'''
+
+    def __init__(self, stock):
+        self._stock = stock
+        self._windows = {}
+        self._names = [x[0] for x in BUILTIN_AGGREGATES]
+        self._functions = [x[1] for x in BUILTIN_AGGREGATES]
+        self._listening = False
+
+#--------------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def _length(window):
+
+        if type(window) is not timedelta:
+            raise TypeError("Invalid type for window : Requiring timedelta (got "+ str(type(window))+")")
+        elif window <= timedelta(0):
+            raise ValueError("Invalid window : Requiring positive timedelta (got "+ str(window)+")")
+        else:
+            return window // timedelta(microseconds=1) * 1000
+
+    @property
+    def windows(self):
+        return sorted(timedelta(microseconds=x // 1000) for x in self._windows)
+
+    @property
+    def aggregates(self):
+        return list(self._names) + list(DERIVED_METRICS)
+
+    def addWindow(self, window):
+
+        with self._stock.lock:
+            length = self._length(window)
+            if length not in self._windows:
+                self._windows[length] = SlidingWindow(length, len(self._names))
+                self._seed(self._windows[length])
+
+            if not self._listening:
+                self._stock.addTradeListener(self._tradesAdded)
+                self._stock.addResetListener(self._tradesReset)
+                self._listening = True
+
+    def removeWindow(self, window):
+
+        with self._stock.lock:
+            length = self._length(window)
+            if length not in self._windows:
+                raise ValueError("Invalid window, no window registered of length "+ str(window))
+            del self._windows[length]
+
+            if not self._windows and self._listening:
+                self._stock.removeTradeListener(self._tradesAdded)
+                self._stock.removeResetListener(self._tradesReset)
+                self._listening = False
+
+    def addAggregate(self, name, value):
+
+        '''Register an aggregate summed over every window, `value` being called per trade as
+        value(timestamp, share_quantity, side, trade_price). Existing windows are re-seeded to include it'''
+
+        with self._stock.lock:
+            if type(name) is not str or not callable(value):
+                raise TypeError("Invalid aggregate : Requiring name string and callable value (got "+ \
+                                str(type(name))+", "+ str(type(value))+")")
+            elif name in self._names or name in DERIVED_METRICS:
+                raise ValueError("Invalid aggregate, name already registered: "+ name)
+
+            self._names.append(name)
+            self._functions.append(value)
+            for length in self._windows:
+                self._windows[length] = SlidingWindow(length, len(self._names))
+                self._seed(self._windows[length])
+
+#--------------------------------------------------------------------------------------------------------
+
+    def _contributions(self, timestamp, quantity, side, price):
+        return tuple(f(timestamp, quantity, side, price) for f in self._functions)
+
+    def _seed(self, window):
+
+        #Fill a window from the trades held in the stock's store that fall inside it
+
+        store = self._stock._trade_store
+        if len(store) == 0:
+            return
+
+        timestamps = store.timestamps
+        start = int(np.searchsorted(timestamps, timestamps[-1] - window.length, side='right'))
+        for row in zip(timestamps[start:].tolist(), store.quantities[start:].tolist(), store.sides[start:].tolist(),
+                       store.prices[start:].tolist()):
+            window.add(row[0], row[3], self._contributions(*row))
+
+    def _tradesAdded(self, stock, timestamps, share_quantities, sides, trade_prices):
+
+        #Trade listener: each trade's contributions are computed once and added to every window. For a batch,
+        #only the trades recent enough to fall inside the longest window are visited, and a window the batch
+        #reaches back into is re-seeded from the (already merged) store rather than fed trade by trade
+
+        windows = list(self._windows.values())
+
+        if len(timestamps) == 1:
+            row = (timestamps[0], share_quantities[0], sides[0], trade_prices[0])
+            values = self._contributions(*row)
+            for window in windows:
+                window.add(row[0], row[3], values)
+            return
+
+        start = int(np.searchsorted(timestamps, timestamps[-1] - max(self._windows), side='right'))
+        rows = list(zip(*(np.asarray(x)[start:].tolist() for x in (timestamps, share_quantities, sides, trade_prices))))
+        contributions = [self._contributions(*row) for row in rows]
+
+        for window in windows:
+            if len(window) and rows[0][0] < window.newest:
+                window.clear()
+                self._seed(window)
+            else:
+                for row, values in zip(rows, contributions):
+                    window.add(row[0], row[3], values)
+
+    def _tradesReset(self, stock):
+
+        #Reset listener: the stock's trades were replaced, so every window starts again from the new trades
+
+        for window in self._windows.values():
+            window.clear()
+            self._seed(window)
+
+#--------------------------------------------------------------------------------------------------------
+
+    def value(self, window, aggregate, as_of=None):
+
+        '''Current value of an aggregate (or 'vwap', 'high', 'low') over a registered window ending at `as_of`
+        (a datetime, default now by the stock's clock; windows only move forward). O(1) amortised'''
+
+        with self._stock.lock:
+            length = self._length(window)
+            if length not in self._windows:
+                raise ValueError("Invalid window, no window registered of length "+ str(window))
+
+            sliding = self._windows[length]
+            sliding.expire(toEpochNanos(self._stock.clock() if as_of is None else as_of))
+
+            if aggregate == 'vwap':
+                volume = sliding.total(0)
+                if volume > 0:
+                    return sliding.total(1) / volume
+                else:
+                    raise ValueError("Unable to calculate Volume Weighted Stock Price, non-zero quantity required")
+            elif aggregate in ('high', 'low'):
+                price = sliding.high() if aggregate == 'high' else sliding.low()
+                if price is None:
+                    raise ValueError("Unable to give "+ aggregate +" price, no trades in window")
+                return price
+            elif aggregate in self._names:
+                return sliding.total(self._names.index(aggregate))
+            else:
+                raise ValueError("Invalid aggregate, no aggregate registered named "+ str(aggregate))
+
+    def values(self, window, as_of=None):
+
+        #All metrics for one window, with None for those not available
+
+        result = {}
+        for aggregate in self.aggregates:
+            try:
+                result[aggregate] = self.value(window, aggregate, as_of)
+            except ValueError:
+                result[aggregate] = None
+        return result
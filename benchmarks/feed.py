@@ -0,0 +1,106 @@
+__author__ = 'sachi'
+
+
+'''Throughput, lag and queue depth of the asyncio TradeFeed against a local replay generator: seeded trade messages
+are either served over a local TCP socket (as fast as the feed will take them) or replayed from a file.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.feed --source tcp --trades 1000000 --batch 20000
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from SuperSimpleStocks.Exchange import Exchange
+from SuperSimpleStocks.Feed import TradeFeed, fileSource, tcpSource
+from SuperSimpleStocks.Stock import Stock, StockType
+from benchmarks.threads import makeSymbols
+
+#--------------------------------------------------------------------------------------------------------
+
+def replayMessages(symbols, count, seed=0):
+
+    #Seeded trade messages (see Feed.encodeTrade) with increasing epoch-ns timestamps, as one bytes block
+
+    rng = np.random.RandomState(seed)
+    start = (datetime.utcnow() - timedelta(minutes=10) - datetime(1970, 1, 1)) // timedelta(microseconds=1) * 1000
+    timestamps = start + np.cumsum(rng.randint(1, 1000, size=count))
+    rows = zip(np.array(symbols)[rng.randint(0, len(symbols), size=count)].tolist(), timestamps.tolist(),
+               rng.randint(1, 100, size=count).tolist(), np.where(rng.randint(0, 2, size=count), 'BUY', 'SELL').tolist(),
+               rng.randint(1, 1000, size=count).tolist())
+    return "".join("%s,%d,%d,%s,%d\n" % x for x in rows).encode()
+
+async def runFeed(source, messages, symbols, batch_size, queue_length):
+
+    exchange = Exchange()
+    for x, symbol in enumerate(symbols):
+        exchange.addStock(Stock(symbol, StockType.Common, x % 10, x % 100 + 1))
+    feed = TradeFeed(exchange, batch_size=batch_size, max_queued_batches=queue_length)
+
+    if source == 'tcp':
+        async def serve(reader, writer):
+            writer.write(messages)
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        start_time = time.perf_counter()
+        stats = await feed.run(tcpSource('127.0.0.1', port))
+        elapsed = time.perf_counter() - start_time
+        server.close()
+    else:
+        with tempfile.NamedTemporaryFile(suffix='.trades', delete=False) as f:
+            f.write(messages)
+        try:
+            start_time = time.perf_counter()
+            stats = await feed.run(fileSource(f.name))
+            elapsed = time.perf_counter() - start_time
+        finally:
+            os.remove(f.name)
+
+    stats['trades_per_second'] = stats['applied'] / elapsed
+    return stats
+
+#--------------------------------------------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Asyncio trade feed benchmark")
+    parser.add_argument('--source', choices=('tcp', 'file'), default='tcp')
+    parser.add_argument('--symbols', type=int, default=100, help="number of stocks")
+    parser.add_argument('--trades', type=int, default=500000, help="messages replayed")
+    parser.add_argument('--batch', default='1000,10000,50000', help="comma separated batch sizes")
+    parser.add_argument('--queue', type=int, default=8, help="most batches queued")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    symbols = makeSymbols(args.symbols)
+    messages = replayMessages(symbols, args.trades)
+
+    results = []
+    print("%8s %14s %12s %12s %10s" % ("batch", "trades/s", "mean lag ms", "max lag ms", "max queue"))
+    for batch_size in [int(x) for x in args.batch.split(',')]:
+        stats = asyncio.run(runFeed(args.source, messages, symbols, batch_size, args.queue))
+        if stats['applied'] != args.trades:
+            raise RuntimeError("Lost trades : "+ str(stats))
+        stats['batch'] = batch_size
+        results.append(stats)
+        print("%8d %14.0f %12.2f %12.2f %10d" % (batch_size, stats['trades_per_second'], 1000 * stats['mean_lag'],
+                                                 1000 * stats['max_lag'], stats['max_queue_depth']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
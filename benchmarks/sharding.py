@@ -0,0 +1,87 @@
+__author__ = 'sachi'
+
+
+'''Ingest throughput of a single-process Exchange against a ShardedExchange with increasing shard counts, for the
+same seeded batches spread over many symbols. Index values are compared at the end as a consistency check.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.sharding --shards 1,2,4,8 --symbols 200 --batches 20 --batch 100000
+'''
+
+import argparse
+import json
+import time
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from SuperSimpleStocks.Exchange import Exchange
+from SuperSimpleStocks.ShardedExchange import ShardedExchange
+from SuperSimpleStocks.Stock import Stock, StockType
+from benchmarks.threads import makeSymbols
+
+#--------------------------------------------------------------------------------------------------------
+
+def makeBatches(symbols, batch_count, batch_size, seed=0):
+
+    #Seeded batches of (symbols, timestamps, quantities, sides, prices), timestamps mostly increasing across batches
+
+    rng = np.random.RandomState(seed)
+    start = np.datetime64(datetime.utcnow() - timedelta(minutes=10), 'ns')
+    symbols = np.array(symbols)
+    batches = []
+    for x in range(batch_count):
+        offsets = (x * batch_size + rng.randint(0, batch_size, size=batch_size)).astype('timedelta64[us]')
+        batches.append((symbols[rng.randint(0, len(symbols), size=batch_size)], start + offsets,
+                        rng.randint(1, 100, size=batch_size), rng.randint(1, 3, size=batch_size),
+                        rng.randint(1, 1000, size=batch_size)))
+    return batches
+
+def timeIngest(exchange, symbols, batches):
+
+    for x, symbol in enumerate(symbols):
+        exchange.addStock(Stock(symbol, StockType.Common, x % 10, x % 100 + 1))
+
+    start_time = time.perf_counter()
+    for batch in batches:
+        exchange.ingest(*batch)
+    elapsed = time.perf_counter() - start_time
+
+    return sum(len(x[0]) for x in batches) / elapsed, exchange.GBCEAllShareIndex()
+
+#--------------------------------------------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Sharded Exchange ingest benchmark")
+    parser.add_argument('--shards', default='1,2,4', help="comma separated shard counts")
+    parser.add_argument('--symbols', type=int, default=200, help="number of stocks")
+    parser.add_argument('--batches', type=int, default=10, help="number of ingest calls")
+    parser.add_argument('--batch', type=int, default=100000, help="trades per ingest call")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    symbols = makeSymbols(args.symbols)
+    batches = makeBatches(symbols, args.batches, args.batch)
+
+    rate, index = timeIngest(Exchange(), symbols, batches)
+    results = [{'shards': 0, 'trades_per_second': rate}]
+    print("%12s %16s" % ("shards", "trades/s"))
+    print("%12s %16.0f" % ("in-process", rate))
+
+    for shards in [int(x) for x in args.shards.split(',')]:
+        with ShardedExchange(shards) as exchange:
+            rate, sharded_index = timeIngest(exchange, symbols, batches)
+        if abs(sharded_index - index) > 1e-9 * abs(index):
+            raise RuntimeError("Index mismatch : "+ str(index)+" in-process, "+ str(sharded_index)+" sharded")
+        results.append({'shards': shards, 'trades_per_second': rate})
+        print("%12d %16.0f" % (shards, rate))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
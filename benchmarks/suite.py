@@ -0,0 +1,365 @@
+__author__ = 'sachi'
+
+
+'''Reproducible benchmarks for the hot paths: Stock.addTrade (in order, late, and single trades each read back),
+Stock.addTrades, getVolumeWeightedStockPrice, Exchange.GBCEAllShareIndex, Exchange.getStock, Exchange.ingest and
+Exchange.snapshot.
+
+Data is generated from a fixed seed, in the spirit of addRandomStocks / addRandomTrades in SSStocksTester. Each case
+runs at every size of the chosen preset (or the sizes given), with warm-up runs before the timed repeats. The
+memory held by the case's data is measured separately with tracemalloc (which also sees NumPy's buffers).
+Results are written as JSON, and two result files can be compared to flag regressions.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.suite run --preset medium --json before.json
+    python -m benchmarks.suite run --preset medium --json after.json
+    python -m benchmarks.suite compare before.json after.json --threshold 0.1
+'''
+
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from SuperSimpleStocks.Exchange import Exchange, IndexBasis
+from SuperSimpleStocks.Stock import Stock, StockType
+from SuperSimpleStocks.Trade import TradeType
+from benchmarks.threads import makeSymbols
+
+#--------------------------------------------------------------------------------------------------------
+
+#Sizes per preset: trade counts (per stock, or per batch for ingest) and stock counts
+
+PRESETS = {
+    'small': {'trades': [10000], 'stocks': [100]},
+    'medium': {'trades': [100000, 1000000], 'stocks': [100, 1000]},
+    'large': {'trades': [1000000, 10000000], 'stocks': [1000, 5000]},
+}
+
+#Calls per timed run for the cases timing many small operations
+CALLS = 10000
+
+#Fixed end of the generated trade history (and time of the trades added after it), so runs see identical data. The
+#generated stocks and exchanges tell the time by endClock, so "the last 15 minutes" always covers the same trades
+END_TIME = datetime(2024, 1, 2, 16)
+
+def endClock():
+    return END_TIME
+
+#--------------------------------------------------------------------------------------------------------
+
+#Seeded data generation
+
+def makeStocks(count, rng):
+
+    stocks = []
+    for symbol in makeSymbols(count):
+        if rng.randint(0, 2):
+            stocks.append(Stock(symbol, StockType.Preferred, int(rng.randint(0, 100)), int(rng.randint(1, 1000)),
+                                int(rng.randint(1, 100)), clock=endClock))
+        else:
+            stocks.append(Stock(symbol, StockType.Common, int(rng.randint(0, 100)), int(rng.randint(1, 1000)),
+                                clock=endClock))
+    return stocks
+
+def makeTradeColumns(count, rng, span=timedelta(hours=1), end=None):
+
+    #Trades spread evenly over the `span` before `end` (default END_TIME), in timestamp order
+
+    end = np.datetime64(END_TIME if end is None else end, 'ns')
+    step = max(1, int(span // timedelta(microseconds=1) * 1000 // max(count, 1)))
+    timestamps = end - (count - np.arange(count, dtype=np.int64)) * step
+    return (timestamps, rng.randint(1, 100, size=count), rng.randint(1, 3, size=count),
+            rng.randint(1, 1000, size=count))
+
+def makeExchange(stock_count, trades_per_stock, rng, index_basis=IndexBasis.ParValue):
+
+    exchange = Exchange(index_basis=index_basis, clock=endClock)
+    for stock in makeStocks(stock_count, rng):
+        if trades_per_stock:
+            stock.addTrades(*makeTradeColumns(trades_per_stock, rng))
+        exchange.addStock(stock)
+    return exchange
+
+#--------------------------------------------------------------------------------------------------------
+
+#Cases: name -> (size parameters, setup(params, rng) -> (state, calls), run(state)). The state is built once per
+#size unless the case is marked fresh, in which case every run gets a new one (cases that add trades, so every run
+#starts from the same stored history)
+
+def _setupAddTrade(params, rng):
+
+    stock = makeStocks(1, rng)[0]
+    stock.addTrades(*makeTradeColumns(params['trades'], rng))
+    now = END_TIME
+    rows = [(now + timedelta(microseconds=x), int(q), TradeType.BUY if s == 1 else TradeType.SELL, int(p))
+            for x, q, s, p in zip(range(CALLS), rng.randint(1, 100, CALLS), rng.randint(1, 3, CALLS),
+                                  rng.randint(1, 1000, CALLS))]
+    return {'stock': stock, 'rows': rows}, CALLS
+
+def _runAddTrade(state):
+    add = state['stock'].addTrade
+    for row in state['rows']:
+        add(*row)
+
+def _runAddTradeSingle(state):
+
+    #Each trade read back (through the VWAP) before the next one arrives, so trades reach the columns one at a time
+    #rather than in staged blocks
+
+    stock = state['stock']
+    add, vwap = stock.addTrade, stock.getVolumeWeightedStockPrice
+    for row in state['rows']:
+        add(*row)
+        vwap()
+
+def _setupAddTradeLate(params, rng):
+
+    #Trades landing at random points in the stored history, so each one shifts part of the columns
+
+    state, calls = _setupAddTrade(params, rng)
+    store = state['stock']._trade_store
+    first, last = int(store.timestamps[0]), int(store.timestamps[-1])
+    late = rng.randint(first, last, size=CALLS // 100)
+    state['rows'] = [(datetime(1970, 1, 1) + timedelta(microseconds=int(x) // 1000),) + row[1:]
+                     for x, row in zip(late, state['rows'])]
+    return state, len(state['rows'])
+
+def _setupAddTradeLateWindow(params, rng):
+
+    #Late trades falling inside a 15 minute sliding window registered on the stock, so each one is placed among the
+    #window's trades rather than appended
+
+    state, calls = _setupAddTrade(params, rng)
+    state['stock'].windows.addWindow(timedelta(minutes=15))
+    store = state['stock']._trade_store
+    last = int(store.timestamps[-1])
+    late = rng.randint(last - 10 * 60 * 10 ** 9, last, size=CALLS // 10)
+    state['rows'] = [(datetime(1970, 1, 1) + timedelta(microseconds=int(x) // 1000),) + row[1:]
+                     for x, row in zip(late, state['rows'])]
+    return state, len(state['rows'])
+
+def _setupAddTrades(params, rng):
+    return {'stock': makeStocks(1, rng)[0], 'columns': makeTradeColumns(params['trades'], rng)}, params['trades']
+
+def _runAddTrades(state):
+    state['stock'].addTrades(*state['columns'])
+
+def _setupVWAP(params, rng):
+    stock = makeStocks(1, rng)[0]
+    stock.addTrades(*makeTradeColumns(params['trades'], rng))
+    return stock, CALLS
+
+def _runVWAP(stock):
+    vwap = stock.getVolumeWeightedStockPrice
+    for x in range(CALLS):
+        vwap()
+
+def _setupIndex(params, rng):
+    return makeExchange(params['stocks'], 10, rng, IndexBasis.LastPrice), CALLS
+
+def _runIndex(exchange):
+    index = exchange.GBCEAllShareIndex
+    for x in range(CALLS):
+        index()
+
+def _runIndexTraded(exchange):
+
+    #Index reads interleaved with trades that move the index terms
+
+    stocks = list(exchange.stocks.values())
+    now = END_TIME
+    for x in range(CALLS):
+        stocks[x % len(stocks)].addTrade(now, 1, TradeType.BUY, x % 997 + 1)
+        exchange.GBCEAllShareIndex()
+
+def _setupGetStock(params, rng):
+    exchange = makeExchange(params['stocks'], 0, rng)
+    symbols = list(exchange.stocks)
+    return {'exchange': exchange, 'symbols': [symbols[x] for x in rng.randint(0, len(symbols), CALLS)]}, CALLS
+
+def _runGetStock(state):
+    get = state['exchange'].getStock
+    for symbol in state['symbols']:
+        get(symbol)
+
+def _setupIngest(params, rng):
+    exchange = makeExchange(params['stocks'], 0, rng)
+    symbols = np.array(list(exchange.stocks))
+    columns = makeTradeColumns(params['trades'], rng)
+    return {'exchange': exchange, 'columns': (symbols[rng.randint(0, len(symbols), params['trades'])],) + columns}, \
+           params['trades']
+
+def _runIngest(state):
+    state['exchange'].ingest(*state['columns'])
+
+def _setupSnapshot(params, rng):
+    return makeExchange(params['stocks'], max(1, params['trades'] // params['stocks']), rng), 1
+
+def _runSnapshot(exchange):
+    exchange.snapshot()
+
+CASES = {
+    'add_trade': (('trades',), _setupAddTrade, _runAddTrade, True),
+    'add_trade_single': (('trades',), _setupAddTrade, _runAddTradeSingle, True),
+    'add_trade_late': (('trades',), _setupAddTradeLate, _runAddTrade, True),
+    'add_trade_late_window': (('trades',), _setupAddTradeLateWindow, _runAddTrade, True),
+    'add_trades': (('trades',), _setupAddTrades, _runAddTrades, True),
+    'vwap': (('trades',), _setupVWAP, _runVWAP, False),
+    'gbce_index': (('stocks',), _setupIndex, _runIndex, False),
+    'gbce_index_traded': (('stocks',), _setupIndex, _runIndexTraded, False),
+    'get_stock': (('stocks',), _setupGetStock, _runGetStock, False),
+    'ingest': (('trades', 'stocks'), _setupIngest, _runIngest, True),
+    'snapshot': (('trades', 'stocks'), _setupSnapshot, _runSnapshot, False),
+}
+
+#--------------------------------------------------------------------------------------------------------
+
+def parameterSets(names, sizes):
+    sets = [{}]
+    for name in names:
+        sets = [dict(x, **{name: value}) for x in sets for value in sizes[name]]
+    return sets
+
+def measureMemory(setup, params, seed):
+
+    #Bytes held by the case's data once set up, and the peak while setting it up
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        state = setup(params, np.random.RandomState(seed))
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del state
+    return current, peak
+
+def runCase(name, params, seed, warmup, repeats, memory):
+
+    names, setup, run, fresh = CASES[name]
+    rng = np.random.RandomState(seed)
+    state, calls = setup(params, rng)
+
+    seconds = []
+    for x in range(warmup + repeats):
+        if fresh and x > 0:
+            state, calls = setup(params, np.random.RandomState(seed))
+        gc.collect()
+        gc.disable()
+        try:
+            start_time = time.perf_counter()
+            run(state)
+            elapsed = time.perf_counter() - start_time
+        finally:
+            gc.enable()
+        if x >= warmup:
+            seconds.append(elapsed)
+    del state
+
+    result = {'case': name, 'params': params, 'calls': calls, 'seconds': seconds,
+              'min': min(seconds), 'median': statistics.median(seconds), 'mean': statistics.mean(seconds),
+              'ns_per_call': 1e9 * statistics.median(seconds) / calls}
+    if memory:
+        result['memory_bytes'], result['peak_memory_bytes'] = measureMemory(setup, params, seed)
+    return result
+
+def runSuite(cases, sizes, seed, warmup, repeats, memory, out=sys.stdout):
+
+    results = []
+    print("%-20s %-34s %12s %14s %12s" % ("case", "params", "median s", "ns/call", "memory MB"), file=out)
+    for name in cases:
+        for params in parameterSets(CASES[name][0], sizes):
+            result = runCase(name, params, seed, warmup, repeats, memory)
+            results.append(result)
+            print("%-20s %-34s %12.6f %14.1f %12s" % (name, json.dumps(params), result['median'], result['ns_per_call'],
+                  "%.1f" % (result['memory_bytes'] / 2 ** 20) if memory else "-"), file=out)
+    return results
+
+#--------------------------------------------------------------------------------------------------------
+
+def compareResults(before, after, threshold):
+
+    '''Pair up results by case and parameters and compare median times. Returns rows of
+    (case, params, before median, after median, ratio, verdict), the verdict being 'regression' when after is
+    more than `threshold` (a fraction) slower, 'improvement' when that much faster, else 'same'''
+
+    def key(result):
+        return result['case'], json.dumps(result['params'], sort_keys=True)
+
+    earlier = dict((key(x), x) for x in before['results'])
+    rows = []
+    for result in after['results']:
+        previous = earlier.get(key(result))
+        if previous is None:
+            continue
+        ratio = result['median'] / previous['median'] if previous['median'] > 0 else float('inf')
+        verdict = 'regression' if ratio > 1 + threshold else 'improvement' if ratio < 1 - threshold else 'same'
+        rows.append(key(result) + (previous['median'], result['median'], ratio, verdict))
+    return rows
+
+def main():
+
+    parser = argparse.ArgumentParser(description="SuperSimpleStocks hot path benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="run the benchmarks")
+    run.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    run.add_argument('--trades', help="comma separated trade counts, overriding the preset")
+    run.add_argument('--stocks', help="comma separated stock counts, overriding the preset")
+    run.add_argument('--cases', default=','.join(CASES), help="comma separated cases to run")
+    run.add_argument('--seed', type=int, default=12345)
+    run.add_argument('--warmup', type=int, default=1)
+    run.add_argument('--repeats', type=int, default=5)
+    run.add_argument('--no-memory', action='store_true', help="skip the (slower) memory measurement")
+    run.add_argument('--json', help="write the results to this JSON file")
+
+    compare = commands.add_parser('compare', help="compare two result files")
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--threshold', type=float, default=0.1, help="relative change flagged (default 0.1)")
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+
+        rows = compareResults(before, after, args.threshold)
+        print("%-20s %-34s %12s %12s %8s  %s" % ("case", "params", "before s", "after s", "ratio", "verdict"))
+        for case, params, earlier, later, ratio, verdict in rows:
+            print("%-20s %-34s %12.6f %12.6f %8.3f  %s" % (case, params, earlier, later, ratio,
+                                                          verdict.upper() if verdict == 'regression' else verdict))
+        sys.exit(1 if any(x[-1] == 'regression' for x in rows) else 0)
+
+    sizes = dict(PRESETS[args.preset])
+    for name in ('trades', 'stocks'):
+        if getattr(args, name):
+            sizes[name] = [int(x) for x in getattr(args, name).split(',')]
+    cases = args.cases.split(',')
+    for name in cases:
+        if name not in CASES:
+            parser.error("unknown case "+ name +", choose from "+ ", ".join(CASES))
+
+    results = runSuite(cases, sizes, args.seed, args.warmup, args.repeats, not args.no_memory)
+
+    if args.json:
+        meta = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                'processor': platform.processor(), 'seed': args.seed, 'warmup': args.warmup,
+                'repeats': args.repeats, 'sizes': sizes, 'time': datetime.utcnow().isoformat()}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+__author__ = 'sachi'
+
+
+'''Throughput of a thread-safe Exchange as producer (writer) and consumer (reader) threads are added.
+Each writer owns its own symbols and adds trades either one at a time (Stock.addTrade) or in batches
+(Exchange.ingest); readers poll VWAPs and the GBCE index until the writers finish. The run is checked for lost trades.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.threads --writers 1,2,4,8 --readers 0,4 --trades 20000 --batch 1
+'''
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from SuperSimpleStocks.Exchange import Exchange, IndexBasis
+from SuperSimpleStocks.Stock import Stock, StockType
+from SuperSimpleStocks.Trade import TradeType
+
+#--------------------------------------------------------------------------------------------------------
+
+SYMBOLS_PER_WRITER = 4
+
+def makeSymbols(count):
+
+    #Distinct 3-letter symbols: AAA, AAB, ...
+
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return [letters[x // 676] + letters[x // 26 % 26] + letters[x % 26] for x in range(count)]
+
+def makeWriterData(symbols, trade_count, batch_size, seed):
+
+    #Pre-generate one writer's trades, in the form the chosen write path takes, so generation is not timed
+
+    rng = np.random.RandomState(seed)
+    start = datetime.utcnow() - timedelta(minutes=10)
+    quantities = rng.randint(1, 100, size=trade_count)
+    prices = rng.randint(1, 1000, size=trade_count)
+    sides = rng.randint(1, 3, size=trade_count)
+    picks = rng.randint(0, len(symbols), size=trade_count)
+
+    if batch_size == 1:
+        return [(symbols[picks[x]], start + timedelta(microseconds=x), int(quantities[x]), TradeType(int(sides[x])),
+                 int(prices[x])) for x in range(trade_count)]
+
+    timestamps = np.datetime64(start, 'ns') + np.arange(trade_count).astype('timedelta64[us]')
+    batch_symbols = np.array(symbols)[picks]
+    return [(batch_symbols[x:x + batch_size], timestamps[x:x + batch_size], quantities[x:x + batch_size],
+             sides[x:x + batch_size], prices[x:x + batch_size]) for x in range(0, trade_count, batch_size)]
+
+#--------------------------------------------------------------------------------------------------------
+
+def runThroughput(writer_count, reader_count, trade_count, batch_size, seed=0):
+
+    '''One timed run: returns trades written per second and reader queries per second'''
+
+    ex = Exchange(index_basis=IndexBasis.LastPrice, thread_safe=True)
+    symbols = makeSymbols(writer_count * SYMBOLS_PER_WRITER)
+    for symbol in symbols:
+        ex.addStock(Stock(symbol, StockType.Common, 5, 100))
+
+    data = [makeWriterData(symbols[x * SYMBOLS_PER_WRITER:(x + 1) * SYMBOLS_PER_WRITER], trade_count, batch_size,
+                           seed + x) for x in range(writer_count)]
+
+    start_barrier = threading.Barrier(writer_count + reader_count + 1)
+    writers_done = threading.Event()
+    reads = [0] * reader_count
+
+    def write(rows):
+        start_barrier.wait()
+        if batch_size == 1:
+            for symbol, timestamp, quantity, trade_type, price in rows:
+                ex.getStock(symbol).addTrade(timestamp, quantity, trade_type, price)
+        else:
+            for batch in rows:
+                ex.ingest(*batch)
+
+    def read(index):
+        rng = random.Random(seed + index)
+        start_barrier.wait()
+        while not writers_done.is_set():
+            try:
+                ex.getStock(rng.choice(symbols)).getVolumeWeightedStockPrice()
+            except ValueError:
+                pass
+            ex.GBCEAllShareIndex()
+            reads[index] += 2
+
+    writers = [threading.Thread(target=write, args=(x,)) for x in data]
+    readers = [threading.Thread(target=read, args=(x,)) for x in range(reader_count)]
+    for thread in writers + readers:
+        thread.start()
+
+    start_barrier.wait()
+    start_time = time.perf_counter()
+    for thread in writers:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    writers_done.set()
+    for thread in readers:
+        thread.join()
+
+    stored = sum(len(ex.getStock(x).trades) for x in symbols)
+    if stored != writer_count * trade_count:
+        raise RuntimeError("Lost trades : expected "+ str(writer_count * trade_count)+", stored "+ str(stored))
+
+    return stored / elapsed, sum(reads) / elapsed
+
+#--------------------------------------------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Thread-safe Exchange throughput benchmark")
+    parser.add_argument('--writers', default='1,2,4,8', help="comma separated writer thread counts")
+    parser.add_argument('--readers', default='0,4', help="comma separated reader thread counts")
+    parser.add_argument('--trades', type=int, default=20000, help="trades per writer thread")
+    parser.add_argument('--batch', type=int, default=1, help="trades per write (1 = Stock.addTrade)")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    print("%8s %8s %16s %16s" % ("writers", "readers", "trades/s", "queries/s"))
+    for readers in [int(x) for x in args.readers.split(',')]:
+        for writers in [int(x) for x in args.writers.split(',')]:
+            writes, reads = runThroughput(writers, readers, args.trades, args.batch)
+            results.append({'writers': writers, 'readers': readers, 'batch': args.batch,
+                            'trades_per_second': writes, 'queries_per_second': reads})
+            print("%8d %8d %16.0f %16.0f" % (writers, readers, writes, reads))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()